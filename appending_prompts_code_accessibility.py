@@ -5,91 +5,227 @@ import time
 from bs4 import BeautifulSoup
 import tiktoken
 import concurrent.futures
+from typing import List
+from pydantic import BaseModel, Field, ValidationError
+from instructor.exceptions import InstructorRetryException
+from llm_gateway import LLM_GATEWAY, model_call
+from html_compaction import compact_soup, report_compaction
+from wcag_rules import check_chunk, label_ids
 
-from constants import BOTO3_CLIENT, OPEN_AI_CLIENT, MODEL_ID, MAX_ISSUES_CODE_ACESSIBILITY, MODEL_SELECTION, ANTHROPIC_VERSION, MAX_TOKENS
+from constants import BOTO3_CLIENT, OPEN_AI_CLIENT, MODEL_ID, MAX_ISSUES_CODE_ACESSIBILITY, MODEL_SELECTION, ANTHROPIC_VERSION, MAX_TOKENS, INSTRUCTOR_CLIENT, ACCESSIBILITY_REVIEW_MODE, ACCESSIBILITY_RULES_ENABLED
 
 """
 This script uses the Claude AI model to analyze HTML code for accessibility issues and suggest improvements based on WCAG 2.1 AA guidelines.
 Four API calls are used to create a structured response  which includes the original code issue, the suggested improvement, the explanation, and the label for the suggested improvement.
+Each call goes through the model response cache, so an unchanged chunk is not sent to the model again.
+
+The "structured" review mode gets all four fields for up to MAX_ISSUES_CODE_ACESSIBILITY issues in a single
+Instructor call instead. The mode is chosen with ACCESSIBILITY_REVIEW_MODE so both can be compared.
 """
 
+REVIEW_MODES = ("conversation", "structured")
+
+
+class AccessibilityIssue(BaseModel):
+    original_content: str = Field(..., description="The exact HTML from the input that has the accessibility issue.")
+    revised_content: str = Field(..., description="The improved HTML that fixes the accessibility issue.")
+    explanation: str = Field(..., description="Why the improvement is necessary, citing the WCAG 2.1 guideline it meets.")
+    label: str = Field(..., description="A short label for the issue, such as 'Missing alt text for image'.")
+
 tokenizer = tiktoken.get_encoding('cl100k_base') 
 
-def chunk_html_script(html_script, max_tokens = MAX_TOKENS):
+def chunk_html_script(html_script, max_tokens = MAX_TOKENS, compact = True):
     """
     This function takes a HTML script and chunks it into smaller pieces based on the max number of tokens.
     Args:
         html_script (str): The HTML script to be chunked.
         max_tokens (int): The maximum number of tokens allowed in each chunk. 
+        compact (bool): Strip scripts, styles and attributes that are not relevant to accessibility before chunking.
 
     Returns:
         list: A list of HTML chunks.
 
     """
-    chunks = []
-
-    soup = BeautifulSoup(html_script, 'html.parser')
+    soup = parse_html(html_script)
+    if compact:
+        compact_soup(soup)
     full_html = soup.html
 
+    # the page is walked once to count the tokens of the HTML of every element
+    tags = ['section', 'div', 'article', 'li']
+    counts = subtree_token_counts(full_html, markup=True)
+    if compact:
+        report_compaction(num_tokens(html_script), counts[id(full_html)])
+
     chunks = []
 
     #iterates though direct children of <html> 
     for top_ele in full_html.find_all(['head', 'body'], recursive= False):
-        #iterates though direct children of <head. and <body> maintaining structure 
-        for elem in top_ele.find_all(['section', 'div', 'article', 'li'], recursive=False):
-            html_chunk = str(elem)
-            if not html_chunk:
-                continue
-            
-            if num_tokens(html_chunk) <= max_tokens:
-                chunks.append(html_chunk)
-            else:
-                # Go deeper recursively
-                chunks.extend(chunk_element(elem, max_tokens))
-
+        #iterates though direct children of <head. and <body> maintaining structure, going deeper into the ones that are too big
+        chunks.extend(chunk_elements(top_ele.find_all(tags, recursive=False), max_tokens, counts, tags, markup=True))
 
     return chunks
 
     
-#change this to passing a parameter for what model function it is using 
-def threading_code_accessibility(chunked_html_code):
+def iter_code_accessibility(chunked_html_code, mode=ACCESSIBILITY_REVIEW_MODE, use_rules=ACCESSIBILITY_RULES_ENABLED, html_source=None):
     """
-    This function takes a list of HTML code chunks and processes them in parallel to find accessibility issues.
+    This function takes a list of HTML code chunks, processes them in parallel to find accessibility issues and yields
+    the suggestions as they are found: first the findings of the local WCAG rules (wcag_rules.py) for all chunks, then
+    the model review of each chunk as it completes. With use_rules, only the chunks with content the rules can not
+    judge are sent to the model. Must not be called from a gateway worker.
     Args:
         chunked_html_code (list): A list of HTML code chunks.
+        mode (str): "conversation" for the four call review or "structured" for the single call review.
+        use_rules (bool): Run the local rules before the model review.
+        html_source (str): The HTML of the whole page, whose <label for=...> ids the form field rule uses. The
+            chunks are used when it is not given.
+    Yields:
+        list: The suggestions of the rules, or of the model review of one chunk.
+    """
+    if mode not in REVIEW_MODES:
+        raise ValueError(f"Unknown accessibility review mode: {mode}")
+
+    if mode == "structured":
+        review = code_accessibility_review_structured
+    elif MODEL_SELECTION:
+        review = code_accessibility_review_claude
+    else:
+        review = code_accessibility_review_openai
+
+    start_time = time.time()
+
+    model_sections = chunked_html_code
+    if use_rules:
+        model_sections = []
+        findings_by_markup = {}
+        # a label and its field can be in different chunks
+        page_labeled_ids = label_ids(html_source if html_source is not None else "\n".join(chunked_html_code))
+        for section in chunked_html_code:
+            findings, needs_model = check_chunk(section, page_labeled_ids)
+            for finding in findings:
+                # the same markup (e.g. a repeated icon) is only reported once
+                findings_by_markup.setdefault((finding["label"], finding["original_content"]), finding)
+            if needs_model:
+                model_sections.append(section)
+        print(f"Accessibility rules found {len(findings_by_markup)} issues in {time.time() - start_time:.3f} seconds, "
+              f"sending {len(model_sections)} of {len(chunked_html_code)} chunks to the model")
+        if findings_by_markup:
+            yield list(findings_by_markup.values())
+
+    # Process the HTML code chunks in parallel on the shared model gateway
+    future_to_section = {
+        LLM_GATEWAY.submit(review, section): section
+        for section in model_sections
+    }
+
+    for future in concurrent.futures.as_completed(future_to_section):
+        try:
+            yield future.result()
+        except Exception as e:
+            print(f"Error processing a section: {e}")
+
+    print(f"{mode} accessibility review of {len(model_sections)} chunks took {time.time() - start_time:.2f} seconds")
+
+
+def threading_code_accessibility(chunked_html_code, mode=ACCESSIBILITY_REVIEW_MODE, use_rules=ACCESSIBILITY_RULES_ENABLED, html_source=None):
+    """
+    This function takes a list of HTML code chunks and processes them in parallel to find accessibility issues.
+    See `iter_code_accessibility`.
     Returns:
         list: A list of suggestions for accessibility improvements.
     """
-    suggestions = []
-    # Use ThreadPoolExecutor to process the HTML code chunks in parallel
-    if MODEL_SELECTION:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            future_to_section = {
-                executor.submit(code_accessibility_review_claude, section): section
-                for section in chunked_html_code
-            }
+    return [suggestion for batch in iter_code_accessibility(chunked_html_code, mode, use_rules, html_source) for suggestion in batch]
 
-        for future in concurrent.futures.as_completed(future_to_section):
-            try:
-                result = future.result()
-                suggestions.extend(result)
-            except Exception as e:
-                print(f"Error processing a section: {e}")
-    else:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            future_to_section = {
-                executor.submit(code_accessibility_review_openai, section): section
-                for section in chunked_html_code
-            }
 
-        for future in concurrent.futures.as_completed(future_to_section):
-            try:
-                result = future.result()
-                suggestions.extend(result)
-            except Exception as e:
-                print(f"Error processing a section: {e}")
+def code_accessibility_review_structured(html_code, max_issues=MAX_ISSUES_CODE_ACESSIBILITY):
+    """
+    Using a single structured (Instructor) call, analyze the HTML code to provide suggestions for improving accessibility.
+    This returns the same fields as the four call review (code issue, suggestion, explanation and label) for up to
+    max_issues issues at once, so the HTML chunk is only sent to the model once.
 
-    return suggestions
+    Args:
+        html_code (str): The HTML code to be analyzed.
+        max_issues (int): The maximum number of issues to return.
+    Returns:
+        list: A list of suggestions for accessibility improvements.The list contains dictionaries with the following keys:
+            - original_content: The original HTML code with the accessibility issue.
+            - revised_content: The suggested improvement for the HTML code.
+            - explanation: An explanation of why the suggested improvement is necessary.
+            - label: A label for the identified code issue and suggested improvement.
+    """
+    input_message = f'''You are a strict accessibility reviewer analyzing the following HTML: {html_code} 
+                Your task is to identify **only real** accessibility issues based on WCAG 2.1 AA guidelines. 
+                Do **not** invent problems. Do not include correct code. 
+                Only include suggestions when an issue is present in the exact HTML. 
+
+                - Find at most {max_issues} issues
+                - Cite the exact HTML in original_content, if you can not find the exact HTML, do not return the issue.
+                - Only provide the improved HTML code in revised_content
+                - Explain the improvement and cite the WCAG 2.1 guideline in explanation
+                - Give the issue a short label
+                - If you can not find any issues return an empty list: []
+
+                - #1 example: original_content: '<img src="images">', revised_content: '<img src="images" alt="This is an image">',
+                  explanation: 'Adding alt text to images provides a text alternative for screen reader users, improving accessibility in accordance with WCAG 2.1 guideline 1.1.1 (Non-text Content).',
+                  label: 'Missing alt text for image'
+                - #2 example: original_content: '<button></button>', revised_content: '<button aria-label="Submit form"></button>',
+                  explanation: 'Using an aria-label on buttons without visible text ensures that assistive technology users can understand their function, supporting WCAG 2.1 guideline 4.1.2 (Name, Role, Value).',
+                  label: 'Button lacks accessible name'
+                - #3 example: original_content: '<a href="#">Click here</a>', revised_content: '<a href="/reports">View the full election report</a>',
+                  explanation: 'Replacing vague link text like "Click here" with descriptive text improves navigation and comprehension for screen reader users, meeting WCAG 2.1 guideline 2.4.4 (Link Purpose).',
+                  label: 'Non-descriptive link text'
+                - #4 example: original_content: '<label>Email</label><input type="email" id="user-email">', revised_content: '<label for="user-email">Email</label><input type="email" id="user-email">',
+                  explanation: 'Using the 'for' attribute ensures labels are programmatically associated with form fields, which is essential for assistive technology users, aligning with WCAG 2.1 guideline 1.3.1 (Info and Relationships).',
+                  label: 'Label not associated with input field'
+                - #5 example: original_content: '<div onclick="openMenu()">Menu</div>', revised_content: '<button onclick="openMenu()">Menu</button>',
+                  explanation: 'Interactive elements must use semantic HTML like <button> to be properly understood by screen readers and keyboard users, as outlined in WCAG 2.1 guideline 4.1.2 (Name, Role, Value).',
+                  label: 'Non-semantic interactive element'
+                '''
+
+    messages = [{"role": "user", "content": input_message}]
+
+    def request_issues():
+        if MODEL_SELECTION:
+            resp = INSTRUCTOR_CLIENT.messages.create(
+                model=MODEL_ID,
+                max_tokens=MAX_TOKENS,
+                messages=messages,
+                response_model=List[AccessibilityIssue],
+            )
+        else:
+            resp = INSTRUCTOR_CLIENT.chat.completions.create(
+                model=MODEL_ID,
+                messages=messages,
+                response_model=List[AccessibilityIssue],
+            )
+
+        if not isinstance(resp, list):
+            raise TypeError(f"Expected list, got {type(resp)}")
+
+        accessibility_improvements = []
+        for item in resp[:max_issues]:
+            if not isinstance(item, AccessibilityIssue):
+                raise TypeError("Invalid item type in response list.")
+            # skip incomplete issues, like the four call review does
+            if item.original_content and item.revised_content and item.explanation and item.label:
+                accessibility_improvements.append({
+                    "original_content": item.original_content,
+                    "revised_content": item.revised_content,
+                    "explanation": item.explanation,
+                    "label": item.label,
+                })
+        return accessibility_improvements
+
+    try:
+        return model_call(
+            "bedrock" if MODEL_SELECTION else "openai",
+            MODEL_ID,
+            {"messages": messages, "max_tokens": MAX_TOKENS, "response_model": "List[AccessibilityIssue]"},
+            request_issues,
+        )
+    except (ValidationError, InstructorRetryException, TypeError) as e:
+        print(f"Error processing structured accessibility response:{e} ")
+        return []
 
 
 def code_accessibility_review_claude(html_code): 
@@ -147,17 +283,8 @@ def code_accessibility_review_claude(html_code):
             }
         
     
-        resp = BOTO3_CLIENT.invoke_model(
-            modelId=MODEL_ID,
-            body=json.dumps(body),
-            contentType="application/json"
-        ) 
-    
-
-
-        # Read the response
-        response_body = json.loads(resp["body"].read())
-        code_issue = response_body["content"][0]["text"]
+        # Send the request to the model and read the response
+        code_issue = invoke_bedrock_text(body)
        
 
         # add the code issue to the accessibility review dictionary
@@ -207,16 +334,8 @@ def code_accessibility_review_claude(html_code):
                 "role": "user",
                 "content": prompt2.strip()
             })
-            # Send the request to the model
-            resp2 = BOTO3_CLIENT.invoke_model(
-                modelId=MODEL_ID,
-                body=json.dumps(body),
-                contentType="application/json"
-            )
-
-            # Read the response and add the suggestion to the accessibility review dictionary
-            response_body2 = json.loads(resp2["body"].read())
-            suggestion = response_body2["content"][0]["text"]
+            # Send the request to the model and read the response
+            suggestion = invoke_bedrock_text(body)
             accessibility_review["revised_content"] = suggestion
     
             # if suggestion is not found, print a message
@@ -257,17 +376,8 @@ def code_accessibility_review_claude(html_code):
                 "content": prompt3.strip()
             })
             
-            # Send the request to the model
-            resp3 = BOTO3_CLIENT.invoke_model(
-                modelId=MODEL_ID,
-                body=json.dumps(body),
-                contentType="application/json"
-            )
-
-            
-            # Read the response and add the explanation to the accessibility review dictionary
-            response_body3 = json.loads(resp3["body"].read())
-            explanation = response_body3["content"][0]["text"]
+            # Send the request to the model and read the response
+            explanation = invoke_bedrock_text(body)
             accessibility_review["explanation"] = explanation
  
 
@@ -305,15 +415,8 @@ def code_accessibility_review_claude(html_code):
                 "content": prompt4.strip()
             })
 
-            # Send the request to the model
-            resp4 = BOTO3_CLIENT.invoke_model(
-                modelId=MODEL_ID,
-                body=json.dumps(body),
-                contentType="application/json"
-            )
-            # Read the response and add the label to the accessibility review dictionary
-            response_body4 = json.loads(resp4["body"].read())
-            label = response_body4["content"][0]["text"]
+            # Send the request to the model and read the response
+            label = invoke_bedrock_text(body)
             accessibility_review["label"] = label
 
             if label == "":
@@ -388,16 +491,8 @@ def code_accessibility_review_openai(html_code):
             }
         
     
-        resp = OPEN_AI_CLIENT.chat.completions.create(
-            model=MODEL_ID,
-            messages= body["messages"],
-            max_tokens= body["max_tokens"],
-            temperature= body["temperature"],
-        ) 
-    
-
-        # Read the response
-        code_issue = resp.choices[0].message.content 
+        # Send the request to the model and read the response
+        code_issue = invoke_openai_text(body)
         #print(f"Code issue found: {code_issue}")
 
         # add the code issue to the accessibility review dictionary
@@ -447,16 +542,8 @@ def code_accessibility_review_openai(html_code):
                 "role": "user",
                 "content": prompt2.strip()
             })
-            # Send the request to the model
-            resp2 = OPEN_AI_CLIENT.chat.completions.create(
-                model=MODEL_ID,
-                messages= body["messages"],
-                max_tokens= body["max_tokens"],
-                temperature= body["temperature"],
-        ) 
-
-            # Read the response and add the suggestion to the accessibility review dictionary
-            suggestion = resp2.choices[0].message.content
+            # Send the request to the model and read the response
+            suggestion = invoke_openai_text(body)
             accessibility_review["revised_content"] = suggestion
     
             # if suggestion is not found, print a message
@@ -497,15 +584,8 @@ def code_accessibility_review_openai(html_code):
                 "content": prompt3.strip()
             })
             
-            # Send the request to the model
-            resp3 = OPEN_AI_CLIENT.chat.completions.create(
-                model=MODEL_ID,
-                messages= body["messages"],
-                max_tokens= body["max_tokens"],
-                temperature= body["temperature"],
-            )
-            # Read the response and add the explanation to the accessibility review dictionary
-            explanation = resp3.choices[0].message.content
+            # Send the request to the model and read the response
+            explanation = invoke_openai_text(body)
             accessibility_review["explanation"] = explanation
  
 
@@ -543,15 +623,8 @@ def code_accessibility_review_openai(html_code):
                 "content": prompt4.strip()
             })
 
-            # Send the request to the model
-            resp4= OPEN_AI_CLIENT.chat.completions.create(
-                model=MODEL_ID,
-                messages= body["messages"],
-                max_tokens= body["max_tokens"],
-                temperature= body["temperature"],
-            )
-            # Read the response and add the label to the accessibility review dictionary
-            label = resp4.choices[0].message.content
+            # Send the request to the model and read the response
+            label = invoke_openai_text(body)
             accessibility_review["label"] = label
 
             if label == "":
@@ -0,0 +1,312 @@
+import json
+import threading
+import time
+import uuid
+
+from llm_cache import set_llm_cache_bypass, reset_llm_cache_bypass
+from constants import (AUDIT_JOB_WORKERS, AUDIT_JOB_POLL_SECONDS, AUDIT_JOB_HEARTBEAT_SECONDS, AUDIT_JOB_STALE_SECONDS,
+                       AUDIT_JOB_MAX_ATTEMPTS)
+
+'''
+This script runs the project audits (web design, accessibility and content) as background jobs, so
+POST /create-project can return at once instead of holding the connection open for several minutes.
+
+The jobs are rows of the AuditJob table (migrations/003_audit_job.sql), there is no other broker:
+- enqueue inserts a queued job and wakes a local worker.
+- A worker claims the oldest queued job with a single UPDATE that sets its claimToken, so the workers of
+  several processes can share the table and each job runs once.
+- The status and output of each audit are written to the job as soon as that audit finishes, so clients
+  can poll the progress and the partial results.
+- While a job runs, its worker process touches updatedAt every AUDIT_JOB_HEARTBEAT_SECONDS. A running job
+  that has not been updated for AUDIT_JOB_STALE_SECONDS (its process stopped) is queued again, up to
+  AUDIT_JOB_MAX_ATTEMPTS runs, and then failed. A requeued job only runs the audits that did not finish,
+  so their audit and suggestion rows are not saved twice.
+- Every write checks the claimToken, so a worker whose job was requeued and claimed again can not
+  overwrite the progress of the new run.
+'''
+
+PROJECT_AUDITS = ("web_design_audit", "accessibility_audit", "content_audit")
+
+
+class AuditJobQueue:
+    """A pool of worker threads running the project audit jobs stored in the AuditJob table."""
+
+    def __init__(self, connect, run_audits, workers=AUDIT_JOB_WORKERS, poll_seconds=AUDIT_JOB_POLL_SECONDS,
+                 heartbeat_seconds=AUDIT_JOB_HEARTBEAT_SECONDS, stale_seconds=AUDIT_JOB_STALE_SECONDS,
+                 max_attempts=AUDIT_JOB_MAX_ATTEMPTS):
+        """
+        Args:
+            connect (callable): Returns a new database connection.
+            run_audits (callable): Runs the audits of a job, called as run_audits(url, projectId, on_audit_done, audits)
+                where on_audit_done(audit_name, result, error) is called as each audit finishes and audits are the
+                names of the audits to run.
+            workers (int): The number of jobs run at once.
+            poll_seconds (float): How often idle workers check for jobs queued by other processes.
+            heartbeat_seconds (float): How often the running jobs are marked as alive.
+            stale_seconds (float): How long a running job can go without an update before it is queued again.
+            max_attempts (int): The number of times a job is run before it is failed.
+        """
+        self.connect = connect
+        self.run_audits = run_audits
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._claims = set()  # the claim tokens of the jobs running in this process
+        self._lock = threading.Lock()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        """Start the worker threads. Safe to call more than once."""
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"audit-job-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._heartbeat, name="audit-job-heartbeat", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def enqueue(self, projectId, url, bypass_cache=False):
+        """Queue the audits of a project.
+        Args:
+            projectId (int): The ID of the project the audits belong to.
+            url (str): The URL of the webpage to audit.
+            bypass_cache (bool): Skip the model response cache for the model calls of the audits.
+        Returns:
+            int: The ID of the job.
+        """
+        progress = {audit_name: {"status": "queued"} for audit_name in PROJECT_AUDITS}
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "INSERT INTO AuditJob (projectId, url, bypassCache, progress, results) VALUES (%s, %s, %s, %s, %s)",
+                (projectId, url, bypass_cache, json.dumps(progress), json.dumps({}))
+            )
+            conn.commit()
+            job_id = cursor.lastrowid
+        finally:
+            cursor.close()
+            conn.close()
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id, include_results=False):
+        """Return a job, or None if there is no job with this ID.
+        Args:
+            job_id (int): The ID of the job.
+            include_results (bool): Include the output of the audits that finished.
+        Returns:
+            dict: The job ID, projectId, url, status, the progress of each audit, attempts, error and times, and
+                with include_results, `results` mapping the audits that finished to their output.
+        """
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT auditJobId, projectId, url, status, progress, error, attempts, createdAt, startedAt, finishedAt"
+                + (", results" if include_results else "") + " FROM AuditJob WHERE auditJobId = %s",
+                (job_id,)
+            )
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+            conn.close()
+
+        if not row:
+            return None
+        job = {
+            "jobId": row[0],
+            "projectId": row[1],
+            "url": row[2],
+            "status": row[3],
+            "audits": json.loads(row[4]) if row[4] else {},
+            "error": row[5],
+            "attempts": row[6],
+            "createdAt": str(row[7]) if row[7] else None,
+            "startedAt": str(row[8]) if row[8] else None,
+            "finishedAt": str(row[9]) if row[9] else None,
+        }
+        if include_results:
+            job["results"] = json.loads(row[10]) if row[10] else {}
+        return job
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers if self._threads else 0, "running": self.running, "completed": self.completed, "failed": self.failed}
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"Error claiming an audit job: {e}")
+                job = None
+
+            if job is None:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+                continue
+
+            # another worker may be idle and there may be more queued jobs
+            self._wake.set()
+            self._run(job)
+
+    def _heartbeat(self):
+        """Touch updatedAt of the jobs running in this process, so they are not taken for stale."""
+        while not self._stop.wait(self.heartbeat_seconds):
+            with self._lock:
+                claims = list(self._claims)
+            if not claims:
+                continue
+            conn = self.connect()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    f"UPDATE AuditJob SET updatedAt = NOW() WHERE claimToken IN ({', '.join(['%s'] * len(claims))})",
+                    claims
+                )
+                conn.commit()
+            except Exception as e:
+                print(f"Error updating the audit job heartbeat: {e}")
+            finally:
+                cursor.close()
+                conn.close()
+
+    def _claim(self):
+        """Requeue stale jobs, then claim the oldest queued job and return it, or None if there is none."""
+        claim_token = str(uuid.uuid4())
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "UPDATE AuditJob SET status = 'queued', claimToken = NULL "
+                "WHERE status = 'running' AND updatedAt < NOW() - INTERVAL %s SECOND AND attempts < %s",
+                (self.stale_seconds, self.max_attempts)
+            )
+            cursor.execute(
+                "UPDATE AuditJob SET status = 'failed', error = 'The audit worker stopped', finishedAt = NOW() "
+                "WHERE status = 'running' AND updatedAt < NOW() - INTERVAL %s SECOND",
+                (self.stale_seconds,)
+            )
+            cursor.execute(
+                "UPDATE AuditJob SET status = 'running', claimToken = %s, attempts = attempts + 1, startedAt = NOW(), "
+                "updatedAt = NOW() WHERE status = 'queued' ORDER BY auditJobId LIMIT 1",
+                (claim_token,)
+            )
+            conn.commit()
+            cursor.execute(
+                "SELECT auditJobId, projectId, url, bypassCache, attempts, progress, results FROM AuditJob WHERE claimToken = %s",
+                (claim_token,)
+            )
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+            conn.close()
+
+        if not row:
+            return None
+        return {"jobId": row[0], "projectId": row[1], "url": row[2], "bypassCache": bool(row[3]),
+                "attempts": row[4], "progress": json.loads(row[5]) if row[5] else {},
+                "results": json.loads(row[6]) if row[6] else {}, "claimToken": claim_token}
+
+    def _run(self, job):
+        """Run the audits of a claimed job that have not finished yet, saving the progress and output of each audit as
+        it finishes."""
+        start_time = time.time()
+        # the audits a previous run of the job finished are kept, their rows are already saved
+        progress = {audit_name: job["progress"].get(audit_name, {}) for audit_name in PROJECT_AUDITS}
+        results = job["results"]
+        remaining = tuple(audit_name for audit_name in PROJECT_AUDITS if progress[audit_name].get("status") != "done")
+        for audit_name in remaining:
+            progress[audit_name] = {"status": "running"}
+        print(f"Audit job {job['jobId']} started (attempt {job['attempts']}, running {', '.join(remaining) or 'nothing'}): {job['url']}")
+
+        with self._lock:
+            self._claims.add(job["claimToken"])
+            self.running += 1
+        self._save(job, progress, results)
+
+        def on_audit_done(audit_name, result, error):
+            progress[audit_name] = {
+                "status": "failed" if error else "done",
+                "seconds": round(time.time() - start_time, 2),
+                "error": error,
+            }
+            if not error:
+                results[audit_name] = result
+            if not self._save(job, progress, results):
+                print(f"Audit job {job['jobId']} was claimed by another worker, not saving {audit_name}")
+
+        token = set_llm_cache_bypass(job["bypassCache"])
+        try:
+            if remaining:
+                self.run_audits(job["url"], job["projectId"], on_audit_done, remaining)
+            failed = [audit_name for audit_name in PROJECT_AUDITS if progress[audit_name]["status"] == "failed"]
+            # the job is done when any audit succeeded, the errors of the others are in its progress
+            status = "failed" if len(failed) == len(PROJECT_AUDITS) else "done"
+            error = f"Audits failed: {', '.join(failed)}" if failed else None
+        except Exception as e:
+            print(f"Error running audit job {job['jobId']}: {e}")
+            for audit_name in PROJECT_AUDITS:
+                if progress[audit_name]["status"] == "running":
+                    progress[audit_name] = {"status": "failed", "seconds": round(time.time() - start_time, 2), "error": str(e)}
+            status = "failed"
+            error = str(e)
+        finally:
+            reset_llm_cache_bypass(token)
+            with self._lock:
+                self._claims.discard(job["claimToken"])
+                self.running -= 1
+
+        self._save(job, progress, results, status=status, error=error)
+        with self._lock:
+            if status == "done":
+                self.completed += 1
+            else:
+                self.failed += 1
+        print(f"Audit job {job['jobId']} {status} after {time.time() - start_time:.2f} seconds")
+
+    def _save(self, job, progress, results, status=None, error=None):
+        """Write the progress and results of a job, and its final status, and mark it as alive. Only the worker holding
+        its claim can write.
+        Returns:
+            bool: Whether this worker still holds the claim of the job.
+        """
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            if status is None:
+                cursor.execute(
+                    "UPDATE AuditJob SET progress = %s, results = %s, updatedAt = NOW() WHERE auditJobId = %s AND claimToken = %s",
+                    (json.dumps(progress), json.dumps(results), job["jobId"], job["claimToken"])
+                )
+            else:
+                cursor.execute(
+                    "UPDATE AuditJob SET progress = %s, results = %s, status = %s, error = %s, finishedAt = NOW(), "
+                    "updatedAt = NOW() WHERE auditJobId = %s AND claimToken = %s",
+                    (json.dumps(progress), json.dumps(results), status, error, job["jobId"], job["claimToken"])
+                )
+            conn.commit()
+            # the affected rows are 0 when nothing changed, so the claim is checked separately
+            cursor.execute("SELECT 1 FROM AuditJob WHERE auditJobId = %s AND claimToken = %s", (job["jobId"], job["claimToken"]))
+            return cursor.fetchone() is not None
+        except Exception as e:
+            print(f"Error saving audit job {job['jobId']}: {e}")
+            return True
+        finally:
+            cursor.close()
+            conn.close()
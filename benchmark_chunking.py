@@ -0,0 +1,74 @@
+import argparse
+import time
+
+import utils
+from utils import *
+
+'''
+Microbenchmark of the single-pass HTML chunker (chunk_html_text) against the previous recursive chunker,
+which extracted and tokenized the text of an element again at every level of nesting.
+
+Usage:
+    python benchmark_chunking.py --depth 200 --width 3
+'''
+
+
+def recursive_chunk_html_text(html_source, max_tokens=5000):
+    """The previous chunk_html_text, kept here as the baseline."""
+    soup = BeautifulSoup(html_source, 'html.parser')
+    main = soup.find('main') or soup.body
+
+    chunks = []
+    for elem in main.find_all(['section', 'div', 'article'], recursive=False):
+        text = elem.get_text(separator=' ', strip=True)
+        if not text:
+            continue
+        if num_tokens(text) <= max_tokens:
+            chunks.append(text)
+        else:
+            chunks.extend(chunk_element(elem, max_tokens))
+    return chunks
+
+
+def deep_page(depth, width, paragraph_words=40):
+    """Build a page of `width` sections, each `depth` nested divs deep with a paragraph at every level."""
+    paragraph = "<p>" + " ".join(f"word{i}" for i in range(paragraph_words)) + "</p>"
+    section = "".join(f"<div>{paragraph}" for _ in range(depth)) + "</div>" * depth
+    return "<html><body><main>" + "".join(f"<section>{section}</section>" for _ in range(width)) + "</main></body></html>"
+
+
+def count_tokenized(fn, *args):
+    """Run fn and return its result, the seconds it took and the number of characters it tokenized."""
+    global num_tokens
+    tokenized = [0]
+    original = num_tokens
+
+    def counting_num_tokens(text):
+        tokenized[0] += len(text)
+        return original(text)
+
+    # the chunkers look up num_tokens in the utils module globals and in this module's
+    utils.num_tokens = counting_num_tokens
+    num_tokens = counting_num_tokens
+    try:
+        start_time = time.perf_counter()
+        result = fn(*args)
+        return result, time.perf_counter() - start_time, tokenized[0]
+    finally:
+        utils.num_tokens = original
+        num_tokens = original
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the single-pass and recursive HTML chunkers.")
+    parser.add_argument("--depth", type=int, default=200, help="nesting depth of each section")
+    parser.add_argument("--width", type=int, default=3, help="number of sections")
+    parser.add_argument("--max-tokens", type=int, default=2000)
+    args = parser.parse_args()
+
+    html_source = deep_page(args.depth, args.width)
+    print(f"page: {len(html_source)} bytes, {args.width} sections {args.depth} levels deep")
+
+    for name, chunker in (("recursive", recursive_chunk_html_text), ("single-pass", lambda source, max_tokens: chunk_html_text(None, max_tokens, html_source=source))):
+        chunks, seconds, tokenized = count_tokenized(chunker, html_source, args.max_tokens)
+        print(f"{name:>12}: {seconds:.3f}s, {tokenized} characters tokenized, {len(chunks)} chunks")
@@ -0,0 +1,59 @@
+import argparse
+import time
+
+from utils import *
+from llm_cache import bypass_llm_cache
+from guideline_retrieval import LAYOUT_GUIDELINE_INDEX, detect_layout_features
+from constants import GUIDELINE_TOP_K, GUIDELINE_MAX_TOKENS
+
+'''
+Benchmark of the layout guidelines sent with a web design audit: the whole of contentlayoutguide.txt against the
+sections retrieved for the page (see guideline_retrieval.py).
+
+Without --call only the guideline tokens and the retrieval time are compared. With --call the web design audit is
+run both ways (bypassing the model response cache), so the model latency and the suggestions can be compared too.
+
+Usage:
+    python benchmark_guideline_retrieval.py --url https://www.nj.gov/state/elections/vote.shtml
+    python benchmark_guideline_retrieval.py --url https://www.nj.gov/state/elections/vote.shtml --call
+'''
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full and retrieved layout guidelines.")
+    parser.add_argument("--url", required=True)
+    parser.add_argument("--top-k", type=int, default=GUIDELINE_TOP_K)
+    parser.add_argument("--max-tokens", type=int, default=GUIDELINE_MAX_TOKENS)
+    parser.add_argument("--call", action="store_true", help="also run the web design audit with both guidelines")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    LAYOUT_GUIDELINE_INDEX.build()
+    print(f"index: {len(LAYOUT_GUIDELINE_INDEX.sections)} sections built in {time.perf_counter() - start_time:.2f}s")
+
+    full_guidelines = read_file_text("contentlayoutguide.txt")
+    html_source = get_pure_source(args.url)
+
+    start_time = time.perf_counter()
+    queries = detect_layout_features(html_source)
+    retrieved_guidelines = LAYOUT_GUIDELINE_INDEX.retrieve(queries, args.top_k, args.max_tokens)
+    retrieval_seconds = time.perf_counter() - start_time
+    print(f"queries: {queries}")
+
+    full_tokens = num_tokens(full_guidelines)
+    retrieved_tokens = num_tokens(retrieved_guidelines)
+    print(f"{'full':>10}: {full_tokens} tokens")
+    print(f"{'retrieved':>10}: {retrieved_tokens} tokens ({100 * (full_tokens - retrieved_tokens) / full_tokens:.0f}% fewer), "
+          f"retrieval {retrieval_seconds * 1000:.0f}ms")
+
+    if args.call:
+        from web_design_structured_prompt import analyze_webdesign
+
+        screenshot = capture_screenshot(args.url)
+        for name, guidelines in (("full", full_guidelines), ("retrieved", retrieved_guidelines)):
+            with bypass_llm_cache():
+                start_time = time.perf_counter()
+                suggestions = analyze_webdesign(args.url, guidelines, screenshot=screenshot)
+                seconds = time.perf_counter() - start_time
+            print(f"{name:>10}: audit {seconds:.1f}s, {len(suggestions)} suggestions")
+    print(LLM_GATEWAY.stats())
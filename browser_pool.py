@@ -0,0 +1,177 @@
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from playwright.sync_api import sync_playwright, Error as PlaywrightError
+
+from constants import BROWSER_POOL_SIZE, BROWSER_RECYCLE_PAGES, BROWSER_RECYCLE_SECONDS, BROWSER_JOB_TIMEOUT_SECONDS
+
+'''
+This script keeps a pool of long-lived headless Chromium browsers for taking screenshots.
+
+The Playwright sync API can only be used from the thread that started it, so every browser is owned by
+its own worker thread. Callers submit a job (a function that receives a fresh page) and get a Future back.
+The number of worker threads bounds how many pages are open at once.
+
+Each browser keeps one context that is reused between jobs. A browser that crashes is relaunched and the
+job is retried once, and every browser is recycled after BROWSER_RECYCLE_PAGES pages or
+BROWSER_RECYCLE_SECONDS seconds to keep its memory in check. A browser that can not be launched fails the
+job (it is not counted as a crash), and a worker thread that died is replaced on the next submit.
+`run` waits at most BROWSER_JOB_TIMEOUT_SECONDS for a job.
+'''
+
+CONTEXT_OPTIONS = {
+    "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
+    "viewport": {"width": 1280, "height": 800},
+    "locale": "en-US",
+}
+
+
+class BrowserPool:
+    """A fixed number of worker threads, each running jobs on its own persistent headless browser."""
+
+    def __init__(self, size=BROWSER_POOL_SIZE, recycle_pages=BROWSER_RECYCLE_PAGES, recycle_seconds=BROWSER_RECYCLE_SECONDS):
+        self.size = size
+        self.recycle_pages = recycle_pages
+        self.recycle_seconds = recycle_seconds
+        self._jobs = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self.pages_served = 0
+        self.launches = 0
+        self.launch_failures = 0
+        self.crashes = 0
+        self.restarted_workers = 0
+
+    def submit(self, job):
+        """Queue a job to run on a pooled browser page.
+        Args:
+            job (callable): A function that takes a Playwright page and returns a result.
+        Returns:
+            Future: Resolves to the return value of the job.
+        """
+        self._start()
+        future = Future()
+        self._jobs.put((job, future))
+        return future
+
+    def run(self, job, timeout=BROWSER_JOB_TIMEOUT_SECONDS):
+        """Run a job on a pooled browser page and wait for its result.
+        Raises:
+            concurrent.futures.TimeoutError: If the job did not finish within timeout seconds. A job that is still
+                queued is cancelled.
+        """
+        future = self.submit(job)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def shutdown(self):
+        """Stop the worker threads and close their browsers."""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._jobs.put(None)
+        for worker in workers:
+            worker.join(timeout=30)
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "queued_jobs": self._jobs.qsize(),
+            "pages_served": self.pages_served,
+            "launches": self.launches,
+            "launch_failures": self.launch_failures,
+            "crashes": self.crashes,
+            "restarted_workers": self.restarted_workers,
+        }
+
+    def _start(self):
+        with self._lock:
+            # replace the workers that died, e.g. when Playwright could not start
+            alive = [worker for worker in self._workers if worker.is_alive()]
+            self.restarted_workers += len(self._workers) - len(alive)
+            self._workers = alive
+            while len(self._workers) < self.size:
+                worker = threading.Thread(target=self._worker, name=f"browser-pool-{len(self._workers)}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _launch(self, playwright, browser):
+        if browser is not None:
+            try:
+                browser.close()
+            except PlaywrightError:
+                pass
+        browser = playwright.chromium.launch(headless=True)
+        context = browser.new_context(**CONTEXT_OPTIONS)
+        self.launches += 1
+        return browser, context, time.time(), 0
+
+    def _worker(self):
+        with sync_playwright() as playwright:
+            browser = context = None
+            launched_at = 0
+            browser_pages = 0
+
+            while True:
+                item = self._jobs.get()
+                if item is None:
+                    break
+                job, future = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                # a crashed browser is relaunched and the job is retried once
+                for attempt in range(2):
+                    if (browser is None or not browser.is_connected()
+                            or browser_pages >= self.recycle_pages
+                            or time.time() - launched_at >= self.recycle_seconds):
+                        try:
+                            browser, context, launched_at, browser_pages = self._launch(playwright, browser)
+                        except Exception as e:
+                            # a browser that can not be launched has not crashed, the job fails
+                            self.launch_failures += 1
+                            print(f"Browser launch failed: {e}")
+                            browser = None
+                            future.set_exception(e)
+                            break
+
+                    try:
+                        page = context.new_page()
+                        browser_pages += 1
+                        self.pages_served += 1
+                        try:
+                            result = job(page)
+                        finally:
+                            try:
+                                page.close()
+                            except PlaywrightError:
+                                pass
+
+                        future.set_result(result)
+                        break
+                    except PlaywrightError as e:
+                        if browser is not None and browser.is_connected() or attempt == 1:
+                            future.set_exception(e)
+                            break
+                        self.crashes += 1
+                        print(f"Browser crashed, relaunching: {e}")
+                        browser = None
+                    except Exception as e:
+                        future.set_exception(e)
+                        break
+
+            if browser is not None:
+                try:
+                    browser.close()
+                except PlaywrightError:
+                    pass
+
+
+BROWSER_POOL = BrowserPool()
+atexit.register(BROWSER_POOL.shutdown)
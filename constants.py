@@ -1,4 +1,5 @@
 import boto3
+from botocore.config import Config
 import os
 from openai import OpenAI
 import instructor
@@ -11,7 +12,22 @@ MAX_ISSUES_CODE_ACESSIBILITY = 1
 MAX_TOKENS = 5000
 S3_BUCKET_NAME = "nj-ai-votes-image"
 ANTHROPIC_VERSION = "bedrock-2023-05-31"
-BOTO3_CLIENT = boto3.client("bedrock-runtime", region_name="us-east-1")
+
+# Shared model gateway, see llm_gateway.py
+LLM_GATEWAY_WORKERS = 8  # model calls in flight across all requests
+LLM_EXPECTED_OUTPUT_TOKENS = 1000  # added to the prompt tokens when estimating a call
+# requests and tokens per minute, per provider or per "provider:model_id"
+LLM_RATE_LIMITS = {
+    "bedrock": {"requests_per_minute": 50, "tokens_per_minute": 400000},
+    "openai": {"requests_per_minute": 500, "tokens_per_minute": 800000},
+}
+
+# mark the static guideline prefix of our prompts as cacheable on Bedrock. Off by default: Bedrock only supports
+# prompt caching for some models (e.g. Claude 3.5 Haiku, Claude 3.7 Sonnet), not for the default MODEL_ID below
+BEDROCK_PROMPT_CACHING = False
+
+# one Bedrock client with enough kept-alive connections for every gateway worker
+BOTO3_CLIENT = boto3.client("bedrock-runtime", region_name="us-east-1", config=Config(max_pool_connections=LLM_GATEWAY_WORKERS))
 OPEN_AI_CLIENT = OpenAI(api_key = os.getenv("OPENAI_API_KEY"))
 
 
@@ -28,5 +44,116 @@ else:
     # using OPEN AI 
     print("Using Open AI model..")
     MODEL_ID = "gpt-4.1"
-    INSTRUCTOR_CLIENT = instructor.from_openai(OpenAI(api_key = os.getenv("OPENAI_API_KEY")))
-   
\ No newline at end of file
+    INSTRUCTOR_CLIENT = instructor.from_openai(OPEN_AI_CLIENT)
+   
+# Page snapshot cache
+PAGE_CACHE_TTL_SECONDS = 300
+PAGE_CACHE_MAX_BYTES = 50 * 1024 * 1024
+PAGE_CACHE_LOCK_STRIPES = 64  # concurrent fetches of URLs sharing a stripe wait for each other
+
+# Shared HTTP client used to fetch webpages
+FETCH_CONNECT_TIMEOUT = 5  # seconds
+FETCH_READ_TIMEOUT = 30  # seconds
+FETCH_MAX_BYTES = 10 * 1024 * 1024
+FETCH_POOL_HOSTS = 10  # number of hosts with a kept-alive connection pool
+FETCH_POOL_SIZE = 10  # connections kept alive per host
+
+# Headless browser pool used for screenshots
+BROWSER_POOL_SIZE = 2  # browsers, each renders one page at a time
+BROWSER_RECYCLE_PAGES = 50  # relaunch a browser after this many pages
+BROWSER_RECYCLE_SECONDS = 30 * 60  # or after this many seconds
+BROWSER_JOB_TIMEOUT_SECONDS = 180  # the longest a screenshot waits, in the queue and on its page
+
+# Screenshots are split into tiles for the vision models, see image_preparation.py
+SCREENSHOT_TILE_HEIGHT = 800  # px, the viewport height of the browser pool
+SCREENSHOT_MAX_TILES = 8  # longer pages get taller tiles
+SCREENSHOT_MAX_WIDTH = 1024  # px, tiles are downscaled to fit in SCREENSHOT_MAX_WIDTH x SCREENSHOT_MAX_HEIGHT
+SCREENSHOT_MAX_HEIGHT = 1568  # px, the longest edge Claude uses without downscaling
+SCREENSHOT_FORMAT = "JPEG"  # "JPEG", "WEBP" or "PNG"
+SCREENSHOT_QUALITY = 80
+
+# Web design: a new audit reuses the suggestions of the last audit of the same page when the perceptual hash of the
+# screenshot differs by at most WEB_DESIGN_REUSE_MAX_DISTANCE bits in every band of WEB_DESIGN_HASH_SIZE**2 bits, see image_preparation.py
+WEB_DESIGN_HASH_SIZE = 8
+WEB_DESIGN_REUSE_MAX_DISTANCE = int(os.getenv("WEB_DESIGN_REUSE_MAX_DISTANCE", "4"))  # -1 always analyzes the screenshot
+
+# Web design: only the sections of contentlayoutguide.txt relevant to the page are sent, see guideline_retrieval.py
+GUIDELINE_RETRIEVAL_ENABLED = os.getenv("GUIDELINE_RETRIEVAL_ENABLED", "true").lower() == "true"
+GUIDELINE_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+GUIDELINE_TOP_K = 6  # sections
+GUIDELINE_MAX_TOKENS = 2500  # tokens of retrieved guideline text
+GUIDELINE_BASE_QUERY = "web design layout principles: simplicity, visual hierarchy, usability and accessibility"
+
+# Model response cache
+LLM_CACHE_ENABLED = True
+LLM_CACHE_MEMORY_ENTRIES = 512
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm_cache")
+LLM_CACHE_DISK_MAX_BYTES = 200 * 1024 * 1024
+
+# HTML parsing: "auto" uses lxml when it is installed and html.parser otherwise
+HTML_PARSER = os.getenv("HTML_PARSER", "auto")
+HTML_PARSE_PROFILE = os.getenv("HTML_PARSE_PROFILE", "false").lower() == "true"  # print the time and peak memory of each parse
+
+# HTML compaction before the HTML is sent to the models, see html_compaction.py
+HTML_COMPACTION_RULES = {
+    "remove_tags": ["script", "style", "noscript", "template", "link"],
+    "remove_comments": True,
+    "svg_keep_children": ["title", "desc"],  # SVG children kept, the drawing (paths, shapes) is dropped
+    # attributes relevant to accessibility, all others (style, data-*, on*, tracking) are dropped
+    "keep_attributes": ["alt", "role", "id", "for", "lang", "xml:lang", "dir", "href", "src", "title", "type", "name",
+                        "value", "label", "placeholder", "autocomplete", "required", "disabled", "hidden", "tabindex",
+                        "accesskey", "scope", "headers", "colspan", "rowspan", "summary", "target", "content", "charset",
+                        "http-equiv", "class", "onclick", "onkeydown", "onkeyup", "onkeypress"],
+    "keep_attribute_prefixes": ["aria-"],
+    "max_classes": 2,  # class names kept per element
+    "drop_data_uris": True,  # replace base64 images with "data:<type>,..."
+    "max_attribute_length": 200,  # longer attribute values (e.g. tracking URLs) are truncated
+    "collapse_whitespace": True,  # outside <pre> and <textarea>
+}
+
+# Content clarity: adjacent small sections are packed into one call of up to this many tokens of text
+CONTENT_PACK_MAX_TOKENS = 4000
+
+# Content clarity: only sections that fail these readability thresholds are sent to the model, see readability.py.
+# The grade levels are read from contentclarityguide.txt when it states them ("Aim for grade levels 6-8, but go no higher than grade 12")
+READABILITY_THRESHOLDS = {
+    "target_grade": 8,
+    "max_grade": 12,
+    "max_sentence_length": 20,  # words, "Use simple words and short sentences"
+    "max_passive_ratio": 0.1,  # passive constructions per sentence, "Use active voice"
+    "max_jargon_density": 0.05,  # abbreviations and long technical words per word, "Avoid jargon, internal abbreviations"
+}
+READABILITY_GATE_ENABLED = os.getenv("READABILITY_GATE_ENABLED", "true").lower() == "true"
+
+# Accessibility review: run the local WCAG rules first and only send chunks they can not judge to the model
+ACCESSIBILITY_RULES_ENABLED = os.getenv("ACCESSIBILITY_RULES_ENABLED", "true").lower() == "true"
+
+# Accessibility review mode: "conversation" (four calls per issue) or "structured" (one call for all issues)
+ACCESSIBILITY_REVIEW_MODE = os.getenv("ACCESSIBILITY_REVIEW_MODE", "conversation")
+
+# Persona audits: "combined" (one structured call for the positives and challenges) or "concurrent" (two calls in parallel)
+AUDIENCE_AUDIT_MODE = os.getenv("AUDIENCE_AUDIT_MODE", "combined")
+AUDIENCE_BATCH_MAX_PERSONAS = 10  # personas per /audience-batch request
+AUDIENCE_MAP_REDUCE_THRESHOLD = 30000  # tokens, larger pages are audited in parts and the observations merged (only reached with AUDIENCE_AUDIT_INPUT="html")
+AUDIENCE_CHUNK_MAX_TOKENS = 15000  # tokens per part
+AUDIENCE_CHUNK_MIN_COVERAGE = 0.9  # share of the page tokens the HTML chunks must keep, or the whole source is split by tokens
+AUDIENCE_AUDIT_INPUT = os.getenv("AUDIENCE_AUDIT_INPUT", "digest")  # "digest" (see page_digest.py) or "html" (the compacted HTML)
+
+# Page digests for persona generation and audience audits, see page_digest.py
+PAGE_DIGEST_CACHE_ENTRIES = 256
+PAGE_DIGEST_LIMITS = {
+    "headings": 40,
+    "navigation": 30,  # navigation labels
+    "forms": 10,
+    "fields": 15,  # fields per form
+    "links": 25,  # key links of the main content
+    "summary_words": 80,
+}
+
+# Project audit jobs, see audit_jobs.py. The workers of a web process start with its first request. Set
+# AUDIT_JOB_WORKERS=0 to run the workers in another process with `flask --app flask_backend audit-worker`
+AUDIT_JOB_WORKERS = int(os.getenv("AUDIT_JOB_WORKERS", "2"))  # project audits run at once per process
+AUDIT_JOB_POLL_SECONDS = 5  # how often idle workers check the job table for work queued by other processes
+AUDIT_JOB_HEARTBEAT_SECONDS = 30  # how often the running jobs of a process are marked as alive
+AUDIT_JOB_STALE_SECONDS = 300  # a running job not updated for this long is requeued (its process stopped)
+AUDIT_JOB_MAX_ATTEMPTS = 2
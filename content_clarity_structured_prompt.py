@@ -4,30 +4,38 @@ from pydantic import BaseModel, Field, ValidationError
 from utils import * 
 from typing import List
 from instructor.exceptions import InstructorRetryException
+import concurrent.futures
 
-from constants import MODEL_SELECTION, INSTRUCTOR_CLIENT, MODEL_ID, MAX_TOKENS
+from constants import MODEL_SELECTION, INSTRUCTOR_CLIENT, MODEL_ID, MAX_TOKENS, CONTENT_PACK_MAX_TOKENS
+from llm_cache import guideline_version
+from llm_gateway import LLM_GATEWAY, model_call
 
 """
 This module provides a function to analyze the clarity of website content and suggest improvements.
-It uses the Anthropic Claude model to generate suggestions based on provided content guidelines."""
+It uses the Anthropic Claude model to generate suggestions based on provided content guidelines.
+Responses are served from the model response cache when the same section is analyzed with the same guidelines.
+The guidelines are sent as a static system prompt ahead of the section, so they are served from the provider prompt cache.
+
+Small adjacent sections are packed into one call (see `analyze_content_sections`) and each suggestion is mapped
+back to the section it came from."""
 
 # Define the ContentSuggestion model
 class ContentSuggestion(BaseModel):
     original_content: str = Field(..., description="The original text that does not meet content clarity standards." )
     suggestion: str = Field(..., description="The revised text that meets content clarity standards." )
     area: str = Field(..., description="The a three word summary of the area of the website where the content is located." )
-    
 
-def anaylze_content_clarity(section, content_guidlines):
-    """Analyze a section of text for content clarity and suggest improvements.
-    Args:
-        section (str): The section of text to analyze.
-        content_guidlines (str): The content clarity guidelines to follow.
-    Returns:
-        output (List[ContentSuggestion]): A list of suggestions for improving content clarity."""
-   
-    input_message =  f'''
-        You are a professional content clarity editor. Analyze the following website section:{section}
+
+class PackedContentSuggestion(ContentSuggestion):
+    section: int = Field(..., description="The number of the section the original content is from." )
+
+
+
+def content_clarity_system_prompt(content_guidlines):
+    """Return the static system prompt with the content guidelines, shared by every content clarity call."""
+    # the instructions and guidelines come first and never change, so the providers can cache them as a prefix
+    return f'''
+        You are a professional content clarity editor.
         Your task is to suggest improvements to the **clarity** of the website text according to the 
         following content guidelines:{content_guidlines}
 
@@ -55,91 +63,193 @@ def anaylze_content_clarity(section, content_guidlines):
 
         If there are **no suggestions**, return an **empty list**: [].
         '''
-   
-    
-    if MODEL_SELECTION: 
 
-        try: 
+
+def request_content_suggestions(system_prompt, messages, response_model):
+    """Send a content clarity request with Instructor and return the parsed list of suggestions."""
+    if MODEL_SELECTION: 
         # note that client.chat.completions.create will also work
-            resp = INSTRUCTOR_CLIENT.messages.create(
-                model= MODEL_ID,
-                max_tokens = MAX_TOKENS,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": input_message
-                    }
-                ],
-                response_model = List[ContentSuggestion],
-                
-            )
-            # Check response type
-            if not isinstance(resp, list):
-                    raise TypeError(f"Expected list, got {type(resp)}")
-            
-            #if the response is a list, check each item type for instance of ContentSuggestion
-            else: 
-                output = []
-                for item in resp:
-                    if isinstance(item, ContentSuggestion): 
-                        #if the item is an instance of ContentSuggestion, append it to the output list
-                        output.append({
-                                    "area": item.area,
-                                    "original_content": item.original_content,
-                                    "suggestion": item.suggestion})
-                    else: 
-                        raise TypeError("Invalid item type in response list.")
-                    
-                return output
-    
-        except (ValidationError, InstructorRetryException, TypeError) as e:
-            print(f"Error processing Claude response:{e} ")
-            return []
-        
-    else: 
-        try: 
-            resp = INSTRUCTOR_CLIENT.chat.completions.create(
+        resp, completion = INSTRUCTOR_CLIENT.messages.create_with_completion(
             model= MODEL_ID,
-            messages=[
-                    {
-                        "role": "user",
-                        "content": input_message
-                    }
-                ],
-            response_model = List[ContentSuggestion],
-            ) 
-
-            if not isinstance(resp, list):
-                    raise TypeError(f"Expected list, got {type(resp)}")
+            max_tokens = MAX_TOKENS,
+            system=bedrock_system_prompt(system_prompt),
+            messages=messages,
+            response_model = response_model,
             
-            #if the response is a list, check each item type for instance of ContentSuggestion
-            else: 
-                output = []
-                for item in resp:
-                    if isinstance(item, ContentSuggestion): 
-                        #if the item is an instance of ContentSuggestion, append it to the output list
-                        output.append({
-                                    "area": item.area,
-                                    "original_content": item.original_content,
-                                    "suggestion": item.suggestion})
-                    else: 
-                        raise TypeError("Invalid item type in response list.")
-                    
-                return output
-
-        except (ValidationError, InstructorRetryException, TypeError) as e:
-            print(f"Error processing Claude response:{e} ")
-            return []
-
-
+        )
+        LLM_GATEWAY.record_prompt_usage("bedrock", MODEL_ID, completion.usage)
+    else: 
+        resp, completion = INSTRUCTOR_CLIENT.chat.completions.create_with_completion(
+        model= MODEL_ID,
+        messages=[{"role": "system", "content": system_prompt}] + messages,
+        response_model = response_model,
+        ) 
+        LLM_GATEWAY.record_prompt_usage("openai", MODEL_ID, completion.usage)
 
-        
+    # Check response type
+    if not isinstance(resp, list):
+            raise TypeError(f"Expected list, got {type(resp)}")
+    return resp
 
 
+def anaylze_content_clarity(section, content_guidlines):
+    """Analyze a section of text for content clarity and suggest improvements.
+    Args:
+        section (str): The section of text to analyze.
+        content_guidlines (str): The content clarity guidelines to follow.
+    Returns:
+        output (List[ContentSuggestion]): A list of suggestions for improving content clarity."""
+   
+    # the instructions and guidelines come first and never change, so the providers can cache them as a prefix
+    system_prompt = content_clarity_system_prompt(content_guidlines)
 
+    input_message = f"Analyze the following website section:{section}"
 
+    messages = [
+        {
+            "role": "user",
+            "content": input_message
+        }
+    ]
 
+    def request_suggestions():
+        resp = request_content_suggestions(system_prompt, messages, List[ContentSuggestion])
+        
+        #if the response is a list, check each item type for instance of ContentSuggestion
+        output = []
+        for item in resp:
+            if isinstance(item, ContentSuggestion): 
+                #if the item is an instance of ContentSuggestion, append it to the output list
+                output.append({
+                            "area": item.area,
+                            "original_content": item.original_content,
+                            "suggestion": item.suggestion})
+            else: 
+                raise TypeError("Invalid item type in response list.")
+            
+        return output
 
+    try: 
+        return model_call(
+            "bedrock" if MODEL_SELECTION else "openai",
+            MODEL_ID,
+            {"system": system_prompt, "messages": messages, "max_tokens": MAX_TOKENS, "response_model": "List[ContentSuggestion]"},
+            request_suggestions,
+            guideline_version=guideline_version(content_guidlines),
+        )
 
+    except (ValidationError, InstructorRetryException, TypeError) as e:
+        print(f"Error processing Claude response:{e} ")
+        return []
 
 
+def anaylze_packed_content_clarity(sections, content_guidlines):
+    """Analyze several small sections of text for content clarity in one call.
+    Args:
+        sections (list): The sections of text to analyze, in page order.
+        content_guidlines (str): The content clarity guidelines to follow.
+    Returns:
+        output (list): The suggestions, each with the index in `sections` of the section it applies to."""
+
+    system_prompt = content_clarity_system_prompt(content_guidlines)
+
+    numbered_sections = "\n\n".join(f"Section {number}:\n{section}" for number, section in enumerate(sections, start=1))
+    input_message = f"""Analyze each of the following {len(sections)} website sections separately. \
+        The limit of suggestions applies to each section, and each suggestion must set "section" to the number of the section its original content is from.
+
+        {numbered_sections}"""
+
+    messages = [
+        {
+            "role": "user",
+            "content": input_message
+        }
+    ]
+
+    def section_index(item):
+        # trust the section number the model gave if its original content is in that section, else look for it
+        index = item.section - 1
+        if 0 <= index < len(sections) and item.original_content in sections[index]:
+            return index
+        for index, section in enumerate(sections):
+            if item.original_content and item.original_content in section:
+                return index
+        return item.section - 1 if 0 <= item.section - 1 < len(sections) else 0
+
+    def request_suggestions():
+        resp = request_content_suggestions(system_prompt, messages, List[PackedContentSuggestion])
+
+        output = []
+        for item in resp:
+            if not isinstance(item, PackedContentSuggestion):
+                raise TypeError("Invalid item type in response list.")
+            output.append({
+                        "section": section_index(item),
+                        "area": item.area,
+                        "original_content": item.original_content,
+                        "suggestion": item.suggestion})
+        return output
+
+    try: 
+        return model_call(
+            "bedrock" if MODEL_SELECTION else "openai",
+            MODEL_ID,
+            {"system": system_prompt, "messages": messages, "max_tokens": MAX_TOKENS, "response_model": "List[PackedContentSuggestion]"},
+            request_suggestions,
+            guideline_version=guideline_version(content_guidlines),
+        )
+
+    except (ValidationError, InstructorRetryException, TypeError) as e:
+        print(f"Error processing Claude response:{e} ")
+        return []
+
+
+def iter_content_sections(sections, content_guidlines, max_tokens=CONTENT_PACK_MAX_TOKENS, scores=None):
+    """Analyze the sections of a page for content clarity and yield the suggestions of each call as it completes.
+    Adjacent small sections are packed into shared calls that run in parallel on the shared model gateway.
+    Must not be called from a gateway worker.
+    Args:
+        sections (list): The sections of text to analyze, in page order.
+        content_guidlines (str): The content clarity guidelines to follow.
+        max_tokens (int): The maximum number of tokens of section text in one call.
+        scores (dict): The readability scores of the sections (see readability.score_sections). If given, only the
+            sections that need a review are sent to the model.
+    Yields:
+        list: The suggestions of one call, each with the index in `sections` of the section it applies to.
+    """
+    indices = list(range(len(sections)))
+    if scores is not None:
+        indices = [score["section"] for score in scores["sections"] if score["needs_review"]]
+        print(f"Readability scoring passed {len(sections) - len(indices)} of {len(sections)} content sections")
+
+    # pack the sections to review and map each group back to the indices of its sections on the page
+    groups = [[indices[position] for position in group] for group in pack_chunks([sections[index] for index in indices], max_tokens)]
+    print(f"Packed {len(indices)} content sections into {len(groups)} model calls")
+
+    future_to_group = {}
+    for group in groups:
+        if len(group) == 1:
+            future = LLM_GATEWAY.submit(anaylze_content_clarity, sections[group[0]], content_guidlines)
+        else:
+            future = LLM_GATEWAY.submit(anaylze_packed_content_clarity, [sections[index] for index in group], content_guidlines)
+        future_to_group[future] = group
+
+    for future in concurrent.futures.as_completed(future_to_group):
+        group = future_to_group[future]
+        try:
+            # map the suggestion back to the index of its section on the page (copied, the item may be cached)
+            yield [dict(item, section=group[item.get("section", 0)]) for item in future.result()]
+        except Exception as e:
+            print(f"Error processing a section: {e}")
+
+
+def analyze_content_sections(sections, content_guidlines, max_tokens=CONTENT_PACK_MAX_TOKENS, scores=None):
+    """Analyze the sections of a page for content clarity, packing adjacent small sections into shared calls.
+    The calls run in parallel on the shared model gateway. Must not be called from a gateway worker.
+    Args: see `iter_content_sections`.
+    Returns:
+        list: The suggestions in page order, each with the index in `sections` of the section it applies to.
+    """
+    suggestions = [item for batch in iter_content_sections(sections, content_guidlines, max_tokens, scores) for item in batch]
+    suggestions.sort(key=lambda item: item["section"])
+    return suggestions
@@ -1,16 +1,27 @@
-from flask import Flask, request
+from flask import Flask, request, g, Response, stream_with_context
 from utils import *
 from flask_cors import CORS
 from web_design_structured_prompt import analyze_webdesign
-from content_clarity_structured_prompt import anaylze_content_clarity
-from appending_prompts_code_accessibility import chunk_html_script, threading_code_accessibility
-from format_audience_page import audience_page_postives, audience_page_challenges
+from content_clarity_structured_prompt import analyze_content_sections, iter_content_sections
+from appending_prompts_code_accessibility import chunk_html_script, threading_code_accessibility, iter_code_accessibility, REVIEW_MODES
+from constants import ACCESSIBILITY_REVIEW_MODE, ACCESSIBILITY_RULES_ENABLED, READABILITY_GATE_ENABLED, WEB_DESIGN_REUSE_MAX_DISTANCE, AUDIENCE_BATCH_MAX_PERSONAS, AUDIENCE_AUDIT_INPUT, AUDIT_JOB_WORKERS
+from format_audience_page import audience_page_audit, audience_page_audits
 import json
 from flaskext.mysql import MySQL
 from dotenv import load_dotenv
 import os
 import concurrent.futures
 import time
+from llm_cache import LLM_CACHE, submit_with_context, set_llm_cache_bypass, reset_llm_cache_bypass, llm_cache_bypassed, guideline_version
+from page_snapshot import PAGE_CACHE
+from llm_gateway import LLM_GATEWAY
+from html_compaction import compact_html
+from wcag_rules import check_page
+from readability import score_sections
+from image_preparation import perceptual_hash, hash_distance
+from guideline_retrieval import layout_guidelines_for_page
+from page_digest import PAGE_DIGEST_CACHE, get_page_digest
+from audit_jobs import AuditJobQueue, PROJECT_AUDITS
 
 
 
@@ -25,6 +36,23 @@ app.config['MYSQL_DATABASE_DB'] = os.getenv('MYSQL_DATABASE_DB')
 app.config['MYSQL_DATABASE_HOST'] = os.getenv('MYSQL_DATABASE_HOST')
 mysql.init_app(app)
 
+@app.before_request
+def read_llm_cache_bypass():
+    """Skip the model response cache for this request when `?bypassCache=true` or the `X-Bypass-Cache: true` header is sent."""
+    bypass = request.args.get('bypassCache', request.headers.get('X-Bypass-Cache', 'false'))
+    g.llm_cache_bypass_token = set_llm_cache_bypass(bypass.lower() == 'true')
+
+
+@app.teardown_request
+def clear_llm_cache_bypass(exception=None):
+    token = g.pop('llm_cache_bypass_token', None)
+    if token is not None:
+        try:
+            reset_llm_cache_bypass(token)
+        except ValueError:
+            # the token was created in another context, e.g. by a streamed response
+            pass
+
 
 
 #############################
@@ -48,6 +76,36 @@ def add_proj(userId, url, name):
     return {"project": created_project}, 201
 
 
+def find_reusable_web_design_audit(url, screenshot_hash, layout_version):
+    """Return the ID of the last analyzed web design audit of the same page if its screenshot looks the same, or None.
+    The audit must have used the same layout guidelines and its perceptual hash must be within
+    WEB_DESIGN_REUSE_MAX_DISTANCE bits in every band of the new screenshot's hash. Audits that reused suggestions are
+    skipped, so small changes can not add up over many re-audits.
+    """
+    if WEB_DESIGN_REUSE_MAX_DISTANCE < 0 or llm_cache_bypassed():
+        return None
+
+    conn = mysql.connect()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT w.webDesignAuditId, w.screenshotHash FROM WebDesignAudit w JOIN Project p ON p.projectId = w.projectId "
+        "WHERE p.url = %s AND w.guidelineVersion = %s AND w.screenshotHash IS NOT NULL AND w.reusedAuditId IS NULL "
+        "ORDER BY w.webDesignAuditId DESC LIMIT 1",
+        (url, layout_version)
+    )
+    previous = cursor.fetchone()
+    cursor.close()
+    conn.close()
+
+    if not previous:
+        return None
+    distance = hash_distance(screenshot_hash, previous[1])
+    print(f"Screenshot hash distance to web design audit {previous[0]}: {distance}")
+    if distance is None or distance > WEB_DESIGN_REUSE_MAX_DISTANCE:
+        return None
+    return previous[0]
+
+
 def run_web_design_audit(url, projectId):
 
     if projectId is None:
@@ -56,14 +114,38 @@ def run_web_design_audit(url, projectId):
 
     if url:
         print(f"loading web design for {url}...")
-        layout_guidelines = read_file_text("contentlayoutguide.txt")
-        output = json.dumps(analyze_webdesign(url, layout_guidelines))
-        output = json.loads(output)
+        # the full guide versions the audit, the prompt only gets the sections relevant to the page
+        layout_version = guideline_version(read_file_text("contentlayoutguide.txt"))
+        screenshot = capture_screenshot(url)
+        screenshot_hash = perceptual_hash(screenshot)
+
+        # a page whose layout has not changed keeps the suggestions of its last audit
+        output = []
+        reusedAuditId = find_reusable_web_design_audit(url, screenshot_hash, layout_version)
+        if reusedAuditId is not None:
+            conn = mysql.connect()
+            cursor = conn.cursor()
+            cursor.execute("SELECT area, suggestion, reason FROM WebDesignSuggestion WHERE webDesignAuditId = %s ORDER BY webDesignSuggestionId", (reusedAuditId,))
+            output = [{"key": key, "area": area, "suggestion": suggestion, "reason": reason}
+                      for key, (area, suggestion, reason) in enumerate(cursor.fetchall(), start=1)]
+            cursor.close()
+            conn.close()
+            print(f"Reusing {len(output)} suggestions of web design audit {reusedAuditId} for {url}")
+
+        if not output:
+            # no similar audit, or its suggestions were all deleted
+            reusedAuditId = None
+            layout_guidelines = layout_guidelines_for_page(get_pure_source(url))
+            output = json.dumps(analyze_webdesign(url, layout_guidelines, screenshot=screenshot))
+            output = json.loads(output)
         
 
         conn = mysql.connect()
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO WebDesignAudit (projectId) VALUES (%s)", (projectId,))
+        cursor.execute(
+            "INSERT INTO WebDesignAudit (projectId, screenshotHash, guidelineVersion, reusedAuditId) VALUES (%s, %s, %s, %s)",
+            (projectId, screenshot_hash, layout_version, reusedAuditId)
+        )
         conn.commit()
         cursor.close()
         conn.close()
@@ -97,13 +179,19 @@ def run_web_design_audit(url, projectId):
     else:
         return "No URL provided", 400
     
-def run_accessibility_audit(url, projectId):
+def page_rule_findings(html_script):
+    """Return the findings of the page level WCAG rules (see wcag_rules.check_page), none when ACCESSIBILITY_RULES_ENABLED is off."""
+    return check_page(html_script) if ACCESSIBILITY_RULES_ENABLED else []
+
+
+def run_accessibility_audit(url, projectId, html_script=None):
     if url:
         print(f" loading code accessibility for: {url} ...")
-        html_script = get_pure_source(url)
+        if html_script is None:
+            html_script = get_pure_source(url)
         print(html_script)
         chunked_script = chunk_html_script(html_script)
-        suggestions = threading_code_accessibility(chunked_script)
+        suggestions = page_rule_findings(html_script) + threading_code_accessibility(chunked_script, html_source=html_script)
         output = json.dumps(suggestions)
         output = json.loads(output)
 
@@ -144,34 +232,26 @@ def run_accessibility_audit(url, projectId):
     else: 
         return "No URL provided", 400
     
-def run_content_audit(url, projectId):
+def run_content_audit(url, projectId, html_source=None):
 
     if not url or not projectId:
         return "Missing 'url' or 'projectId'", 400
     
     print(f" loading content for: {url} ...")
 
-    scrapped_data = chunk_html_text(url)
+    scrapped_data = chunk_html_text(url, html_source=html_source)
     content_guidelines = read_file_text("contentclarityguide.txt")
 
-    suggestions = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_section = {
-            executor.submit(anaylze_content_clarity, section, content_guidelines): section
-            for section in scrapped_data
-        }
+    # sections that already meet the readability thresholds are not sent to the model
+    scores = score_sections(scrapped_data, content_guidelines)
 
-        for future in concurrent.futures.as_completed(future_to_section):
-            try:
-                result = future.result()
-                suggestions.extend(result)
-            except Exception as e:
-                print(f"Error processing a section: {e}")
+    # small sections are packed into shared calls that run in parallel on the shared model gateway
+    suggestions = analyze_content_sections(scrapped_data, content_guidelines, scores=scores if READABILITY_GATE_ENABLED else None)
 
-    # Save to database
+    # Save to database, with the readability scores so they can be shown without another audit
     conn = mysql.connect()
     cursor = conn.cursor()
-    cursor.execute("INSERT INTO ContentClarityAudit (projectId) VALUES (%s)", (projectId,))
+    cursor.execute("INSERT INTO ContentClarityAudit (projectId, readabilityScores) VALUES (%s, %s)", (projectId, json.dumps(scores)))
     conn.commit()
 
     cursor.execute(
@@ -197,6 +277,87 @@ def run_content_audit(url, projectId):
     return suggestions
 
 
+def run_project_audits(url, projectId, on_audit_done=None, audits=PROJECT_AUDITS):
+    """Run the web design, accessibility and content audits for a project concurrently.
+
+    The web design audit only needs the URL (it takes its own screenshot) so it starts right away.
+    The page source is fetched once and shared by the accessibility and content audits, which start
+    as soon as the fetch finishes. A failure in one audit does not stop the others.
+
+    Args:
+        url (str): The URL of the webpage to audit.
+        projectId (int): The ID of the project the audits belong to.
+        on_audit_done (callable): Called as on_audit_done(audit_name, result, error) as each audit finishes,
+            with error None if it succeeded.
+        audits (tuple): The names of the audits to run, e.g. the ones a resumed job has not finished yet.
+    Returns:
+        tuple: (results, errors) where results maps each audit name to its output (None if it failed)
+            and errors maps the name of each failed audit to its error message.
+    """
+    results = {}
+    errors = {}
+    start_time = time.time()
+
+    def finish(audit_name, result, error=None):
+        results[audit_name] = result
+        if error is not None:
+            errors[audit_name] = error
+        if on_audit_done is not None:
+            on_audit_done(audit_name, result, error)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        future_to_audit = {}
+        if "web_design_audit" in audits:
+            future_to_audit[submit_with_context(executor, run_web_design_audit, url, projectId)] = "web_design_audit"
+
+        # shared page fetch for the audits that work on the page source
+        source_audits = [audit_name for audit_name in ("accessibility_audit", "content_audit") if audit_name in audits]
+        html_source = get_pure_source(url) if source_audits else None
+        if source_audits and html_source is None:
+            for audit_name in source_audits:
+                finish(audit_name, None, f"Could not fetch the page source for {url}")
+        elif html_source is not None:
+            if "accessibility_audit" in audits:
+                future_to_audit[submit_with_context(executor, run_accessibility_audit, url, projectId, html_source)] = "accessibility_audit"
+            if "content_audit" in audits:
+                future_to_audit[submit_with_context(executor, run_content_audit, url, projectId, html_source)] = "content_audit"
+
+        for future in concurrent.futures.as_completed(future_to_audit):
+            audit_name = future_to_audit[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error running {audit_name}: {e}")
+                finish(audit_name, None, str(e))
+                continue
+            print(f"{audit_name} finished after {time.time() - start_time:.2f} seconds")
+            finish(audit_name, result)
+
+    return results, errors
+
+
+# background workers for the project audits, see audit_jobs.py
+AUDIT_JOBS = AuditJobQueue(mysql.connect, run_project_audits)
+
+
+@app.before_request
+def start_audit_workers():
+    """Start the audit workers with the first request this process serves, so importing the app (the CLI, tooling or
+    the reloader parent) does not claim jobs."""
+    if AUDIT_JOB_WORKERS > 0:
+        AUDIT_JOBS.start()
+
+
+@app.cli.command("audit-worker")
+def audit_worker():
+    """Run project audit jobs in this process, e.g. when the web processes run with AUDIT_JOB_WORKERS=0."""
+    queue = AUDIT_JOBS if AUDIT_JOB_WORKERS > 0 else AuditJobQueue(mysql.connect, run_project_audits, workers=2)
+    queue.start()
+    print(f"Running {queue.workers} audit job workers")
+    while True:
+        time.sleep(60)
+
+
 @app.route('/create-project', methods=['POST', 'OPTIONS'])
 def create_project():
     """
@@ -219,11 +380,13 @@ def create_project():
     - Parses the incoming JSON payload from the request body.
     - Extracts `userId`, `url`, and `name` fields.
     - Inserts the new project record into the Project table.
-    - Returns a success message and HTTP status code 201 on successful insertion.
+    - Queues a job that runs the web design, accessibility and content audits (see `run_project_audits` and audit_jobs.py).
+    - Returns the project and the job ID at once. Poll GET /audit-job for the progress of each audit and
+      GET /audit-job-results for the output of the audits that finished.
 
 
     Returns:
-        Tuple[str, int]: A success message and HTTP 201 status code if insertion is successful.
+        Tuple[dict, int]: The project, `jobId`, the job `status` and HTTP 202 status code.
     Note:
         This function assumes valid input and does not currently handle errors or validation.
     """
@@ -242,14 +405,68 @@ def create_project():
 
     project_id = created_project[0]['project'][0]
 
-    web_design_audit = run_web_design_audit(url, project_id)
-    accessibility_audit = run_accessibility_audit(url, project_id)
-    content_audit = run_content_audit(url, project_id)
+    job_id = AUDIT_JOBS.enqueue(project_id, url, bypass_cache=llm_cache_bypassed())
 
-    return {"project": created_project,
-            "web_design_audit": web_design_audit,
-            "accessibility_audit": accessibility_audit,
-            "content_audit": content_audit}, 201
+    return {"project": created_project, "jobId": job_id, "status": "queued"}, 202
+
+
+@app.route('/audit-job', methods=['GET'])
+def get_audit_job():
+    """
+    GET /audit-job
+    --------------
+    Returns the status of a project audit job and the progress of each of its audits.
+
+    Query Parameters:
+        jobId (int): The ID of the job returned by POST /create-project.
+
+    Returns:
+        - {"jobId", "projectId", "url", "status", "audits", "error", "attempts", "createdAt", "startedAt", "finishedAt"}
+          and HTTP 200. The job status is queued, running, done or failed and `audits` maps each audit to its
+          status (queued, running, done or failed), seconds and error.
+        - 400 Bad Request error if jobId is missing, 404 if there is no such job.
+    """
+    job_id = request.args.get('jobId')
+    if not job_id:
+        return "No jobId provided", 400
+
+    job = AUDIT_JOBS.get(job_id)
+    if job is None:
+        return "No audit job found for the given jobId", 404
+    return job, 200
+
+
+@app.route('/audit-job-results', methods=['GET'])
+def get_audit_job_results():
+    """
+    GET /audit-job-results
+    ----------------------
+    Returns the output of the audits of a project audit job that have finished so far, in the format
+    POST /create-project used to return.
+
+    Query Parameters:
+        jobId (int): The ID of the job returned by POST /create-project.
+
+    Returns:
+        - {"jobId", "projectId", "status", "web_design_audit", "accessibility_audit", "content_audit", "audit_errors"}
+          and HTTP 200, with None for the audits that have not finished or failed.
+        - 400 Bad Request error if jobId is missing, 404 if there is no such job.
+    """
+    job_id = request.args.get('jobId')
+    if not job_id:
+        return "No jobId provided", 400
+
+    job = AUDIT_JOBS.get(job_id, include_results=True)
+    if job is None:
+        return "No audit job found for the given jobId", 404
+
+    output = {"jobId": job["jobId"], "projectId": job["projectId"], "status": job["status"]}
+    for audit_name in job["audits"]:
+        output[audit_name] = job["results"].get(audit_name)
+    output["audit_errors"] = {
+        audit_name: progress["error"] for audit_name, progress in job["audits"].items() if progress.get("error")
+    }
+    return output, 200
 
 ## ROUTE 2 - Fetch all project data for a given userId ##
 
@@ -269,7 +486,7 @@ def fetch_user_projects(user_id):
 def get_content_suggestions_by_project(project_id):
     conn = mysql.connect()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM ContentClarityAudit WHERE projectId = %s", (project_id,))
+    cursor.execute("SELECT * FROM ContentClarityAudit WHERE projectId = %s ORDER BY contentClarityAuditId DESC LIMIT 1", (project_id,))
     content_clarity_audit = cursor.fetchone()
     cursor.close()
     conn.close()
@@ -288,6 +505,19 @@ def get_content_suggestions_by_project(project_id):
 
     return suggestions
 
+def get_content_scores_by_project(project_id):
+    conn = mysql.connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT readabilityScores FROM ContentClarityAudit WHERE projectId = %s ORDER BY contentClarityAuditId DESC LIMIT 1", (project_id,))
+    content_clarity_audit = cursor.fetchone()
+    cursor.close()
+    conn.close()
+
+    if not content_clarity_audit or not content_clarity_audit[0]:
+        return None
+
+    return json.loads(content_clarity_audit[0])
+
 def get_web_design_suggestions_by_project(project_id):
     conn = mysql.connect()
     cursor = conn.cursor()
@@ -350,6 +580,7 @@ def fetch_projects():
 
     projects = fetch_user_projects(user_id)
     content_suggestions = {}
+    content_scores = {}
     web_design_suggestions = {}
     accessibility_suggestions = {}
     personas = {}
@@ -359,6 +590,7 @@ def fetch_projects():
     for project in projects:
         project_id =project[0]
         content_suggestions[project_id] = get_content_suggestions_by_project(project_id)
+        content_scores[project_id] = get_content_scores_by_project(project_id)
         web_design_suggestions[project_id] = get_web_design_suggestions_by_project(project_id)
         accessibility_suggestions[project_id] = get_accessibility_suggestions_by_project(project_id)
         personas[project_id] = get_persona_data(project_id)
@@ -366,6 +598,7 @@ def fetch_projects():
 
     return {"projects": projects,
             "content_suggestions": content_suggestions,
+            "content_scores": content_scores,
             "web_design_suggestions": web_design_suggestions,
             "accessibility_suggestions": accessibility_suggestions,
             "audience_data": personas}, 200
@@ -402,6 +635,9 @@ def delete_all_project_data(projectId):
 
     # Delete PersonaAudit associated with this project
     cursor.execute("DELETE FROM PersonaAudit WHERE projectId = %s", (projectId,))
+
+    # Delete the audit jobs of this project, a running job can no longer save its progress
+    cursor.execute("DELETE FROM AuditJob WHERE projectId = %s", (projectId,))
     
     cursor.execute("DELETE FROM Project WHERE projectId = %s", (projectId,))
     conn.commit()
@@ -465,10 +701,15 @@ def delete():
 ## ROUTE 4 - Audience ##
 
 def generate_user_persona(url):
+    """Generate a user persona for a webpage from its digest, or return None if the page can not be fetched."""
     if url:
+        # the persona is grounded in the digest of the page instead of only its URL
+        page_digest = get_page_digest(url)
+        if page_digest is None:
+            return None
 
-        generate_user_persona = get_pred(url,
-                    f"""Based on the url provided, please create one user persona of someone who would navigate the website. 
+        generate_user_persona = get_pred(page_digest,
+                    f"""Based on the website provided, please create one user persona of someone who would navigate the website. 
                         Include their age, gender, occupation, income level, education level, tech savviness, needs or end goals from the website, 
                         challenges they may have using the website.
                     
@@ -514,6 +755,14 @@ def generate_user_persona(url):
         
         return generate_user_persona
 
+def audience_page_source(url):
+    """Return what the audience audits see of a page: its digest, or its compacted HTML (AUDIENCE_AUDIT_INPUT).
+    Returns None if the page can not be fetched."""
+    if AUDIENCE_AUDIT_INPUT == "html":
+        html_source = get_pure_source(url)
+        return compact_html(html_source, label=url) if html_source is not None else None
+    return get_page_digest(url)
+
 @app.route('/audience-audit', methods=['POST', 'OPTIONS'])
 def audience_audit():
     data = request.get_json()
@@ -532,13 +781,17 @@ def audience_audit():
     cursor.close()
 
     if (usePersonaGenerator):
-        persona = usePersonaGenerator(url)
+        persona = generate_user_persona(url)
+        if url and persona is None:
+            return f"Could not fetch the page {url}", 502
     else:
         persona = data.get('persona')
     
     if url and persona:
-        positives = audience_page_postives(get_pure_source(url), persona)  
-        challenges = audience_page_challenges(get_pure_source(url), persona)
+        source_code = audience_page_source(url)
+        if source_code is None:
+            return f"Could not fetch the page {url}", 502
+        positives, challenges = audience_page_audit(source_code, persona)
 
         conn = mysql.connect()
         cursor = conn.cursor()
@@ -570,7 +823,7 @@ def generate_sample_persona():
 
     Behavior:
     - Retrieves the 'url' query parameter.
-    - Uses a predictive model (`get_pred`) to generate a realistic user persona based on the site's content.
+    - Uses a predictive model (`get_pred`) to generate a realistic user persona based on the digest of the site (see page_digest.py).
     - The persona includes key demographic and behavioral details:
         - Age, gender, occupation, income level, education level
         - Tech savviness
@@ -582,61 +835,19 @@ def generate_sample_persona():
 
     Error:
         - Returns HTTP 400 if no URL is provided.
+        - Returns HTTP 502 if the page can not be fetched.
 
     Notes:
-        - Ensure that the predictive model used in `get_pred` has access to and properly interprets the content at the given URL.
+        - The page digest is cached per URL and rebuilt when the page snapshot changes.
         - Consider sanitizing and validating the URL for robustness.
     """
     url = request.args.get('url')
     # should format 
     if url:
-
-        generate_user_persona = get_pred(url,
-                    f"""Based on the url provided, please create one user persona of someone who would navigate the website. 
-                        Include their age, gender, occupation, income level, education level, tech savviness, needs or end goals from the website, 
-                        challenges they may have using the website.
-                    
-
-                        An example of a user persona and formatting is: 
-
-                        Name: '  '
-                        Age: ' '
-                        Gender: '  '
-                        Occupation:  ''
-                        Income Level:  XX per year
-                        Education Level: '   '
-                        Tech Savviness: Beginner/ Moderate / Intermediate / Advance 
-
-                        Example Goals and Needs: 
-
-                        Goals and Needs: 
-                        1. Register to vote in New Jersey
-                        2. Check voter registration status
-                        3. Find the polling place
-                        4. Understand early voting options
-                        5. Request and submit a mail-in ballot
-
-                        Example Challenges Using the Website:
-
-                        Challenges Using the Website: 
-                        1. Navigating through multiple pages to find specific information
-                        2. Understanding legal or technical terminology related to voting procedures
-                        3. Locating and downloading necessary forms for voter registration or mail-in ballots
-                        4. Identifying the most up-to-date information, especially if there are changes to voting procedures
-                        5. Finding clear instructions on how to complete and submit various forms
-                        6. Accessing mobile-friendly versions of the website while using her smartphone
-
-                        Example Summary: 
-                        X  wants to ensure they are properly registered and informed about the voting process in New Jersey. 
-                        They are civic-minded and wants to participate in elections but may struggle with finding time to thoroughly research voting procedures. 
-                        They would benefit from clear, concise information and easy-to-follow instructions on the website.
-
-                                
-                                 
-                        """ )
-        
-        
-        return generate_user_persona
+        persona = generate_user_persona(url)
+        if persona is None:
+            return f"Could not fetch the page {url}", 502
+        return persona
     
     else: 
         return "No URL provided", 400
@@ -657,8 +868,8 @@ def audience():
 
     Behavior:
     - Extracts the 'url' and 'persona' from the request body.
-    - Retrieves the raw source content of the webpage using `get_pure_source(url)`.
-    - Uses a predictive model (`get_pred`) to generate a user-specific audit based on the provided persona.
+    - Retrieves the digest of the webpage once using `audience_page_source(url)` (served from the page digest cache).
+    - Uses `audience_page_audit` to generate the positives and challenges for the persona in one model round trip.
     - Updates the PersonaAudit table in the database with the new persona and audit output.
     - Returns the generated audit commentary.
 
@@ -682,8 +893,10 @@ def audience():
     personaAuditId = data.get('personaAuditId')
     
     if url and persona:
-        positives = audience_page_postives(get_pure_source(url), persona)  
-        challenges = audience_page_challenges(get_pure_source(url), persona)
+        source_code = audience_page_source(url)
+        if source_code is None:
+            return f"Could not fetch the page {url}", 502
+        positives, challenges = audience_page_audit(source_code, persona)
         #output = get_pred(get_pure_source(url), f"""Based off of the provided URL, please audit the website for the following user persona: {persona}.""")
 
         conn = mysql.connect()
@@ -698,6 +911,78 @@ def audience():
         return "No URL or persona provided", 400
     
 
+@app.route('/audience-batch', methods=['POST', 'OPTIONS'])
+def audience_batch():
+    """
+    POST /audience-batch
+    ----------------
+    Audits a website from the perspective of several user personas at once.
+
+    Expected JSON payload:
+    {
+        "url": str,          # The URL of the website to audit
+        "projectId": int,    # The ID of the project the persona audits belong to
+        "personas": [        # Up to AUDIENCE_BATCH_MAX_PERSONAS personas
+            {"name": str, "persona": str},
+            ...
+        ]
+    }
+
+    Behavior:
+    - Fetches the page once (from the page snapshot cache) and builds its digest (or compacts its HTML) once for all personas.
+    - Runs the persona audits concurrently under the shared model gateway budget, with the page in a cacheable
+      prompt prefix so only the persona text varies between calls (see `audience_page_audits`).
+    - Inserts one PersonaAudit row per persona in a single transaction.
+
+    Returns:
+        dict: {"audits": [{"id", "name", "persona", "positives", "challenges"}, ...]} in the order of the personas.
+
+    Error:
+        - Returns HTTP 400 if the URL, the projectId or the personas are missing, or if there are too many personas.
+    """
+    if request.method == 'OPTIONS':
+        return '', 204  # let preflight pass
+    data = request.get_json()
+    url = data.get('url')
+    projectId = data.get('projectId')
+    personas = [persona if isinstance(persona, dict) else {"persona": persona} for persona in data.get('personas') or []]
+    personas = [persona for persona in personas if persona.get('persona')]
+
+    if not url or not personas:
+        return "No URL or personas provided", 400
+    if not projectId:
+        return "Missing 'projectId'", 400
+    if len(personas) > AUDIENCE_BATCH_MAX_PERSONAS:
+        return f"At most {AUDIENCE_BATCH_MAX_PERSONAS} personas can be audited at once", 400
+
+    print(f" loading audience for {len(personas)} personas: {url} ...")
+    source_code = audience_page_source(url)
+    if source_code is None:
+        return f"Could not fetch the page {url}", 502
+    results = audience_page_audits(source_code, [persona['persona'] for persona in personas])
+
+    audits = []
+    conn = mysql.connect()
+    cursor = conn.cursor()
+    try:
+        for persona, (positives, challenges) in zip(personas, results):
+            cursor.execute(
+                "INSERT INTO PersonaAudit (name, projectId, persona, positives, challenges) VALUES (%s, %s, %s, %s, %s)",
+                (persona.get('name'), projectId, persona['persona'], positives, challenges)
+            )
+            audits.append({"id": cursor.lastrowid, "name": persona.get('name'), "persona": persona['persona'],
+                           "positives": positives, "challenges": challenges})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+    return {"audits": audits}, 200
+
+
 @app.route('/content', methods=['POST', 'OPTIONS'])
 def improveContent():
     """
@@ -741,24 +1026,16 @@ def improveContent():
     scrapped_data = chunk_html_text(url)
     content_guidelines = read_file_text("contentclarityguide.txt")
 
-    suggestions = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_section = {
-            executor.submit(anaylze_content_clarity, section, content_guidelines): section
-            for section in scrapped_data
-        }
+    # sections that already meet the readability thresholds are not sent to the model
+    scores = score_sections(scrapped_data, content_guidelines)
 
-        for future in concurrent.futures.as_completed(future_to_section):
-            try:
-                result = future.result()
-                suggestions.extend(result)
-            except Exception as e:
-                print(f"Error processing a section: {e}")
+    # small sections are packed into shared calls that run in parallel on the shared model gateway
+    suggestions = analyze_content_sections(scrapped_data, content_guidelines, scores=scores if READABILITY_GATE_ENABLED else None)
 
-    # Save to database
+    # Save to database, with the readability scores so they can be shown without another audit
     conn = mysql.connect()
     cursor = conn.cursor()
-    cursor.execute("INSERT INTO ContentClarityAudit (projectId) VALUES (%s)", (projectId,))
+    cursor.execute("INSERT INTO ContentClarityAudit (projectId, readabilityScores) VALUES (%s, %s)", (projectId, json.dumps(scores)))
     conn.commit()
 
     cursor.execute(
@@ -783,6 +1060,98 @@ def improveContent():
 
     return suggestions
 
+def sse_event(event, data):
+    """Format a Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_response(events):
+    """Stream Server-Sent Events, keeping the request context (e.g. the cache bypass) until the stream ends."""
+    return Response(stream_with_context(events), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route('/content-stream', methods=['POST', 'OPTIONS'])
+def improveContentStream():
+    """
+    POST /content-stream
+    ----------------
+    Like POST /content, but streams the clarity suggestions as Server-Sent Events as each model call completes.
+
+    Expected JSON payload:
+    {
+        "url": str,        # The URL of the webpage whose content should be analyzed
+        "projectId": int   # The ID of the project associated with the audit
+    }
+
+    Events:
+    - audit: {"contentClarityAuditId", "readabilityScores"} once the ContentClarityAudit row is created.
+    - suggestion: one clarity suggestion with its "contentClaritySuggestionId", after its row is saved.
+    - summary: {"contentClarityAuditId", "suggestions", "calls", "firstSuggestionSeconds", "seconds"} closes the stream.
+
+    Returns:
+        - A text/event-stream response.
+        - 400 Bad Request error if the URL or projectId is missing.
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    data = request.get_json()
+    url = data.get('url')
+    projectId = data.get('projectId')
+
+    if not url or not projectId:
+        return "Missing 'url' or 'projectId'", 400
+
+    print(f" streaming content for: {url} ...")
+
+    def events():
+        start_time = time.time()
+        scrapped_data = chunk_html_text(url)
+        content_guidelines = read_file_text("contentclarityguide.txt")
+        scores = score_sections(scrapped_data, content_guidelines)
+
+        conn = mysql.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("INSERT INTO ContentClarityAudit (projectId, readabilityScores) VALUES (%s, %s)", (projectId, json.dumps(scores)))
+            conn.commit()
+            contentClarityAuditId = cursor.lastrowid
+            yield sse_event("audit", {"contentClarityAuditId": contentClarityAuditId, "readabilityScores": scores})
+
+            count = 0
+            calls = 0
+            first_suggestion_seconds = None
+            for batch in iter_content_sections(scrapped_data, content_guidelines, scores=scores if READABILITY_GATE_ENABLED else None):
+                calls += 1
+                saved = []
+                for item in batch:
+                    cursor.execute(
+                        "INSERT INTO ContentClaritySuggestion (contentClarityAuditId, original, suggestion, area) VALUES (%s, %s, %s, %s)",
+                        (contentClarityAuditId, item.get("original_content", ""), item.get("suggestion", ""), item.get("area", ""))
+                    )
+                    saved.append(dict(item, contentClaritySuggestionId=cursor.lastrowid))
+                # the rows are saved before the client sees them
+                conn.commit()
+                for item in saved:
+                    if first_suggestion_seconds is None:
+                        first_suggestion_seconds = round(time.time() - start_time, 2)
+                    count += 1
+                    yield sse_event("suggestion", item)
+
+            yield sse_event("summary", {
+                "contentClarityAuditId": contentClarityAuditId,
+                "suggestions": count,
+                "calls": calls,
+                "firstSuggestionSeconds": first_suggestion_seconds,
+                "seconds": round(time.time() - start_time, 2),
+            })
+        finally:
+            cursor.close()
+            conn.close()
+
+    return sse_response(events())
+
 @app.route('/webdesign', methods=['POST', 'OPTIONS'])
 def webDesign():
     """
@@ -828,6 +1197,7 @@ def codeAccessibility():
     {
         "url": str  # The URL of the webpage to be analyzed,
         "projectId": int # The ID of the project associated with the audit
+        "reviewMode": str # Optional, "conversation" (four calls per issue) or "structured" (one call per chunk)
     }
 
     Behavior:
@@ -848,12 +1218,15 @@ def codeAccessibility():
     data = request.get_json()
     url = data.get('url')
     projectId = data.get('projectId')
+    reviewMode = data.get('reviewMode', ACCESSIBILITY_REVIEW_MODE)
+    if reviewMode not in REVIEW_MODES:
+        return f"Unknown reviewMode, expected one of {REVIEW_MODES}", 400
     if url:
         print(f" loading code accessibility for: {url} ...")
         html_script = get_pure_source(url)
         #print(html_script)
         chunked_script = chunk_html_script(html_script)
-        suggestions = threading_code_accessibility(chunked_script)
+        suggestions = page_rule_findings(html_script) + threading_code_accessibility(chunked_script, mode=reviewMode, html_source=html_script)
         output = json.dumps(suggestions)
         output = json.loads(output)
 
@@ -896,6 +1269,123 @@ def codeAccessibility():
 
 
 
+@app.route('/accessibility-stream', methods=['POST', 'OPTIONS'])
+def codeAccessibilityStream():
+    """
+    POST /accessibility-stream
+    --------------------
+    Like POST /accessibility, but streams the accessibility suggestions as Server-Sent Events: the page and rule
+    findings first, then the model review of each chunk as it completes.
+
+    Expected JSON payload:
+    {
+        "url": str,          # The URL of the webpage to analyze
+        "projectId": int,    # The ID of the project associated with the audit
+        "reviewMode": str    # Optional, "conversation" or "structured"
+    }
+
+    Events:
+    - audit: {"accessibilityAuditId", "chunks"} once the AccessibilityAudit row is created.
+    - suggestion: one accessibility suggestion with its "accessibilitySuggestionId", after its row is saved.
+    - summary: {"accessibilityAuditId", "suggestions", "firstSuggestionSeconds", "seconds"} closes the stream.
+
+    Returns:
+        - A text/event-stream response.
+        - 400 Bad Request error if the URL is missing or the reviewMode is unknown.
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    data = request.get_json()
+    url = data.get('url')
+    projectId = data.get('projectId')
+    reviewMode = data.get('reviewMode', ACCESSIBILITY_REVIEW_MODE)
+    if reviewMode not in REVIEW_MODES:
+        return f"Unknown reviewMode, expected one of {REVIEW_MODES}", 400
+    if not url:
+        return "No URL provided", 400
+
+    print(f" streaming code accessibility for: {url} ...")
+
+    def events():
+        start_time = time.time()
+        html_script = get_pure_source(url)
+        chunked_script = chunk_html_script(html_script)
+
+        conn = mysql.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("INSERT INTO AccessibilityAudit (projectId) VALUES (%s)", (projectId,))
+            conn.commit()
+            accessibilityAuditId = cursor.lastrowid
+            yield sse_event("audit", {"accessibilityAuditId": accessibilityAuditId, "chunks": len(chunked_script)})
+
+            count = 0
+            first_suggestion_seconds = None
+
+            def batches():
+                yield page_rule_findings(html_script)
+                yield from iter_code_accessibility(chunked_script, mode=reviewMode, html_source=html_script)
+
+            for batch in batches():
+                saved = []
+                for suggestion in batch:
+                    cursor.execute(
+                        "INSERT INTO AccessibilitySuggestion (accessibilityAuditId, label, original, revised, explanation) VALUES (%s, %s, %s, %s, %s)",
+                        (accessibilityAuditId, suggestion["label"], suggestion["original_content"], suggestion["revised_content"], suggestion["explanation"])
+                    )
+                    saved.append(dict(suggestion, accessibilitySuggestionId=cursor.lastrowid))
+                # the rows are saved before the client sees them
+                conn.commit()
+                for suggestion in saved:
+                    if first_suggestion_seconds is None:
+                        first_suggestion_seconds = round(time.time() - start_time, 2)
+                    count += 1
+                    yield sse_event("suggestion", suggestion)
+
+            yield sse_event("summary", {
+                "accessibilityAuditId": accessibilityAuditId,
+                "suggestions": count,
+                "firstSuggestionSeconds": first_suggestion_seconds,
+                "seconds": round(time.time() - start_time, 2),
+            })
+        finally:
+            cursor.close()
+            conn.close()
+
+    return sse_response(events())
+
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """
+    GET /cache-stats
+    ----------------
+    Returns the hit and miss counters of the model response cache, the page snapshot cache and the page digest cache.
+
+    Returns:
+        Tuple[dict, int]: The cache statistics and HTTP 200 status code.
+    """
+    return {"llm_cache": LLM_CACHE.stats(), "page_cache": PAGE_CACHE.stats(), "page_digest_cache": PAGE_DIGEST_CACHE.stats()}, 200
+
+
+@app.route('/gateway-stats', methods=['GET'])
+def gateway_stats():
+    """
+    GET /gateway-stats
+    ------------------
+    Returns the queue depth, queue wait times and the rate limit budgets of the shared model gateway, and the
+    counters of the project audit workers.
+
+    Returns:
+        Tuple[dict, int]: The gateway statistics and HTTP 200 status code.
+    """
+    stats = LLM_GATEWAY.stats()
+    stats["audit_jobs"] = AUDIT_JOBS.stats()
+    return stats, 200
+
+
+
 ########################
 
 ## Database Endpoints ##
@@ -1582,6 +2072,9 @@ def delete_project():
 
     # Delete PersonaAudit associated with this project
     cursor.execute("DELETE FROM PersonaAudit WHERE projectId = %s", (projectId,))
+
+    # Delete the audit jobs of this project, a running job can no longer save its progress
+    cursor.execute("DELETE FROM AuditJob WHERE projectId = %s", (projectId,))
     
     cursor.execute("DELETE FROM Project WHERE projectId = %s", (projectId,))
     conn.commit()
@@ -1,12 +1,27 @@
+import concurrent.futures
 import boto3
+from pydantic import BaseModel, Field, ValidationError
+from instructor.exceptions import InstructorRetryException
+from typing import List
 from utils import * 
 
-from constants import MODEL_SELECTION, ANTHROPIC_VERSION, MAX_TOKENS, BOTO3_CLIENT, OPEN_AI_CLIENT, MODEL_ID
+from constants import (MODEL_SELECTION, ANTHROPIC_VERSION, MAX_TOKENS, BOTO3_CLIENT, OPEN_AI_CLIENT, MODEL_ID, INSTRUCTOR_CLIENT, AUDIENCE_AUDIT_MODE,
+                       AUDIENCE_MAP_REDUCE_THRESHOLD, AUDIENCE_CHUNK_MAX_TOKENS, AUDIENCE_CHUNK_MIN_COVERAGE,
+                       BEDROCK_PROMPT_CACHING)
+from appending_prompts_code_accessibility import chunk_html_script
 
 '''
 This script uses the Bedrock API to analyze a webpage's source code and provide feedback on the positives and challenges of user interaction with the website.
+
+`audience_page_audit` returns both from one fetched source: with one structured call that returns the two lists
+("combined"), or with the positives and challenges calls running at the same time ("concurrent").
+Either way a persona audit takes one model round trip.
+
+Pages larger than AUDIENCE_MAP_REDUCE_THRESHOLD tokens are audited with map-reduce: the page is chunked, the
+observations of each part are collected concurrently and one final call merges them into the positives and challenges.
+The size is checked on the input the audit sends, so this only happens with AUDIENCE_AUDIT_INPUT="html": a page
+digest (the default) is a few hundred tokens and always fits in one call.
 '''
-client  = boto3.client("bedrock-runtime", region_name="us-east-1")
 model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
 
 
@@ -34,9 +49,9 @@ def audience_page_postives(source_code, persona):
     postives_prompt = f"""
 
                     You are an expert accessibility and usability reviewer. 
-                    Analyze the following website source code and evaluate it from the perspective of the given user persona.
+                    Analyze the following website (its source code or a digest of its structure and content) and evaluate it from the perspective of the given user persona.
 
-                    - **HTML Source Code**: {source_code}
+                    - **Website**: {source_code}
                     - **User Persona**: {persona}
 
                     Your task is to identify specific **usability or accessibility postives ** this user may like when interacting with the website, based on their age, tech-savviness, goals, and potential limitations.
@@ -68,14 +83,8 @@ def audience_page_postives(source_code, persona):
 
                     }
 
-        resp_postives = BOTO3_CLIENT.invoke_model(
-            modelId= MODEL_ID,
-            body=json.dumps(body),
-            contentType="application/json"
-        )
-
-        response_body = json.loads(resp_postives["body"].read())
-        positives = response_body["content"][0]["text"]
+        # Send the request to the model and read the response
+        positives = invoke_bedrock_text(body)
 
         return positives
     else: 
@@ -90,16 +99,8 @@ def audience_page_postives(source_code, persona):
             }
         
     
-        resp = OPEN_AI_CLIENT.chat.completions.create(
-            model=MODEL_ID,
-            messages= body["messages"],
-            max_tokens= body["max_tokens"],
-            temperature= body["temperature"],
-        ) 
-    
-
-        # Read the response
-        positives = resp.choices[0].message.content 
+        # Send the request to the model and read the response
+        positives = invoke_openai_text(body)
         return positives 
 
 """
@@ -125,9 +126,9 @@ def audience_page_challenges(source_code, persona):
     challenges_prompt = f"""
 
                         You are an expert accessibility and usability reviewer. 
-                        Analyze the following website source code and evaluate it from the perspective of the given user persona.
+                        Analyze the following website (its source code or a digest of its structure and content) and evaluate it from the perspective of the given user persona.
 
-                        - **HTML Source Code**: {source_code}
+                        - **Website**: {source_code}
                         - **User Persona**: {persona}
 
                         Your task is to identify specific **usability or accessibility challenges** this user may face when interacting with the website, based on their age, tech-savviness, goals, and potential limitations.
@@ -161,14 +162,8 @@ def audience_page_challenges(source_code, persona):
 
                     }
 
-        resp_challenges = BOTO3_CLIENT.invoke_model(
-            modelId= MODEL_ID,
-            body=json.dumps(body),
-            contentType="application/json"
-        ) 
-
-        response_body = json.loads(resp_challenges["body"].read())
-        challenges = response_body["content"][0]["text"]
+        # Send the request to the model and read the response
+        challenges = invoke_bedrock_text(body)
 
         return challenges
     else: 
@@ -183,16 +178,8 @@ def audience_page_challenges(source_code, persona):
             }
         
     
-        resp = OPEN_AI_CLIENT.chat.completions.create(
-            model=MODEL_ID,
-            messages= body["messages"],
-            max_tokens= body["max_tokens"],
-            temperature= body["temperature"],
-        ) 
-    
-
-        # Read the response
-        challenges = resp.choices[0].message.content 
+        # Send the request to the model and read the response
+        challenges = invoke_openai_text(body)
         return challenges 
         
 
@@ -205,6 +192,232 @@ def audience_page_challenges(source_code, persona):
     return challenges_list
 """
 
+class PersonaPageAudit(BaseModel):
+    positives: List[str] = Field(..., description="3-5 usability or accessibility positives this user may like, one insight per item.")
+    challenges: List[str] = Field(..., description="3-5 usability or accessibility challenges this user may face, one insight per item.")
+
+
+class PersonaChunkObservations(BaseModel):
+    positives: List[str] = Field(..., description="Up to 5 usability or accessibility positives this user may like in this part of the page.")
+    challenges: List[str] = Field(..., description="Up to 5 usability or accessibility challenges this user may face in this part of the page.")
+
+
+PERSONA_INSIGHT_RULES = """
+                    Each positive and challenge should:
+                    - Reflect the user’s specific needs or difficulties
+                    - Be actionable, specific to the user persona, and concise but detailed enough to provide actionable insights
+                    - Only include the insight itself, without any additional text, bullet points or numbers
+                    - limit the positives and the challenges to 3-5 insights each
+
+                    An example of positives is:
+                    Clear navigation menu with simple, descriptive labels for different sections
+                    Prominent search bar to quickly find specific information
+
+                    An example of challenges is:
+                    Complex navigation structure may overwhelm a first-time voter
+                    Lack of clear, prominent call-to-action for mail-in voting process
+                """
+
+
+def request_persona_audit(system_prompt, messages, response_model):
+    """Send a persona audit request with Instructor, through the response cache and the gateway.
+    Returns:
+        dict: {"positives": [...], "challenges": [...]}
+    """
+    def request_audit():
+        if MODEL_SELECTION: 
+            #using claude model 
+            resp, completion = INSTRUCTOR_CLIENT.messages.create_with_completion(
+                model= MODEL_ID,
+                max_tokens= MAX_TOKENS,
+                system=bedrock_system_prompt(system_prompt),
+                messages=messages,
+                response_model = response_model,
+            )
+            LLM_GATEWAY.record_prompt_usage("bedrock", MODEL_ID, completion.usage)
+        else: 
+            #using open ai model
+            resp, completion = INSTRUCTOR_CLIENT.chat.completions.create_with_completion(
+                model= MODEL_ID,
+                messages=[{"role": "system", "content": system_prompt}] + messages,
+                response_model = response_model,
+                temperature=0,
+            )
+            LLM_GATEWAY.record_prompt_usage("openai", MODEL_ID, completion.usage)
+
+        return {"positives": [positive.strip() for positive in resp.positives if positive.strip()],
+                "challenges": [challenge.strip() for challenge in resp.challenges if challenge.strip()]}
+
+    return model_call(
+        "bedrock" if MODEL_SELECTION else "openai",
+        MODEL_ID,
+        {"system": system_prompt, "messages": messages, "max_tokens": MAX_TOKENS, "response_model": response_model.__name__},
+        request_audit,
+    )
+
+
+def needs_map_reduce(source_code):
+    """Whether a page is too large for one persona audit call (AUDIENCE_MAP_REDUCE_THRESHOLD tokens).
+    A page digest (AUDIENCE_AUDIT_INPUT="digest", the default) never is, only the compacted HTML can be."""
+    return bool(source_code) and num_tokens(source_code) > AUDIENCE_MAP_REDUCE_THRESHOLD
+
+
+def audience_page_audit(source_code, persona, mode=AUDIENCE_AUDIT_MODE):
+    """Provide feedback on the positives and challenges of User interaction with the website in one model round trip.
+    Pages larger than AUDIENCE_MAP_REDUCE_THRESHOLD tokens are audited in parts (see `audience_page_map_reduce`).
+    Must not be called from a gateway worker.
+    Args:
+        source_code (str): The source code of the webpage to analyze.
+        persona (str): The persona to guide the analysis.
+        mode (str): "combined" for one structured call, "concurrent" for the positives and challenges calls in parallel.
+    Returns:
+        tuple: (positives, challenges), each a string with one insight per line.
+    """
+    if needs_map_reduce(source_code):
+        return audience_page_map_reduce(source_code, [persona])[0]
+
+    if mode == "concurrent":
+        positives = LLM_GATEWAY.submit(audience_page_postives, source_code, persona)
+        challenges = LLM_GATEWAY.submit(audience_page_challenges, source_code, persona)
+        return positives.result(), challenges.result()
+
+    return audience_page_combined(source_code, persona)
+
+
+def audience_page_combined(source_code, persona):
+    """The positives and challenges of a persona in one structured model call. Does not submit other gateway work,
+    so it can run on a gateway worker.
+    Args:
+        source_code (str): The source code of the webpage to analyze.
+        persona (str): The persona to guide the analysis.
+    Returns:
+        tuple: (positives, challenges), each a string with one insight per line.
+    """
+    # the page comes first and is the same for every persona, so the providers can cache it as a prefix
+    system_prompt = f"""
+                    You are an expert accessibility and usability reviewer. 
+                    Analyze the following website (its source code or a digest of its structure and content) and evaluate it from the perspective of the user persona you are given.
+
+                    - **Website**: {source_code}
+
+                    Identify the specific **usability or accessibility positives** this user may like and the **challenges** this user may face
+                    when interacting with the website, based on their age, tech-savviness, goals, and potential limitations.
+                    {PERSONA_INSIGHT_RULES}"""
+    messages = [{"role": "user", "content": f"**User Persona**: {persona}"}]
+
+    try: 
+        output = request_persona_audit(system_prompt, messages, PersonaPageAudit)
+    except (ValidationError, InstructorRetryException) as e:
+        print(f"Error processing persona audit response: {e}")
+        return "", ""
+
+    return "\n".join(output["positives"]), "\n".join(output["challenges"])
+
+
+def observe_page_part(part, index, count, persona):
+    """Map step: the positives and challenges a persona may find in one part of a large page."""
+    # the part comes first and is the same for every persona, so the providers can cache it as a prefix
+    system_prompt = f"""
+                    You are an expert accessibility and usability reviewer. 
+                    The following is part {index + 1} of {count} of the source code of a website that is too large to review at once.
+                    Evaluate this part from the perspective of the user persona you are given.
+
+                    - **Website part**: {part}
+
+                    List the specific **usability or accessibility positives** this user may like and the **challenges** this user may face
+                    in this part of the website, based on their age, tech-savviness, goals, and potential limitations.
+                    Only include what this part of the page shows. Return empty lists if there is nothing relevant to the user.
+                """
+    messages = [{"role": "user", "content": f"**User Persona**: {persona}"}]
+    try: 
+        return request_persona_audit(system_prompt, messages, PersonaChunkObservations)
+    except (ValidationError, InstructorRetryException) as e:
+        print(f"Error processing persona audit response for part {index + 1}: {e}")
+        return {"positives": [], "challenges": []}
+
+
+def merge_page_observations(observations, persona):
+    """Reduce step: merge the observations of the parts of a page into 3-5 positives and challenges."""
+    positives = "\n".join(positive for observation in observations for positive in observation["positives"])
+    challenges = "\n".join(challenge for observation in observations for challenge in observation["challenges"])
+    system_prompt = f"""
+                    You are an expert accessibility and usability reviewer. 
+                    A large website was reviewed in parts from the perspective of the user persona you are given.
+                    Merge the observations of all parts into the most important **usability or accessibility positives** this user
+                    may like and **challenges** this user may face on the whole website. Combine observations that say the same thing.
+                    {PERSONA_INSIGHT_RULES}"""
+    messages = [{"role": "user", "content": f"**User Persona**: {persona}\n\n**Positives of the parts**:\n{positives}\n\n**Challenges of the parts**:\n{challenges}"}]
+    try: 
+        output = request_persona_audit(system_prompt, messages, PersonaPageAudit)
+    except (ValidationError, InstructorRetryException) as e:
+        print(f"Error processing persona audit response: {e}")
+        return "", ""
+    return "\n".join(output["positives"]), "\n".join(output["challenges"])
+
+
+def audience_page_map_reduce(source_code, personas):
+    """Audit a page that is too large for one call: the page is chunked, the observations of each part are collected
+    concurrently for every persona and a final call per persona merges them. Must not be called from a gateway worker.
+    Args:
+        source_code (str): The source code of the webpage to analyze.
+        personas (list): The personas to guide the analysis.
+    Returns:
+        list: The (positives, challenges) of each persona, in the order of the personas.
+    """
+    source_tokens = num_tokens(source_code)
+    chunks = chunk_html_script(source_code, AUDIENCE_CHUNK_MAX_TOKENS, compact=False) if "<" in source_code else []
+    # the HTML chunker only keeps div, section, article and li elements, text outside of them (e.g. in <main>, <nav>
+    # or a <p> directly in <body>) would not be audited, so the whole source is split instead when it misses too much
+    coverage = sum(num_tokens(chunk) for chunk in chunks) / max(source_tokens, 1)
+    if coverage < AUDIENCE_CHUNK_MIN_COVERAGE:
+        if chunks:
+            print(f"HTML chunks cover {coverage:.0%} of the page, splitting the whole source instead")
+        chunks = force_split_text(source_code, AUDIENCE_CHUNK_MAX_TOKENS)
+    # the chunkers split down to small elements, adjacent ones share a part
+    parts = ["\n".join(chunks[index] for index in group) for group in pack_chunks(chunks, AUDIENCE_CHUNK_MAX_TOKENS)]
+    print(f"Auditing a page of {source_tokens} tokens in {len(parts)} parts for {len(personas)} personas")
+
+    observation_futures = [
+        [LLM_GATEWAY.submit(observe_page_part, part, index, len(parts), persona) for index, part in enumerate(parts)]
+        for persona in personas
+    ]
+    merge_futures = [
+        LLM_GATEWAY.submit(merge_page_observations, [future.result() for future in futures], persona)
+        for futures, persona in zip(observation_futures, personas)
+    ]
+    return [future.result() for future in merge_futures]
+
+
+def audience_page_audits(source_code, personas, mode=AUDIENCE_AUDIT_MODE):
+    """Audit one page for several personas, running the audits concurrently on the shared model gateway.
+    Must not be called from a gateway worker.
+    Args:
+        source_code (str): The source code of the webpage to analyze, fetched once for all personas.
+        personas (list): The personas to guide the analysis.
+        mode (str): See `audience_page_audit`.
+    Returns:
+        list: The (positives, challenges) of each persona, in the order of the personas.
+    """
+    if not personas:
+        return []
+
+    if needs_map_reduce(source_code):
+        return audience_page_map_reduce(source_code, personas)
+
+    if mode == "concurrent":
+        futures = [(LLM_GATEWAY.submit(audience_page_postives, source_code, persona),
+                    LLM_GATEWAY.submit(audience_page_challenges, source_code, persona)) for persona in personas]
+        return [(positives.result(), challenges.result()) for positives, challenges in futures]
+
+    futures = [LLM_GATEWAY.submit(audience_page_combined, source_code, personas[0])]
+    if MODEL_SELECTION and BEDROCK_PROMPT_CACHING and len(personas) > 1:
+        # on Bedrock the first call writes the page prefix to the prompt cache, so the other personas read it instead
+        # of each paying for the cache write. OpenAI has no cache to warm, there all the calls start at once
+        concurrent.futures.wait(futures)
+    futures += [LLM_GATEWAY.submit(audience_page_combined, source_code, persona) for persona in personas[1:]]
+    return [future.result() for future in futures]
+
+
 # url1 = "https://www.nj.gov/state/elections/vote.shtml"
 # source_code = get_pure_source(url1)
 
@@ -0,0 +1,167 @@
+import re
+import threading
+import time
+
+import numpy as np
+
+from utils import parse_html, num_tokens, read_file_text
+from constants import (GUIDELINE_RETRIEVAL_ENABLED, GUIDELINE_EMBEDDING_MODEL, GUIDELINE_TOP_K, GUIDELINE_MAX_TOKENS,
+                       GUIDELINE_BASE_QUERY)
+
+'''
+This script retrieves the sections of the layout guidelines (contentlayoutguide.txt, about 7,000 tokens) that are
+relevant to a page, so the web design prompt does not have to include the whole guide.
+
+The guide is split into sections at its headings and each section is embedded once with sentence-transformers into
+a faiss inner product index. For a page, its layout features (navigation, sidebar, forms, media, tables, ...) are
+detected from the HTML and each feature is a query. A section scores its best similarity to any query, and the top
+GUIDELINE_TOP_K sections that fit in GUIDELINE_MAX_TOKENS are returned in the order of the guide.
+
+The index is built on the first retrieval, so importing this module does not load the embedding model. If the
+model can not be loaded, the whole guide is used.
+'''
+
+# image captions and pull quotes in the guide, e.g. "Visual Hierarchy – Image by Benjamin Oberemok"
+CAPTION = re.compile(r"\s[–-]\s.*(Image by|Google|Toptal|Ramotion)|^(.+)\2$|^'")
+
+# (CSS selector, query) pairs: when the selector matches the page, the query is used to retrieve guideline sections
+LAYOUT_FEATURES = [
+    ("nav, [role=navigation]", "navigation menu and navigability"),
+    ("header, [role=banner]", "header and top of the page"),
+    ("footer, [role=contentinfo]", "footer links and information"),
+    ("aside, [role=complementary], [class*=sidebar]", "sidebar and two-column layout"),
+    ("form, input, select, textarea", "forms, tappable areas and calls to action"),
+    ("input[type=search], [role=search]", "search functionality"),
+    ("video, iframe, [class*=hero], [class*=banner]", "featured image or video hero area"),
+    ("table", "content-heavy pages and informational hierarchy"),
+    ("[class*=card], [class*=grid], [class*=tile]", "card or block layout and grids"),
+    ("meta[name=viewport]", "responsiveness and mobile-friendliness"),
+]
+
+
+def split_guideline_sections(text):
+    """Split a guideline text into sections at its headings.
+    A heading is a short line without end punctuation followed by a sentence. Image captions and quotes are dropped.
+    Args:
+        text (str): The guideline text.
+    Returns:
+        list: The (heading, section text) pairs in the order of the guide.
+    """
+    lines = [line.strip() for line in text.split("\n")]
+    lines = [line for line in lines if line and not CAPTION.search(line)]
+
+    sections = []
+    for index, line in enumerate(lines):
+        following = lines[index + 1] if index + 1 < len(lines) else ""
+        is_heading = len(line) <= 80 and line[-1] not in ".,:;!?'" and (len(following) > 80 or following[-1:] in (".", ":", ","))
+        if is_heading or not sections:
+            sections.append((line, [line]))
+        else:
+            sections[-1][1].append(line)
+    return [(heading, "\n".join(body)) for heading, body in sections]
+
+
+def detect_layout_features(html_source):
+    """Return the retrieval queries for the layout features found in the page HTML, starting with GUIDELINE_BASE_QUERY."""
+    queries = [GUIDELINE_BASE_QUERY]
+    if not html_source:
+        return queries
+
+    soup = parse_html(html_source)
+    for selector, query in LAYOUT_FEATURES:
+        if soup.select_one(selector) is not None:
+            queries.append(query)
+    if len(soup.find_all("img")) >= 10:
+        queries.append("images, multimedia and whitespace")
+    if len(soup.find_all("a")) >= 100:
+        queries.append("avoid clutter and cognitive overload")
+    return queries
+
+
+class GuidelineIndex:
+    """Embeddings of the sections of a guideline file, built once."""
+
+    def __init__(self, file_path, model_name=GUIDELINE_EMBEDDING_MODEL):
+        self.file_path = file_path
+        self.model_name = model_name
+        self.text = None
+        self.sections = []
+        self.section_tokens = []
+        self.model = None
+        self.index = None
+        self._lock = threading.Lock()
+
+    def build(self):
+        """Split the guideline file and embed its sections. Called by the first retrieval, safe to call more than once."""
+        with self._lock:
+            if self.text is not None:
+                return
+            text = read_file_text(self.file_path)
+            self.sections = split_guideline_sections(text)
+            self.section_tokens = [num_tokens(section) for _, section in self.sections]
+
+            try:
+                # imported here, loading sentence-transformers and faiss takes seconds and a lot of memory
+                import faiss
+                from sentence_transformers import SentenceTransformer
+
+                start_time = time.perf_counter()
+                self.model = SentenceTransformer(self.model_name)
+                embeddings = self.model.encode([section for _, section in self.sections], normalize_embeddings=True)
+                self.index = faiss.IndexFlatIP(embeddings.shape[1])
+                self.index.add(np.asarray(embeddings, dtype=np.float32))
+                print(f"Embedded {len(self.sections)} sections of {self.file_path} in {time.perf_counter() - start_time:.2f}s")
+            except Exception as e:
+                print(f"Guideline retrieval unavailable, using all of {self.file_path}: {e}")
+                self.model = None
+                self.index = None
+            self.text = text
+
+    def retrieve(self, queries, top_k=GUIDELINE_TOP_K, max_tokens=GUIDELINE_MAX_TOKENS):
+        """Return the guideline sections most similar to the queries.
+        Args:
+            queries (list): The retrieval queries, e.g. from detect_layout_features.
+            top_k (int): The maximum number of sections.
+            max_tokens (int): The maximum tokens of the returned text.
+        Returns:
+            str: The sections in the order of the guide, or the whole guide if there is no index.
+        """
+        self.build()
+        if self.index is None:
+            return self.text
+
+        query_embeddings = self.model.encode(queries, normalize_embeddings=True)
+        similarities, positions = self.index.search(np.asarray(query_embeddings, dtype=np.float32), len(self.sections))
+        # a section scores its best similarity to any of the queries
+        scores = np.full(len(self.sections), -1.0)
+        np.maximum.at(scores, positions.ravel(), similarities.ravel())
+
+        selected = []
+        tokens = 0
+        for position in np.argsort(-scores):
+            if len(selected) == top_k:
+                break
+            if tokens + self.section_tokens[position] > max_tokens:
+                continue
+            selected.append(int(position))
+            tokens += self.section_tokens[position]
+
+        print(f"Retrieved {len(selected)} of {len(self.sections)} guideline sections ({tokens} tokens): "
+              f"{', '.join(self.sections[position][0] for position in sorted(selected))}")
+        return "\n\n".join(self.sections[position][1] for position in sorted(selected))
+
+
+LAYOUT_GUIDELINE_INDEX = GuidelineIndex("contentlayoutguide.txt")
+
+
+def layout_guidelines_for_page(html_source, top_k=GUIDELINE_TOP_K, max_tokens=GUIDELINE_MAX_TOKENS):
+    """Return the layout guidelines for a page: the sections relevant to its layout features, or the whole guide when
+    retrieval is disabled.
+    Args:
+        html_source (str): The HTML of the page.
+    Returns:
+        str: The layout guidelines to put in the web design prompt.
+    """
+    if not GUIDELINE_RETRIEVAL_ENABLED:
+        return read_file_text(LAYOUT_GUIDELINE_INDEX.file_path)
+    return LAYOUT_GUIDELINE_INDEX.retrieve(detect_layout_features(html_source), top_k, max_tokens)
@@ -0,0 +1,87 @@
+import re
+
+from bs4 import Comment, NavigableString, Tag
+
+from utils import parse_html, num_tokens
+from constants import HTML_COMPACTION_RULES
+
+'''
+This script strips the parts of a page's HTML that cost tokens but add nothing to an accessibility or usability review
+before it is chunked and sent to the models: scripts, styles, comments, SVG path data, tracking and styling attributes,
+long class lists, base64 images and indentation.
+
+Attributes that matter for accessibility (alt, aria-*, role, for/id, lang, href, ...) are kept. What is removed is
+configured by HTML_COMPACTION_RULES in constants.py.
+'''
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def compact_soup(soup, rules=HTML_COMPACTION_RULES):
+    """Compact parsed HTML in place.
+    Args:
+        soup (BeautifulSoup): The parsed HTML.
+        rules (dict): The compaction rules, see HTML_COMPACTION_RULES.
+    """
+    for tag in soup.find_all(rules["remove_tags"]):
+        tag.decompose()
+
+    if rules["remove_comments"]:
+        for comment in soup.find_all(string=lambda string: isinstance(string, Comment)):
+            comment.extract()
+
+    # keep the accessible name of an SVG (its title and description) but not its drawing
+    for svg in soup.find_all("svg"):
+        for child in list(svg.children):
+            if isinstance(child, Tag) and child.name not in rules["svg_keep_children"]:
+                child.decompose()
+
+    keep_attributes = set(rules["keep_attributes"])
+    for tag in soup.find_all(True):
+        attrs = {}
+        for name, value in tag.attrs.items():
+            if name not in keep_attributes and not name.startswith(tuple(rules["keep_attribute_prefixes"])):
+                continue
+            if name == "class":
+                value = value[:rules["max_classes"]] if isinstance(value, list) else value
+                if not value:
+                    continue
+            elif isinstance(value, str):
+                if rules["drop_data_uris"] and value.startswith("data:"):
+                    value = value.split(",", 1)[0] + ",..."
+                elif len(value) > rules["max_attribute_length"]:
+                    value = value[:rules["max_attribute_length"]] + "..."
+            attrs[name] = value
+        tag.attrs = attrs
+
+    if rules["collapse_whitespace"]:
+        for string in soup.find_all(string=True):
+            if type(string) is not NavigableString or string.find_parent(["pre", "textarea"]):
+                continue
+            collapsed = WHITESPACE.sub(" ", string)
+            if collapsed != string:
+                string.replace_with(collapsed)
+
+
+def report_compaction(tokens_before, tokens_after, label="page"):
+    """Print how many tokens compaction saved."""
+    saved = 100 * (tokens_before - tokens_after) / tokens_before if tokens_before else 0
+    print(f"Compacted {label} HTML from {tokens_before} to {tokens_after} tokens ({saved:.0f}% smaller)")
+
+
+def compact_html(html_source, rules=HTML_COMPACTION_RULES, label="page"):
+    """Compact a page's HTML and print the tokens before and after.
+    Args:
+        html_source (str): The HTML to compact.
+        rules (dict): The compaction rules, see HTML_COMPACTION_RULES.
+        label (str): A name for the page in the printed report.
+    Returns:
+        str: The compacted HTML (or html_source itself if it is empty).
+    """
+    if not html_source:
+        return html_source
+    soup = parse_html(html_source)
+    compact_soup(soup, rules)
+    compacted = str(soup)
+    report_compaction(num_tokens(html_source), num_tokens(compacted), label)
+    return compacted
@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import chardet
+
+from constants import (FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT, FETCH_MAX_BYTES,
+                       FETCH_POOL_HOSTS, FETCH_POOL_SIZE)
+
+'''
+This script provides the shared HTTP client used to fetch webpages.
+
+All fetches go through one requests.Session with a connection pool per host, so repeated audits of the
+same site reuse kept-alive TCP/TLS connections instead of paying a new handshake for every request.
+Every fetch has a connect and read timeout, a cap on the response size, and its timing is recorded.
+
+Brotli responses are only requested when the brotli package is installed, since urllib3 needs it to decode them.
+'''
+
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
+    "Accept-Encoding": ACCEPT_ENCODING,
+}
+
+
+class ResponseTooLarge(requests.exceptions.RequestException):
+    """Raised when a response body is larger than the configured size cap."""
+
+
+class FetchResult:
+    """The body, headers and timing of a completed fetch."""
+
+    def __init__(self, response, content, timing):
+        self.url = response.url
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = content
+        self.timing = timing
+        self.encoding = response.encoding
+        if self.encoding is None and content:
+            self.encoding = chardet.detect(content)["encoding"]
+
+
+class HttpClient:
+    """A keep-alive HTTP client with per-host connection pools, timeouts and a response size cap."""
+
+    def __init__(self, connect_timeout=FETCH_CONNECT_TIMEOUT, read_timeout=FETCH_READ_TIMEOUT,
+                 max_bytes=FETCH_MAX_BYTES, pool_hosts=FETCH_POOL_HOSTS, pool_size=FETCH_POOL_SIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_bytes = max_bytes
+
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._timings = deque(maxlen=100)
+        self._lock = threading.Lock()
+
+    def fetch(self, url, headers=None):
+        """Fetch a URL and return its decoded body.
+        Args:
+            url (str): The URL to fetch.
+            headers (dict): Extra request headers, e.g. conditional GET headers.
+        Returns:
+            FetchResult: The response body, headers and timing.
+        Raises:
+            requests.exceptions.RequestException: On connection errors, timeouts, HTTP errors
+                or if the body is larger than max_bytes.
+        """
+        start_time = time.perf_counter()
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            # response.elapsed is measured until the headers were parsed
+            headers_seconds = response.elapsed.total_seconds()
+            response.raise_for_status()  # Raise exception for HTTP errors
+
+            content_length = response.headers.get("Content-Length")
+            if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+                raise ResponseTooLarge(f"{url} is {content_length} bytes, the limit is {self.max_bytes}")
+
+            # iter_content decodes gzip/deflate/br, so the cap applies to the decoded size
+            body = bytearray()
+            for block in response.iter_content(chunk_size=64 * 1024):
+                body.extend(block)
+                if len(body) > self.max_bytes:
+                    raise ResponseTooLarge(f"{url} is larger than the limit of {self.max_bytes} bytes")
+
+        total_seconds = time.perf_counter() - start_time
+        timing = {
+            "url": url,
+            "status_code": response.status_code,
+            "bytes": len(body),
+            "content_encoding": response.headers.get("Content-Encoding", "identity"),
+            "headers_seconds": round(headers_seconds, 4),
+            "download_seconds": round(max(total_seconds - headers_seconds, 0.0), 4),
+            "total_seconds": round(total_seconds, 4),
+        }
+        with self._lock:
+            self._timings.append(timing)
+        print(f"fetched {url} ({timing['status_code']}, {timing['bytes']} bytes, {timing['content_encoding']}) "
+              f"in {timing['total_seconds']:.2f}s (headers {timing['headers_seconds']:.2f}s)")
+
+        return FetchResult(response, bytes(body), timing)
+
+    def recent_timings(self):
+        """Return the timings of the most recent fetches, oldest first."""
+        with self._lock:
+            return list(self._timings)
+
+
+HTTP_CLIENT = HttpClient()
+
+
+def fetch(url, headers=None):
+    """Fetch a URL with the shared HTTP client. See HttpClient.fetch."""
+    return HTTP_CLIENT.fetch(url, headers=headers)
@@ -0,0 +1,151 @@
+import io
+import math
+
+import numpy as np
+from PIL import Image
+
+from constants import (SCREENSHOT_TILE_HEIGHT, SCREENSHOT_MAX_TILES, SCREENSHOT_MAX_WIDTH, SCREENSHOT_MAX_HEIGHT,
+                       SCREENSHOT_FORMAT, SCREENSHOT_QUALITY, WEB_DESIGN_HASH_SIZE)
+
+'''
+This script prepares full page screenshots for the vision models.
+
+A full page screenshot can be 1280x15000 px or more. Sent as one PNG it is large to upload and the model
+downscales it anyway, losing the detail of the text. Instead the screenshot is split into viewport height
+tiles, each tile is downscaled to at most SCREENSHOT_MAX_WIDTH by SCREENSHOT_MAX_HEIGHT (what the models use
+without downscaling again) and recompressed as JPEG or WebP.
+
+Long pages are cut into at most SCREENSHOT_MAX_TILES taller tiles, so the number of model calls per page is bounded.
+
+A perceptual hash of the screenshot tells whether the layout of a page changed since its last web design audit.
+'''
+
+MEDIA_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+class ScreenshotTile:
+    """One encoded tile of a screenshot and where it is on the page."""
+
+    def __init__(self, index, count, top, bottom, image_bytes, media_type, width, height):
+        self.index = index
+        self.count = count
+        self.top = top
+        self.bottom = bottom
+        self.image_bytes = image_bytes
+        self.media_type = media_type
+        self.width = width
+        self.height = height
+
+    def estimated_tokens(self, provider):
+        return estimate_image_tokens(self.width, self.height, provider)
+
+
+def estimate_image_tokens(width, height, provider):
+    """Estimate the input tokens of an image.
+    Claude downscales images to at most 1568 px on the long edge and about 1.15 megapixels, then uses about
+    width * height / 750 tokens. OpenAI (high detail) fits the image in 2048x2048, scales its short side to 768
+    and charges 170 tokens per 512 px tile plus 85.
+    """
+    if provider == "bedrock":
+        scale = min(1, 1568 / max(width, height), math.sqrt(1150000 / (width * height)))
+        return math.ceil(width * scale * height * scale / 750)
+
+    scale = min(1, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 170 * math.ceil(width / 512) * math.ceil(height / 512) + 85
+
+
+def prepare_screenshot_tiles(screenshot, tile_height=SCREENSHOT_TILE_HEIGHT, max_tiles=SCREENSHOT_MAX_TILES,
+                             max_width=SCREENSHOT_MAX_WIDTH, max_height=SCREENSHOT_MAX_HEIGHT, image_format=SCREENSHOT_FORMAT,
+                             quality=SCREENSHOT_QUALITY):
+    """Split a screenshot into downscaled, recompressed tiles from the top of the page down.
+    Args:
+        screenshot (bytes): The encoded screenshot, e.g. the PNG from capture_screenshot.
+        tile_height (int): The height of a tile in screenshot pixels (the viewport height).
+        max_tiles (int): The maximum number of tiles, long pages get taller tiles.
+        max_width (int): The maximum width of a tile after downscaling.
+        max_height (int): The maximum height of a tile after downscaling.
+        image_format (str): "JPEG", "WEBP" or "PNG".
+        quality (int): The JPEG or WebP quality.
+    Returns:
+        list: The ScreenshotTile objects in page order.
+    """
+    image = Image.open(io.BytesIO(screenshot))
+    image.load()
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    width, height = image.size
+    count = min(max(1, math.ceil(height / tile_height)), max_tiles)
+    tile_height = math.ceil(height / count)
+    scale = min(1, max_width / width, max_height / tile_height)
+
+    tiles = []
+    for index in range(count):
+        top = index * tile_height
+        bottom = min(top + tile_height, height)
+        tile = image.crop((0, top, width, bottom))
+        if scale < 1:
+            tile = tile.resize((round(width * scale), max(1, round((bottom - top) * scale))), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        options = {} if image_format == "PNG" else {"quality": quality}
+        tile.save(buffer, format=image_format, optimize=True, **options)
+        tiles.append(ScreenshotTile(index, count, top, bottom, buffer.getvalue(), MEDIA_TYPES[image_format], *tile.size))
+
+    return tiles
+
+
+def report_tiles(screenshot, tiles, provider):
+    """Print the bytes and estimated tokens of each tile against the original screenshot."""
+    width, height = Image.open(io.BytesIO(screenshot)).size
+    print(f"Screenshot {width}x{height}: {len(screenshot)} bytes, about {estimate_image_tokens(width, height, provider)} tokens as one image")
+    for tile in tiles:
+        print(f"  tile {tile.index + 1}/{tile.count} ({tile.top}-{tile.bottom}px) {tile.width}x{tile.height}: "
+              f"{len(tile.image_bytes)} bytes, about {tile.estimated_tokens(provider)} tokens")
+    print(f"  total: {sum(len(tile.image_bytes) for tile in tiles)} bytes, about {sum(tile.estimated_tokens(provider) for tile in tiles)} tokens")
+
+
+def perceptual_hash(screenshot, hash_size=WEB_DESIGN_HASH_SIZE):
+    """Return the difference hash (dHash) of a screenshot, e.g. "12:8f3c...".
+    A full page screenshot is much taller than it is wide, so it is hashed in square bands from the top of the page
+    down: each band is shrunk to (hash_size + 1) x hash_size grey pixels and each bit tells whether a pixel is brighter
+    than its right neighbour. A changed date or photo flips a few bits, a new layout flips many.
+    Args:
+        screenshot (bytes): The encoded screenshot.
+        hash_size (int): The bits per row and rows per band.
+    Returns:
+        str: The number of bands and the hex encoded bits.
+    """
+    image = Image.open(io.BytesIO(screenshot)).convert("L")
+    width, height = image.size
+    bands = max(1, round(height / width))
+    pixels = np.asarray(image.resize((hash_size + 1, hash_size * bands), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return f"{bands}:{np.packbits(bits).tobytes().hex()}"
+
+
+def hash_distance(hash_a, hash_b, hash_size=WEB_DESIGN_HASH_SIZE):
+    """Return the largest number of bits that differ between two perceptual hashes in any one band, or None when the
+    pages have a different number of bands (their length changed) and can not be compared.
+    The largest band is used, not the average, so a redesigned hero or body is not hidden by the unchanged bands.
+    Args:
+        hash_a (str): A perceptual hash, see perceptual_hash.
+        hash_b (str): Another perceptual hash of the same hash_size.
+        hash_size (int): The bits per row and rows per band of both hashes.
+    Returns:
+        int: The differing bits of the most changed band, or None.
+    """
+    bands_a, bits_a = hash_a.split(":")
+    bands_b, bits_b = hash_b.split(":")
+    if bands_a != bands_b or len(bits_a) != len(bits_b):
+        return None
+    band_bits = hash_size * hash_size
+    differing = np.unpackbits(np.bitwise_xor(
+        np.frombuffer(bytes.fromhex(bits_a), dtype=np.uint8), np.frombuffer(bytes.fromhex(bits_b), dtype=np.uint8)
+    ))[:int(bands_a) * band_bits]
+    if len(differing) != int(bands_a) * band_bits:
+        return None
+    return int(differing.reshape(int(bands_a), band_bits).sum(axis=1).max())
@@ -0,0 +1,237 @@
+import contextvars
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from constants import LLM_CACHE_ENABLED, LLM_CACHE_MEMORY_ENTRIES, LLM_CACHE_DIR, LLM_CACHE_DISK_MAX_BYTES
+
+'''
+This script is a content-addressed cache in front of every model call.
+
+A call is keyed by the provider, model ID, the full request (prompt, images and parameters) and the version
+of the guidelines used to build the prompt, so re-auditing an unchanged page returns the stored answer
+instead of paying for the same tokens again.
+
+There are two tiers: an in-process LRU of LLM_CACHE_MEMORY_ENTRIES responses, and a persistent tier of JSON
+files in LLM_CACHE_DIR that evicts the least recently used files once it is larger than LLM_CACHE_DISK_MAX_BYTES.
+Only successful, JSON serializable responses are cached.
+
+The cache can be bypassed for a single request with `bypass_llm_cache()`. The bypass still stores the new response.
+'''
+
+_bypass = contextvars.ContextVar("llm_cache_bypass", default=False)
+
+
+def guideline_version(guidelines):
+    """Return a short version hash of a guideline text, used as part of the cache key."""
+    return hashlib.sha256(guidelines.encode("utf-8")).hexdigest()[:12]
+
+
+def make_cache_key(provider, model_id, request, guideline_version=None):
+    """Return the sha256 key of a model call.
+    Args:
+        provider (str): The model provider, e.g. "bedrock" or "openai".
+        model_id (str): The model ID.
+        request (dict): Everything sent to the model: messages, images and parameters.
+        guideline_version (str): The version of the guidelines used in the prompt.
+    Returns:
+        str: The hex digest identifying the call.
+    """
+    payload = json.dumps(
+        {"provider": provider, "model": model_id, "guidelines": guideline_version, "request": request},
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """A two tier (memory LRU and on-disk) cache of model responses with hit and miss counters."""
+
+    def __init__(self, memory_entries=LLM_CACHE_MEMORY_ENTRIES, cache_dir=LLM_CACHE_DIR,
+                 disk_max_bytes=LLM_CACHE_DISK_MAX_BYTES, enabled=LLM_CACHE_ENABLED):
+        self.memory_entries = memory_entries
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.enabled = enabled
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "writes": 0}
+
+    def get_or_call(self, provider, model_id, request, call, guideline_version=None):
+        """Return the cached response of a model call, or make the call and cache its response.
+        Args:
+            provider (str): The model provider, e.g. "bedrock" or "openai".
+            model_id (str): The model ID.
+            request (dict): Everything sent to the model: messages, images and parameters.
+            call (callable): Makes the model call and returns a JSON serializable response.
+            guideline_version (str): The version of the guidelines used in the prompt.
+        Returns:
+            The response of the model call.
+        """
+        if not self.enabled:
+            return call()
+
+        key = make_cache_key(provider, model_id, request, guideline_version)
+
+        if _bypass.get():
+            self._count("bypassed")
+        else:
+            found, response = self._get(key)
+            if found:
+                return response
+            self._count("misses")
+
+        response = call()
+        self._set(key, response)
+        return response
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_bytes"] = self._disk_bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            for path, _, _ in self._disk_files():
+                os.remove(path)
+            self._disk_bytes = 0
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return True, self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                response = json.load(file)
+            os.utime(path)  # mark as recently used for eviction
+        except (OSError, ValueError):
+            return False, None
+
+        with self._lock:
+            self.counters["disk_hits"] += 1
+            self._remember(key, response)
+        return True, response
+
+    def _set(self, key, response):
+        try:
+            data = json.dumps(response)
+        except TypeError as e:
+            print(f"Not caching model response that is not JSON serializable: {e}")
+            return
+
+        with self._lock:
+            self.counters["writes"] += 1
+            self._remember(key, response)
+
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first so readers never see a partial response
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing the model response cache: {e}")
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+            else:
+                self._disk_bytes += len(data.encode("utf-8"))
+            if self._disk_bytes > self.disk_max_bytes:
+                self._evict_disk()
+
+    def _remember(self, key, response):
+        self._memory[key] = response
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _disk_files(self):
+        files = []
+        if not os.path.isdir(self.cache_dir):
+            return files
+        for directory, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _evict_disk(self):
+        # remove the least recently used files until the cache is back to 90% of its limit
+        files = sorted(self._disk_files(), key=lambda file: file[2])
+        total = sum(size for _, size, _ in files)
+        target = self.disk_max_bytes * 0.9
+        for path, size, _ in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._disk_bytes = total
+
+
+LLM_CACHE = LLMResponseCache()
+
+
+def cached_model_call(provider, model_id, request, call, guideline_version=None):
+    """Make a model call through the shared response cache. See LLMResponseCache.get_or_call."""
+    return LLM_CACHE.get_or_call(provider, model_id, request, call, guideline_version)
+
+
+@contextmanager
+def bypass_llm_cache():
+    """Skip cache lookups for the model calls made inside this block (new responses are still stored)."""
+    token = _bypass.set(True)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def set_llm_cache_bypass(bypass):
+    """Set the cache bypass for the current context and return a token for `reset_llm_cache_bypass`."""
+    return _bypass.set(bypass)
+
+
+def reset_llm_cache_bypass(token):
+    _bypass.reset(token)
+
+
+def llm_cache_bypassed():
+    """Whether the cache is bypassed in the current context."""
+    return _bypass.get()
+
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """Submit a function to an executor so it runs with the caller's cache bypass setting."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,286 @@
+import contextvars
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from llm_cache import cached_model_call
+from constants import LLM_GATEWAY_WORKERS, LLM_RATE_LIMITS, LLM_EXPECTED_OUTPUT_TOKENS
+
+'''
+This script is the shared gateway that every analyzer uses to call the models.
+
+It replaces the ThreadPoolExecutor that each request used to build, which let the number of in-flight
+model calls grow with the number of concurrent HTTP requests and got us throttled by Bedrock and OpenAI.
+
+- LLM_GATEWAY.submit runs work on a process-wide pool of LLM_GATEWAY_WORKERS threads. Work is queued per
+  caller thread and the queues are served round-robin, so one large audit can not starve the others.
+- Every model call waits for its provider and model budget (requests and tokens per minute, see
+  LLM_RATE_LIMITS). Waiters are served in arrival order.
+- The model clients in constants.py are shared, so their HTTP connections are reused across calls.
+- record_prompt_usage counts the cached and uncached input tokens of each call, to check that the
+  static guideline prefixes of our prompts are served from the provider prompt cache.
+- record_stream_metrics counts the time to first token and output tokens per second of streamed responses.
+
+Work submitted to the gateway must not itself wait on other gateway work, or it can deadlock the pool.
+'''
+
+
+def estimate_request_tokens(request):
+    """Roughly estimate the tokens of a model request (4 characters per token plus the expected output)."""
+    return len(json.dumps(request, default=str)) // 4 + LLM_EXPECTED_OUTPUT_TOKENS
+
+
+def prompt_token_usage(usage):
+    """Return the (cached, uncached) input tokens of an Anthropic or OpenAI usage object or dictionary."""
+    def read(source, name):
+        value = source.get(name) if isinstance(source, dict) else getattr(source, name, None)
+        return value or 0
+
+    if read(usage, "prompt_tokens"):
+        # OpenAI reports every prompt token, and the cached ones in the details
+        details = read(usage, "prompt_tokens_details")
+        cached = read(details, "cached_tokens") if details else 0
+        return cached, read(usage, "prompt_tokens") - cached
+
+    # Anthropic reports the cached tokens separately from the (uncached) input tokens
+    cached = read(usage, "cache_read_input_tokens")
+    return cached, read(usage, "input_tokens") + read(usage, "cache_creation_input_tokens")
+
+
+class RateBudget:
+    """A sliding one minute window of requests and tokens for one provider and model. Waiters are served first come, first served."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._events = deque()  # (time, tokens) of the calls made in the last minute
+        self._tokens_used = 0
+        self._waiters = deque()
+        self._cond = threading.Condition()
+        self.acquired = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def acquire(self, tokens):
+        """Block until the call fits in the budget and return how long it waited."""
+        # a single call larger than the whole budget would otherwise wait forever
+        tokens = min(tokens, self.tokens_per_minute)
+        ticket = object()
+        start_time = time.monotonic()
+
+        with self._cond:
+            self._waiters.append(ticket)
+            while True:
+                now = time.monotonic()
+                while self._events and now - self._events[0][0] >= 60:
+                    _, expired_tokens = self._events.popleft()
+                    self._tokens_used -= expired_tokens
+
+                is_next = self._waiters[0] is ticket
+                if (is_next and len(self._events) < self.requests_per_minute
+                        and self._tokens_used + tokens <= self.tokens_per_minute):
+                    self._waiters.popleft()
+                    self._events.append((now, tokens))
+                    self._tokens_used += tokens
+
+                    waited = now - start_time
+                    self.acquired += 1
+                    self.total_wait_seconds += waited
+                    self.max_wait_seconds = max(self.max_wait_seconds, waited)
+                    self._cond.notify_all()
+                    return waited
+
+                # the next waiter sleeps until the oldest call leaves the window, the others until they are next
+                timeout = self._events[0][0] + 60 - now if is_next and self._events else None
+                self._cond.wait(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "requests_per_minute": self.requests_per_minute,
+                "tokens_per_minute": self.tokens_per_minute,
+                "requests_in_window": len(self._events),
+                "tokens_in_window": self._tokens_used,
+                "waiting": len(self._waiters),
+                "acquired": self.acquired,
+                "average_wait_seconds": round(self.total_wait_seconds / self.acquired, 3) if self.acquired else 0.0,
+                "max_wait_seconds": round(self.max_wait_seconds, 3),
+            }
+
+
+class LLMGateway:
+    """A process-wide, fair worker pool and per provider/model rate budgets for model calls."""
+
+    def __init__(self, workers=LLM_GATEWAY_WORKERS, rate_limits=LLM_RATE_LIMITS):
+        self.workers = workers
+        self.rate_limits = rate_limits
+        self._queues = OrderedDict()  # caller -> deque of queued work
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._budgets = {}
+        self._budgets_lock = threading.Lock()
+        self.in_flight_calls = 0
+        self.completed_calls = 0
+        self.total_queue_wait_seconds = 0.0
+        self.max_queue_wait_seconds = 0.0
+        self.dequeued = 0
+        self._prompt_tokens = {}  # "provider:model_id" -> cached and uncached input token counts
+        self._streams = {}  # "provider:model_id" -> time to first token and output rate of streamed responses
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue a function to run on the shared pool, with the caller's context (e.g. the cache bypass).
+        Returns:
+            Future: Resolves to the return value of the function.
+        """
+        self._start()
+        future = Future()
+        work = (contextvars.copy_context(), fn, args, kwargs, future, time.monotonic())
+        caller = threading.get_ident()
+        with self._cond:
+            self._queues.setdefault(caller, deque()).append(work)
+            self._queued += 1
+            self._cond.notify()
+        return future
+
+    def call(self, provider, model_id, call, estimated_tokens):
+        """Wait for the provider and model budget, then make the model call.
+        Args:
+            provider (str): The model provider, e.g. "bedrock" or "openai".
+            model_id (str): The model ID.
+            call (callable): Makes the model call.
+            estimated_tokens (int): The tokens the call is expected to use.
+        Returns:
+            The return value of the call.
+        """
+        waited = self._budget(provider, model_id).acquire(estimated_tokens)
+        if waited > 1:
+            print(f"{provider} {model_id} call waited {waited:.2f}s for its rate limit budget")
+
+        with self._cond:
+            self.in_flight_calls += 1
+        try:
+            return call()
+        finally:
+            with self._cond:
+                self.in_flight_calls -= 1
+                self.completed_calls += 1
+
+    def record_prompt_usage(self, provider, model_id, usage):
+        """Count and print the cached and uncached input tokens of a model response's usage."""
+        if usage is None:
+            return
+        cached, uncached = prompt_token_usage(usage)
+        print(f"{provider} {model_id} input tokens: {cached} cached, {uncached} uncached")
+
+        with self._cond:
+            counts = self._prompt_tokens.setdefault(f"{provider}:{model_id}", {"cached_input_tokens": 0, "uncached_input_tokens": 0})
+            counts["cached_input_tokens"] += cached
+            counts["uncached_input_tokens"] += uncached
+
+    def record_stream_metrics(self, provider, model_id, time_to_first_token, output_tokens, generation_seconds):
+        """Count the time to first token and the output tokens per second of a streamed response."""
+        with self._cond:
+            streams = self._streams.setdefault(f"{provider}:{model_id}", {
+                "streams": 0, "total_time_to_first_token": 0.0, "max_time_to_first_token": 0.0,
+                "output_tokens": 0, "generation_seconds": 0.0,
+            })
+            streams["streams"] += 1
+            streams["total_time_to_first_token"] += time_to_first_token
+            streams["max_time_to_first_token"] = max(streams["max_time_to_first_token"], time_to_first_token)
+            streams["output_tokens"] += output_tokens
+            streams["generation_seconds"] += generation_seconds
+
+    def stats(self):
+        with self._cond:
+            stats = {
+                "workers": self.workers,
+                "queue_depth": self._queued,
+                "queued_callers": len(self._queues),
+                "in_flight_calls": self.in_flight_calls,
+                "completed_calls": self.completed_calls,
+                "average_queue_wait_seconds": round(self.total_queue_wait_seconds / self.dequeued, 3) if self.dequeued else 0.0,
+                "max_queue_wait_seconds": round(self.max_queue_wait_seconds, 3),
+                "prompt_tokens": {key: dict(counts) for key, counts in self._prompt_tokens.items()},
+                "streams": {
+                    key: {
+                        "streams": streams["streams"],
+                        "average_time_to_first_token": round(streams["total_time_to_first_token"] / streams["streams"], 3),
+                        "max_time_to_first_token": round(streams["max_time_to_first_token"], 3),
+                        "output_tokens_per_second": round(streams["output_tokens"] / streams["generation_seconds"], 1) if streams["generation_seconds"] else 0.0,
+                    }
+                    for key, streams in self._streams.items()
+                },
+            }
+        with self._budgets_lock:
+            stats["budgets"] = {f"{provider}:{model_id}": budget.stats() for (provider, model_id), budget in self._budgets.items()}
+        return stats
+
+    def _budget(self, provider, model_id):
+        with self._budgets_lock:
+            budget = self._budgets.get((provider, model_id))
+            if budget is None:
+                limits = self.rate_limits.get(f"{provider}:{model_id}", self.rate_limits[provider])
+                budget = RateBudget(limits["requests_per_minute"], limits["tokens_per_minute"])
+                self._budgets[(provider, model_id)] = budget
+            return budget
+
+    def _start(self):
+        with self._cond:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, name=f"llm-gateway-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _next_work(self):
+        with self._cond:
+            while not self._queued:
+                self._cond.wait()
+            # take from the first caller's queue, then move that caller to the back (round-robin)
+            caller, queue = next(iter(self._queues.items()))
+            work = queue.popleft()
+            if queue:
+                self._queues.move_to_end(caller)
+            else:
+                del self._queues[caller]
+            self._queued -= 1
+
+            waited = time.monotonic() - work[5]
+            self.dequeued += 1
+            self.total_queue_wait_seconds += waited
+            self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, waited)
+            return work
+
+    def _worker(self):
+        while True:
+            context, fn, args, kwargs, future, _ = self._next_work()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(context.run(fn, *args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+
+LLM_GATEWAY = LLMGateway()
+
+
+def model_call(provider, model_id, request, call, guideline_version=None):
+    """Make a model call through the response cache and, on a miss, the rate limited gateway.
+    Args:
+        provider (str): The model provider, e.g. "bedrock" or "openai".
+        model_id (str): The model ID.
+        request (dict): Everything sent to the model, used for the cache key and the token estimate.
+        call (callable): Makes the model call and returns a JSON serializable response.
+        guideline_version (str): The version of the guidelines used in the prompt.
+    Returns:
+        The response of the model call.
+    """
+    estimated_tokens = estimate_request_tokens(request)
+    return cached_model_call(
+        provider, model_id, request,
+        lambda: LLM_GATEWAY.call(provider, model_id, call, estimated_tokens),
+        guideline_version,
+    )
@@ -0,0 +1,3 @@
+-- Readability scores of the content sections (see readability.py), stored with each content clarity audit
+-- so the UI can show them without running the audit again.
+ALTER TABLE ContentClarityAudit ADD COLUMN readabilityScores JSON NULL;
@@ -0,0 +1,7 @@
+-- Perceptual hash of the screenshot of each web design audit (see image_preparation.py) and the version of the
+-- layout guidelines it used, so an audit of a page whose layout has not changed can reuse the previous suggestions.
+-- reusedAuditId is the audit whose suggestions were copied, NULL when the screenshot was analyzed.
+ALTER TABLE WebDesignAudit
+    ADD COLUMN screenshotHash VARCHAR(2048) NULL,
+    ADD COLUMN guidelineVersion VARCHAR(12) NULL,
+    ADD COLUMN reusedAuditId INT NULL;
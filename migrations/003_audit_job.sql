@@ -0,0 +1,22 @@
+-- Queue of project audit jobs (see audit_jobs.py). POST /create-project inserts a queued job and the audit workers
+-- claim it with claimToken. progress holds the status, seconds and error of each audit, results the output of each
+-- audit that finished, so the partial results can be polled while the other audits run.
+CREATE TABLE AuditJob (
+    auditJobId INT AUTO_INCREMENT PRIMARY KEY,
+    projectId INT NOT NULL,
+    url VARCHAR(2048) NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'queued',  -- queued, running, done or failed
+    bypassCache BOOLEAN NOT NULL DEFAULT FALSE,
+    progress JSON NULL,
+    results JSON NULL,
+    error TEXT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    claimToken VARCHAR(36) NULL,
+    createdAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    startedAt TIMESTAMP NULL,
+    updatedAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    finishedAt TIMESTAMP NULL,
+    INDEX auditJobStatus (status, auditJobId),
+    INDEX auditJobProject (projectId),
+    UNIQUE INDEX auditJobClaim (claimToken)
+);
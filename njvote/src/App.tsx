@@ -131,7 +131,20 @@ function App({ user }: WithAuthenticatorProps) {
       if (!response.ok) throw new Error('Failed to create project');
 
       const data = await response.json();
-      const newProjectId = data[0]['project'][0]['project'][0];
+      const newProjectId = data['project'][0]['project'][0];
+
+      // the audits run in the background, poll the job until they are finished
+      let job = { status: data['status'], audits: {} as Record<string, { status: string }> };
+      while (job.status === 'queued' || job.status === 'running') {
+        await new Promise(resolve => setTimeout(resolve, 3000));
+        const jobResponse = await fetch(`https://a8b6filf5e.execute-api.us-east-1.amazonaws.com/audit-job?jobId=${data['jobId']}`);
+        if (!jobResponse.ok) throw new Error('Failed to fetch the audit job');
+        job = await jobResponse.json();
+        const finished = Object.values(job.audits).filter(audit => audit.status === 'done' || audit.status === 'failed').length;
+        setLoadingPercent(10 + finished * 30);
+      }
+      if (job.status === 'failed') throw new Error('The audits of the project failed');
+
       await fetchProjects();
       setSelectedProjectId(newProjectId);
       setLoadingPercent(100);
@@ -0,0 +1,208 @@
+import re
+import threading
+from collections import OrderedDict
+
+import requests
+
+from utils import parse_html, num_tokens
+from page_snapshot import get_page_snapshot
+from constants import PAGE_DIGEST_CACHE_ENTRIES, PAGE_DIGEST_LIMITS
+
+'''
+This script builds a compact digest of a webpage for persona generation and audience audits: the title, language
+options, a short summary, the heading outline, the navigation labels, the forms and their fields and the key links.
+A digest is a few hundred tokens where the HTML of the page is often tens of thousands.
+
+The digest is extracted from the HTML without a model call. Digests are cached per URL together with the digest
+(sha256) of the page snapshot they were built from, so a digest is rebuilt as soon as the snapshot of the page changes.
+'''
+
+# link texts of language switchers, e.g. on nj.gov "Español", "Português", "中文"
+LANGUAGE_NAMES = {"english", "español", "espanol", "spanish", "português", "portuguese", "français", "french", "kreyòl",
+                  "kreyol", "haitian creole", "中文", "chinese", "繁體中文", "简体中文", "한국어", "korean", "tiếng việt",
+                  "vietnamese", "tagalog", "русский", "russian", "polski", "polish", "italiano", "italian", "العربية",
+                  "arabic", "हिन्दी", "hindi", "ગુજરાતી", "gujarati", "বাংলা", "bengali", "اردو", "urdu", "日本語", "japanese"}
+TRANSLATE_WIDGET = re.compile(r"translate", re.IGNORECASE)
+WHITESPACE = re.compile(r"\s+")
+
+
+def clean_text(text, limit=120):
+    text = WHITESPACE.sub(" ", text or "").strip()
+    return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + "..."
+
+
+def field_label(field, soup):
+    """Return the label of a form field: its <label>, aria-label, placeholder, title or name."""
+    if field.get("id"):
+        label = soup.find("label", attrs={"for": field["id"]})
+        if label is not None and label.get_text(strip=True):
+            return clean_text(label.get_text(" "), 60)
+    parent_label = field.find_parent("label")
+    if parent_label is not None and parent_label.get_text(strip=True):
+        return clean_text(parent_label.get_text(" "), 60)
+    for name in ("aria-label", "placeholder", "title", "name"):
+        if field.get(name, "").strip():
+            return clean_text(field[name], 60)
+    return "unlabeled"
+
+
+def build_page_digest(html_source, url=None, limits=PAGE_DIGEST_LIMITS):
+    """Extract the digest of a page from its HTML.
+    Args:
+        html_source (str): The HTML of the page.
+        url (str): The URL of the page.
+        limits (dict): The maximum number of headings, navigation labels, forms, fields per form and links, and the
+            words of the summary, see PAGE_DIGEST_LIMITS.
+    Returns:
+        dict: The digest with url, title, language, languages, summary, headings, navigation, forms and links.
+    """
+    soup = parse_html(html_source or "")
+    html_tag = soup.find("html")
+    title = soup.find("title")
+
+    description = soup.find("meta", attrs={"name": "description"})
+    summary = description.get("content", "") if description is not None else ""
+    main = soup.find("main") or soup.find(attrs={"role": "main"}) or soup.body or soup
+    if not summary.strip():
+        paragraphs = (clean_text(p.get_text(" "), 1000) for p in main.find_all("p"))
+        summary = " ".join(paragraph for paragraph in paragraphs if len(paragraph.split()) >= 8)
+    summary_words = summary.split()
+    summary = " ".join(summary_words[:limits["summary_words"]]) + ("..." if len(summary_words) > limits["summary_words"] else "")
+
+    headings = [
+        {"level": int(heading.name[1]), "text": clean_text(heading.get_text(" "))}
+        for heading in soup.find_all(["h1", "h2", "h3"]) if heading.get_text(strip=True)
+    ][:limits["headings"]]
+
+    navigation = []
+    for region in soup.find_all(["nav", "header"]) + soup.find_all(attrs={"role": "navigation"}):
+        for link in region.find_all("a"):
+            label = clean_text(link.get_text(" ") or link.get("aria-label", ""), 60)
+            if label and label not in navigation:
+                navigation.append(label)
+    navigation = navigation[:limits["navigation"]]
+
+    forms = []
+    for form in soup.find_all("form")[:limits["forms"]]:
+        fields = [
+            f"{field_label(field, soup)} ({field.get('type', field.name) if field.name == 'input' else field.name})"
+            for field in form.find_all(["input", "select", "textarea"])
+            if field.get("type", "").lower() not in ("hidden", "submit", "button", "reset")
+        ]
+        submit = form.find(["button", "input"], attrs={"type": "submit"}) or form.find("button")
+        forms.append({
+            "name": clean_text(form.get("aria-label") or form.get("name") or form.get("id") or "form", 60),
+            "fields": fields[:limits["fields"]],
+            "submit": clean_text(submit.get_text(" ") or submit.get("value", ""), 60) if submit is not None else "",
+        })
+
+    languages = []
+    for link in soup.find_all("a"):
+        label = clean_text(link.get_text(" "), 40)
+        if link.get("hreflang") or label.lower() in LANGUAGE_NAMES:
+            if label and label not in languages:
+                languages.append(label)
+    if soup.find(id=TRANSLATE_WIDGET) or soup.find(class_=TRANSLATE_WIDGET):
+        languages.append("translation widget")
+
+    links = []
+    seen = set(navigation)
+    for link in main.find_all("a", href=True):
+        if link.find_parent(["nav", "header", "footer"]):
+            continue
+        label = clean_text(link.get_text(" ") or link.get("aria-label", ""), 80)
+        if len(label) < 3 or label in seen:
+            continue
+        seen.add(label)
+        links.append({"text": label, "href": link["href"][:120]})
+    links = links[:limits["links"]]
+
+    return {
+        "url": url,
+        "title": clean_text(title.get_text(" ")) if title is not None else "",
+        "language": (html_tag.get("lang") if html_tag is not None else None) or "not set",
+        "languages": languages,
+        "summary": summary,
+        "headings": headings,
+        "navigation": navigation,
+        "forms": forms,
+        "links": links,
+    }
+
+
+def format_page_digest(digest):
+    """Format a page digest as compact text for a prompt."""
+    lines = [f"URL: {digest['url']}", f"Title: {digest['title']}", f"Page language: {digest['language']}"]
+    if digest["languages"]:
+        lines.append(f"Language options: {', '.join(digest['languages'])}")
+    if digest["summary"]:
+        lines.append(f"Summary: {digest['summary']}")
+    if digest["headings"]:
+        lines.append("Headings:")
+        lines.extend(f"{'  ' * (heading['level'] - 1)}- H{heading['level']} {heading['text']}" for heading in digest["headings"])
+    if digest["navigation"]:
+        lines.append(f"Navigation: {' | '.join(digest['navigation'])}")
+    if digest["forms"]:
+        lines.append("Forms:")
+        for form in digest["forms"]:
+            submit = f", submit: {form['submit']}" if form["submit"] else ""
+            lines.append(f"- {form['name']}: {', '.join(form['fields']) or 'no fields'}{submit}")
+    if digest["links"]:
+        lines.append("Key links:")
+        lines.extend(f"- {link['text']} ({link['href']})" for link in digest["links"])
+    return "\n".join(lines)
+
+
+class PageDigestCache:
+    """A thread safe LRU cache of page digests keyed by URL and checked against the digest of the page snapshot."""
+
+    def __init__(self, max_entries=PAGE_DIGEST_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        """Return the formatted digest of a webpage, building it if the page snapshot changed since it was cached.
+        Args:
+            url (str): The URL of the webpage.
+        Returns:
+            str: The formatted page digest.
+        Raises:
+            requests.exceptions.RequestException: If the page can not be fetched.
+        """
+        snapshot = get_page_snapshot(url)
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None and entry[0] == snapshot.digest:
+                self._entries.move_to_end(url)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        html_source = snapshot.text
+        digest = format_page_digest(build_page_digest(html_source, url))
+        print(f"Page digest of {url}: {num_tokens(digest)} tokens, the HTML is {num_tokens(html_source)} tokens")
+
+        with self._lock:
+            self._entries[url] = (snapshot.digest, digest)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return digest
+
+    def stats(self):
+        with self._lock:
+            return {"pages": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+PAGE_DIGEST_CACHE = PageDigestCache()
+
+
+def get_page_digest(url):
+    """Return the shared, formatted digest of a webpage, or None if it can not be fetched. See PageDigestCache.get."""
+    try:
+        return PAGE_DIGEST_CACHE.get(url)
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching the website: {e}")
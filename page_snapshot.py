@@ -0,0 +1,162 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from http_client import fetch
+from constants import PAGE_CACHE_TTL_SECONDS, PAGE_CACHE_MAX_BYTES, PAGE_CACHE_LOCK_STRIPES
+
+'''
+This script keeps an in-memory snapshot of every webpage that is fetched, so that all the scrapers
+(get_pure_source, chunk_html_text and the Playwright screenshot) share a single download of a URL.
+
+Snapshots expire after PAGE_CACHE_TTL_SECONDS. An expired snapshot is revalidated with a conditional GET
+(If-None-Match / If-Modified-Since) so an unchanged page is not downloaded again.
+Pages are downloaded with the shared keep-alive client in http_client.py.
+The cache is bounded to PAGE_CACHE_MAX_BYTES of page content and evicts the least recently used pages first.
+'''
+
+class PageSnapshot:
+    """The raw bytes of a fetched webpage together with the headers needed to revalidate it."""
+
+    def __init__(self, url, final_url, content, encoding, content_type, etag, last_modified, fetch_timing=None):
+        self.url = url
+        self.final_url = final_url
+        self.content = content
+        self.encoding = encoding
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetch_timing = fetch_timing
+        self.fetched_at = time.time()
+        self.digest = hashlib.sha256(content).hexdigest()
+
+    @property
+    def text(self):
+        """The page content decoded the same way requests decodes `response.text`."""
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    @property
+    def size(self):
+        return len(self.content)
+
+
+class PageSnapshotCache:
+    """A thread safe, TTL and size bounded LRU cache of PageSnapshot objects keyed by URL."""
+
+    def __init__(self, ttl_seconds=PAGE_CACHE_TTL_SECONDS, max_bytes=PAGE_CACHE_MAX_BYTES, lock_stripes=PAGE_CACHE_LOCK_STRIPES):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._snapshots = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        # a fixed set of locks picked by the hash of the URL, so concurrent audits of the same page wait for a
+        # single download without keeping a lock for every URL ever fetched
+        self._url_locks = [threading.Lock() for _ in range(lock_stripes)]
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def get(self, url, force_refresh=False):
+        """Return the snapshot of a URL, downloading or revalidating it if needed.
+        Args:
+            url (str): The URL of the webpage.
+            force_refresh (bool): Revalidate the snapshot even if it has not expired.
+        Returns:
+            PageSnapshot: The snapshot of the webpage.
+        Raises:
+            requests.exceptions.RequestException: If the page can not be fetched.
+        """
+        with self._url_locks[hash(url) % len(self._url_locks)]:
+            with self._lock:
+                snapshot = self._snapshots.get(url)
+                if snapshot is not None:
+                    self._snapshots.move_to_end(url)
+                    if not force_refresh and time.time() - snapshot.fetched_at < self.ttl_seconds:
+                        self.hits += 1
+                        return snapshot
+                    self.revalidations += 1
+                else:
+                    self.misses += 1
+
+            if snapshot is None:
+                snapshot = self._fetch(url)
+            else:
+                snapshot = self._revalidate(snapshot)
+
+            self._store(snapshot)
+            return snapshot
+
+    def invalidate(self, url):
+        """Drop the snapshot of a URL from the cache."""
+        with self._lock:
+            snapshot = self._snapshots.pop(url, None)
+            if snapshot is not None:
+                self._total_bytes -= snapshot.size
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        """Return the hit, miss and revalidation counters and the current size of the cache."""
+        with self._lock:
+            return {
+                "pages": len(self._snapshots),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+            }
+
+    def _fetch(self, url, extra_headers=None):
+        response = fetch(url, headers=extra_headers)
+        if response.status_code == 304:
+            return response
+        return PageSnapshot(
+            url=url,
+            final_url=response.url,
+            content=response.content,
+            encoding=response.encoding,
+            content_type=response.headers.get("Content-Type", "text/html"),
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            fetch_timing=response.timing,
+        )
+
+    def _revalidate(self, snapshot):
+        conditional_headers = {}
+        if snapshot.etag:
+            conditional_headers["If-None-Match"] = snapshot.etag
+        if snapshot.last_modified:
+            conditional_headers["If-Modified-Since"] = snapshot.last_modified
+
+        result = self._fetch(snapshot.url, conditional_headers)
+        if isinstance(result, PageSnapshot):
+            return result
+
+        # 304 Not Modified: keep the stored bytes and restart the TTL
+        snapshot.fetched_at = time.time()
+        return snapshot
+
+    def _store(self, snapshot):
+        with self._lock:
+            previous = self._snapshots.pop(snapshot.url, None)
+            if previous is not None:
+                self._total_bytes -= previous.size
+            self._snapshots[snapshot.url] = snapshot
+            self._total_bytes += snapshot.size
+
+            # evict the least recently used pages, but always keep the page that was just stored
+            while self._total_bytes > self.max_bytes and len(self._snapshots) > 1:
+                _, evicted = self._snapshots.popitem(last=False)
+                self._total_bytes -= evicted.size
+
+
+PAGE_CACHE = PageSnapshotCache()
+
+
+def get_page_snapshot(url, force_refresh=False):
+    """Return the shared snapshot of a webpage. See PageSnapshotCache.get."""
+    return PAGE_CACHE.get(url, force_refresh=force_refresh)
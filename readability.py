@@ -0,0 +1,119 @@
+import re
+
+import numpy as np
+
+from constants import READABILITY_THRESHOLDS
+
+'''
+This script scores the readability of the content sections of a page before they are sent to the model, so only the
+sections that fail the content guidelines are reviewed by content clarity.
+
+All sections are scored at once: the counts (words, sentences, syllables, passive constructions and jargon) are
+collected per section and the scores and threshold checks are computed as numpy arrays.
+
+- grade: Flesch-Kincaid grade level
+- sentence_length: average words per sentence
+- passive_ratio: passive constructions per sentence
+- jargon_density: abbreviations and long technical words per word
+
+The grade thresholds are read from the content guidelines ("Aim for grade levels 6-8, but go no higher than grade 12"),
+the other thresholds are in READABILITY_THRESHOLDS.
+'''
+
+WORD = re.compile(r"[A-Za-z]+(?:'[a-z]+)?")
+SENTENCE_END = re.compile(r"[.!?]+(?:\s|$)")
+PUNCTUATED_SENTENCE = re.compile(r"[^.!?]+[.!?]+(?=\s|$)")
+VOWEL_GROUP = re.compile(r"[aeiouy]+")
+SILENT_E = re.compile(r"[^aeiouy\s]e\b")
+PASSIVE = re.compile(r"\b(?:am|is|are|was|were|be|been|being)\s+(?:\w+ly\s+)?\w+(?:ed|en)\b", re.IGNORECASE)
+ABBREVIATION = re.compile(r"\b[A-Z]{2,6}s?\b")
+LONG_WORD = re.compile(r"\b[A-Za-z]{13,}\b")
+TARGET_GRADE = re.compile(r"grade levels? (\d+)\s*-\s*(\d+)", re.IGNORECASE)
+MAX_GRADE = re.compile(r"no higher than grade (\d+)", re.IGNORECASE)
+
+
+def readability_thresholds(content_guidelines):
+    """Return the readability thresholds, with the grade levels read from the content guidelines when they state them.
+    Args:
+        content_guidelines (str): The content clarity guidelines.
+    Returns:
+        dict: The thresholds (see READABILITY_THRESHOLDS).
+    """
+    thresholds = dict(READABILITY_THRESHOLDS)
+    target = TARGET_GRADE.search(content_guidelines or "")
+    if target:
+        thresholds["target_grade"] = int(target.group(2))
+    maximum = MAX_GRADE.search(content_guidelines or "")
+    if maximum:
+        thresholds["max_grade"] = int(maximum.group(1))
+    return thresholds
+
+
+def section_counts(section):
+    """Return the (words, sentences, syllables, prose sentences, passive constructions, jargon words) of a section."""
+    words = WORD.findall(section)
+    sentences = [sentence for sentence in SENTENCE_END.split(section) if WORD.search(sentence)]
+    lower = section.lower()
+    syllables = max(len(VOWEL_GROUP.findall(lower)) - len(SILENT_E.findall(lower)), len(words))
+    # prose sentences end in punctuation and have more than a few words: labels, buttons and link lists (e.g. a
+    # navigation menu, whose labels run together into one long unpunctuated "sentence") are not prose
+    prose = sum(1 for sentence in PUNCTUATED_SENTENCE.findall(section) if len(WORD.findall(sentence)) >= 5)
+    jargon = len(ABBREVIATION.findall(section)) + len(LONG_WORD.findall(section))
+    return len(words), max(len(sentences), 1), syllables, prose, len(PASSIVE.findall(section)), jargon
+
+
+def score_sections(sections, content_guidelines):
+    """Score the readability of every section and decide which ones need a content clarity review.
+    Args:
+        sections (list): The sections of text, in page order.
+        content_guidelines (str): The content clarity guidelines the thresholds are read from.
+    Returns:
+        dict: {"thresholds": ..., "page": ..., "sections": [...]} where each section has its index, scores and a
+            needs_review flag, and page has the word weighted averages.
+    """
+    thresholds = readability_thresholds(content_guidelines)
+    if not sections:
+        return {"thresholds": thresholds, "page": None, "sections": []}
+
+    counts = np.array([section_counts(section) for section in sections], dtype=float)
+    words, sentences, syllables, prose, passive, jargon = counts.T
+    safe_words = np.maximum(words, 1)
+
+    sentence_length = words / sentences
+    grade = np.clip(0.39 * sentence_length + 11.8 * (syllables / safe_words) - 15.59, 0, None)
+    passive_ratio = passive / sentences
+    jargon_density = jargon / safe_words
+
+    fails = (
+        (grade > thresholds["target_grade"])
+        | (sentence_length > thresholds["max_sentence_length"])
+        | (passive_ratio > thresholds["max_passive_ratio"])
+        | (jargon_density > thresholds["max_jargon_density"])
+    )
+    # link lists and labels have no prose to rewrite
+    needs_review = fails & (prose > 0)
+
+    section_scores = [
+        {
+            "section": index,
+            "words": int(words[index]),
+            "grade": round(float(grade[index]), 1),
+            "sentence_length": round(float(sentence_length[index]), 1),
+            "passive_ratio": round(float(passive_ratio[index]), 2),
+            "jargon_density": round(float(jargon_density[index]), 3),
+            "above_max_grade": bool(grade[index] > thresholds["max_grade"]),
+            "needs_review": bool(needs_review[index]),
+        }
+        for index in range(len(sections))
+    ]
+
+    weights = words if words.sum() else None
+    page = {
+        "grade": round(float(np.average(grade, weights=weights)), 1),
+        "sentence_length": round(float(np.average(sentence_length, weights=weights)), 1),
+        "passive_ratio": round(float(np.average(passive_ratio, weights=weights)), 2),
+        "jargon_density": round(float(np.average(jargon_density, weights=weights)), 3),
+        "sections_reviewed": int(needs_review.sum()),
+        "sections": len(sections),
+    }
+    return {"thresholds": thresholds, "page": page, "sections": section_scores}
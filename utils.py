@@ -1,16 +1,25 @@
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer, Tag, NavigableString, CData
 import boto3
 import os
 import json
-from playwright.sync_api import sync_playwright
 from openai import OpenAI
 import re 
+import io
+import hashlib
 import tiktoken
+import time
+import tracemalloc
 
+from page_snapshot import get_page_snapshot
+from browser_pool import BROWSER_POOL
+from llm_gateway import LLM_GATEWAY, model_call, estimate_request_tokens
+from constants import BOTO3_CLIENT, OPEN_AI_CLIENT, MODEL_ID, BEDROCK_PROMPT_CACHING, HTML_PARSER, HTML_PARSE_PROFILE
 
 
-bedrock_client = boto3.client("bedrock-runtime", region_name="us-east-1")
+
+# shares the kept-alive connections of the gateway Bedrock client
+bedrock_client = BOTO3_CLIENT
 model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
 
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1") 
@@ -19,17 +28,75 @@ S3_BUCKET_NAME = "nj-ai-votes-image"
 s3_client = boto3.client("s3", region_name="us-east-1")
 tokenizer = tiktoken.get_encoding('cl100k_base')
 
-def get_pred(scrapped_data, prompt):
-    """Using the Bedrock API, analyze the webpage source code and provide suggestions for improving the web design.
+class StreamMetrics:
+    """Time to first token and output tokens per second of one streamed model response."""
+
+    def __init__(self, provider, model_id):
+        self.provider = provider
+        self.model_id = model_id
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.output_tokens = None
+        self.text_characters = 0
+
+    def text(self, delta):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.text_characters += len(delta)
+
+    def finish(self):
+        """Print the metrics of the response and add them to the gateway stats."""
+        finished = time.perf_counter()
+        if self.first_token is None:
+            return
+        time_to_first_token = self.first_token - self.started
+        generation_seconds = finished - self.first_token
+        # the usage of the stream, or about 4 characters per token if it did not report one
+        output_tokens = self.output_tokens or round(self.text_characters / 4)
+        tokens_per_second = output_tokens / generation_seconds if generation_seconds > 0 else 0.0
+        print(f"{self.provider} {self.model_id} stream: first token after {time_to_first_token:.2f}s, "
+              f"{output_tokens} tokens at {tokens_per_second:.1f} tokens/s")
+        LLM_GATEWAY.record_stream_metrics(self.provider, self.model_id, time_to_first_token, output_tokens, generation_seconds)
+
+
+def decode_bedrock_stream(event_stream, metrics=None):
+    """Decode the events of a Bedrock invoke_model_with_response_stream body and yield the text deltas as they arrive.
     Args:
-        scrapped_data (str): The source code of the webpage to analyze.
-        prompt (str): The prompt to guide the analysis.
-    Returns:
-        str: The response from the model based on the provided source code and prompt.
+        event_stream: The "body" of the response, an iterable of events.
+        metrics (StreamMetrics): Records the time to first token and the output tokens of the stream.
+    Yields:
+        str: The text of each content block delta.
+    Raises:
+        RuntimeError: If the stream reports an error event.
     """
+    try:
+        for event in event_stream:
+            if "chunk" not in event:
+                # exception events, e.g. throttlingException or modelStreamErrorException
+                name, error = next(iter(event.items()), ("unknown", {}))
+                raise RuntimeError(f"Bedrock stream error {name}: {error.get('message', error) if isinstance(error, dict) else error}")
+
+            payload = json.loads(event["chunk"]["bytes"])
+            event_type = payload.get("type")
+            if event_type == "content_block_delta" and payload["delta"].get("type") == "text_delta":
+                delta = payload["delta"]["text"]
+                if metrics is not None:
+                    metrics.text(delta)
+                yield delta
+            elif event_type == "message_delta" and metrics is not None:
+                metrics.output_tokens = payload.get("usage", {}).get("output_tokens", metrics.output_tokens)
+            elif event_type == "message_stop" and metrics is not None:
+                invocation_metrics = payload.get("amazon-bedrock-invocationMetrics", {})
+                metrics.output_tokens = invocation_metrics.get("outputTokenCount", metrics.output_tokens)
+    finally:
+        if metrics is not None:
+            metrics.finish()
 
+
+def pred_request(scrapped_data, prompt):
+    """Return the Bedrock request body of get_pred and stream_pred."""
     summary = f"Look at the following website source code: {scrapped_data}. {prompt}"
-    input_data = {
+    return {
         "anthropic_version": "bedrock-2023-05-31",
         "messages": [
             {"role": "user", "content": summary}  # Directly set the user input
@@ -38,30 +105,116 @@ def get_pred(scrapped_data, prompt):
         "temperature": 0,
     }
 
+
+def open_pred_stream(input_data):
+    """Start a streamed Bedrock response and return its event stream."""
     response = bedrock_client.invoke_model_with_response_stream(
         modelId=model_id,
         body=json.dumps(input_data),
         contentType="application/json"
     )
+    return response["body"]
 
-    event_stream = response["body"]
-    
-    assistant_response = ""
-    
-    for event in event_stream:
-        event_str = event['chunk']['bytes'].decode()
-        if 'delta' in event_str:
-            try:
-                delta_index = event_str.index('text\":')
-                str = event_str[delta_index:][7:-3]
-                str = str.replace("\\n", "\n")
-                str = str.replace("\\\"", "\"")
-                str = str.replace("•", "\n•\n")
-                assistant_response += str
-            except:
-                pass
-            
-    return assistant_response
+
+def format_pred_text(delta):
+    # bullet points are put on their own lines
+    return delta.replace("•", "\n•\n")
+
+
+def stream_pred(scrapped_data, prompt):
+    """Like get_pred, but yield the text of the response as it arrives. Streamed responses are not cached.
+    Args:
+        scrapped_data (str): The source code of the webpage to analyze.
+        prompt (str): The prompt to guide the analysis.
+    Yields:
+        str: The text deltas of the response.
+    """
+    input_data = pred_request(scrapped_data, prompt)
+    # the rate limit budget is taken before the stream is opened
+    event_stream = LLM_GATEWAY.call("bedrock", model_id, lambda: open_pred_stream(input_data), estimate_request_tokens(input_data))
+    for delta in decode_bedrock_stream(event_stream, StreamMetrics("bedrock", model_id)):
+        yield format_pred_text(delta)
+
+
+def get_pred(scrapped_data, prompt):
+    """Using the Bedrock API, analyze the webpage source code and provide suggestions for improving the web design.
+    Args:
+        scrapped_data (str): The source code of the webpage to analyze.
+        prompt (str): The prompt to guide the analysis.
+    Returns:
+        str: The response from the model based on the provided source code and prompt.
+    Raises:
+        ValueError: If there is no source code, e.g. the page could not be fetched. The model would answer about "None"
+            and the answer would be cached for every page that fails.
+    """
+    if scrapped_data is None:
+        raise ValueError("No website source code to analyze")
+    input_data = pred_request(scrapped_data, prompt)
+
+    def stream_response():
+        event_stream = open_pred_stream(input_data)
+        # the deltas are collected in a list and joined once
+        return "".join(format_pred_text(delta) for delta in decode_bedrock_stream(event_stream, StreamMetrics("bedrock", model_id)))
+
+    return model_call("bedrock", model_id, input_data, stream_response)
+
+
+def invoke_bedrock_text(body):
+    """Send a request body to the Bedrock model and return the text of its response.
+    Responses are served from the model response cache when the same body was sent before,
+    otherwise the call waits for its rate limit budget in the model gateway.
+    Args:
+        body (dict): The Bedrock messages request body.
+    Returns:
+        str: The text of the first content block of the response.
+    """
+    def call():
+        resp = BOTO3_CLIENT.invoke_model(
+            modelId=MODEL_ID,
+            body=json.dumps(body),
+            contentType="application/json"
+        )
+        response_body = json.loads(resp["body"].read())
+        LLM_GATEWAY.record_prompt_usage("bedrock", MODEL_ID, response_body.get("usage"))
+        return response_body["content"][0]["text"]
+
+    return model_call("bedrock", MODEL_ID, body, call)
+
+
+def invoke_openai_text(body):
+    """Send a chat completion request to the OpenAI model and return the text of its response.
+    Responses are served from the model response cache when the same body was sent before,
+    otherwise the call waits for its rate limit budget in the model gateway.
+    Args:
+        body (dict): A dictionary with the "messages", "max_tokens" and "temperature" of the request.
+    Returns:
+        str: The content of the first choice of the response.
+    """
+    def call():
+        resp = OPEN_AI_CLIENT.chat.completions.create(
+            model=MODEL_ID,
+            messages= body["messages"],
+            max_tokens= body["max_tokens"],
+            temperature= body["temperature"],
+        )
+        LLM_GATEWAY.record_prompt_usage("openai", MODEL_ID, resp.usage)
+        return resp.choices[0].message.content
+
+    return model_call("openai", MODEL_ID, body, call)
+
+
+def bedrock_system_prompt(text):
+    """Return the system prompt blocks for a Claude request, marked for prompt caching when it is enabled.
+    Keep the text static (instructions and guidelines only) so every request can reuse the cached prefix.
+    Args:
+        text (str): The static system prompt.
+    Returns:
+        list: The system content blocks.
+    """
+    block = {"type": "text", "text": text}
+    if BEDROCK_PROMPT_CACHING:
+        block["cache_control"] = {"type": "ephemeral"}
+    return [block]
 
 
 def read_file_text(file_path):
@@ -81,19 +234,32 @@ def read_file_text(file_path):
 
 
 ## Webdesign Functions
-def capture_screenshot(url, filepath="screenshot.png"):
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=False)  # try headless=False
-        context = browser.new_context(
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
-            viewport={"width": 1280, "height": 800},
-            locale="en-US",
-        )
-        page = context.new_page()
-        page.goto(url, timeout=60000)
-        page.screenshot(path=filepath, full_page=True)
-        browser.close()
-        return filepath
+def capture_screenshot(url):
+    """Take a full page screenshot of a webpage on a pooled headless browser.
+    Args:
+        url (str): The URL of the webpage.
+    Returns:
+        bytes: The screenshot as PNG bytes, kept in memory so concurrent audits never share a file.
+    """
+    # serve the page document from the shared snapshot, only its images, css and scripts are downloaded by the browser
+    try:
+        snapshot = get_page_snapshot(url)
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching the website snapshot, loading it in the browser: {e}")
+        snapshot = None
+
+    def take_screenshot(page):
+        target_url = url
+        if snapshot is not None:
+            page.route(
+                lambda request_url: request_url == snapshot.final_url,
+                lambda route: route.fulfill(status=200, body=snapshot.content, content_type=snapshot.content_type),
+            )
+            target_url = snapshot.final_url
+        page.goto(target_url, timeout=60000)
+        return page.screenshot(full_page=True)
+
+    return BROWSER_POOL.run(take_screenshot)
 
 
 def upload_to_s3(file_path, bucket_name, object_name=None):
@@ -106,27 +272,86 @@ def upload_to_s3(file_path, bucket_name, object_name=None):
     return s3_url
 
 
+def upload_image_bytes_to_s3(image_bytes, bucket_name, content_type="image/png"):
+    """Stream in-memory image bytes to S3 under a content-hashed key and return its URL.
+    The same screenshot always maps to the same key, so concurrent audits never overwrite each other's image.
+    Args:
+        image_bytes (bytes): The encoded image.
+        bucket_name (str): The S3 bucket to upload to.
+        content_type (str): The MIME type of the image.
+    Returns:
+        str: The public URL of the uploaded image.
+    """
+    extension = content_type.split("/")[-1]
+    object_name = f"screenshots/{hashlib.sha256(image_bytes).hexdigest()}.{extension}"
+
+    s3_client.upload_fileobj(io.BytesIO(image_bytes), bucket_name, object_name,
+                             ExtraArgs={'ACL': 'public-read', 'ContentType': content_type})
+    s3_url = f"https://{bucket_name}.s3.{AWS_REGION}.amazonaws.com/{object_name}"
+    return s3_url
+
+
 ##Code accessibility Functions
 
 def get_pure_source(url):
     """Fetch the source code of a webpage and return it as plain text.
+    The page is served from the shared page snapshot cache, so repeated calls for the same URL do not download it again.
     Args:
         url (str): The URL of the webpage to fetch.
     Returns:
         str: The source code of the webpage as plain text.
     """
     try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()  # Raise exception for HTTP errors
-        source_code = response.text
-        return source_code
+        return get_page_snapshot(url).text
     except requests.exceptions.RequestException as e:
         print(f"Error fetching the website: {e}")
 
 
+# Parsing Functions
+def html_parser_backend():
+    """Return the BeautifulSoup parser to use: HTML_PARSER, or for "auto" lxml when it is installed and html.parser otherwise."""
+    if HTML_PARSER != "auto":
+        return HTML_PARSER
+    try:
+        import lxml  # noqa: F401
+        return "lxml"
+    except ImportError:
+        return "html.parser"
+
+
+def parse_html(html_source, parse_only=None):
+    """Parse HTML with the configured parser backend.
+    When HTML_PARSE_PROFILE is on, how long the parse took and its peak memory are printed (tracemalloc slows parsing down).
+    Args:
+        html_source (str or bytes): The HTML to parse.
+        parse_only (SoupStrainer): Only build the part of the tree that matches, e.g. SoupStrainer("body").
+    Returns:
+        BeautifulSoup: The parsed HTML.
+    """
+    parser = html_parser_backend()
+    # tracemalloc is process wide, so only profile when no other parse is being profiled
+    profile = HTML_PARSE_PROFILE and not tracemalloc.is_tracing()
+    if profile:
+        tracemalloc.start()
+
+    start_time = time.perf_counter()
+    try:
+        soup = BeautifulSoup(html_source, parser, parse_only=parse_only)
+    finally:
+        parse_seconds = time.perf_counter() - start_time
+        peak = None
+        if profile:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    if HTML_PARSE_PROFILE:
+        message = f"Parsed {len(html_source)} bytes of HTML with {parser} in {parse_seconds:.3f}s"
+        if peak is not None:
+            message += f", peak memory {peak / (1024 * 1024):.1f} MB"
+        print(message)
+    return soup
+
+
 # Chunking Functions 
 def num_tokens(text):
     """Calculate the number of tokens in a string using tiktoken."""
@@ -170,31 +395,115 @@ def force_split_text(text, max_tokens):
         chunks.append(sub_text)
     return chunks
 
-def chunk_html_text(url, max_tokens=5000):
-    """Download HTML and chunk it by token size using structural recursion Used for chunking the HTML text."""
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
-    }
-    response = requests.get(url, headers=headers)
-    soup = BeautifulSoup(response.content, 'html.parser')
+def pack_chunks(chunks, max_tokens=4000):
+    """Bin-pack adjacent chunks into groups of at most max_tokens, so small sections can share one model call.
+    A chunk larger than max_tokens is given a group of its own.
+    Args:
+        chunks (list): The text chunks, in page order.
+        max_tokens (int): The maximum number of tokens of text in a group.
+    Returns:
+        list: A list of groups, each a list of the indices of its chunks in page order.
+    """
+    groups = []
+    group = []
+    group_tokens = 0
+    for index, chunk in enumerate(chunks):
+        tokens = num_tokens(chunk)
+        if group and group_tokens + tokens > max_tokens:
+            groups.append(group)
+            group = []
+            group_tokens = 0
+        group.append(index)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+def subtree_token_counts(root, markup=False):
+    """Count the tokens of every element under root in one bottom-up pass.
+    Each string (and, for markup, each tag) is tokenized exactly once and the counts are summed up the tree,
+    so the count of an element is the sum of its parts rather than an exact tokenization of the whole.
+    Args:
+        root (BeautifulSoup element): The element whose subtree to count.
+        markup (bool): Count the HTML of each element instead of its text.
+    Returns:
+        dict: The token count of each element, keyed by id(element).
+    """
+    counts = {id(root): 0}
+    elements = [root]
+
+    for node in root.descendants:
+        if isinstance(node, Tag):
+            tokens = 0
+            if markup:
+                attrs = "".join(f' {name}="{" ".join(value) if isinstance(value, list) else value}"' for name, value in node.attrs.items())
+                tokens = num_tokens(f"<{node.name}{attrs}></{node.name}>")
+            counts[id(node)] = counts.get(id(node), 0) + tokens
+            elements.append(node)
+        elif markup:
+            counts[id(node.parent)] = counts.get(id(node.parent), 0) + num_tokens(node.output_ready())
+        elif type(node) in (NavigableString, CData):
+            # the same strings get_text(separator=' ', strip=True) joins
+            text = node.strip()
+            if text:
+                counts[id(node.parent)] = counts.get(id(node.parent), 0) + num_tokens(" " + text)
+
+    # descendants are in document order, so walking them backwards adds every child before its parent
+    for element in reversed(elements[1:]):
+        counts[id(element.parent)] += counts[id(element)]
+    return counts
+
+
+def chunk_elements(elements, max_tokens, counts, tags, markup=False):
+    """Emit chunks of at most max_tokens from the token counts of subtree_token_counts.
+    An element that fits is emitted whole, otherwise its direct children with one of the given tags are chunked,
+    and an element with no such children is split by tokens.
+    Args:
+        elements (list): The elements to chunk, in page order.
+        max_tokens (int): The maximum number of tokens allowed in a chunk.
+        counts (dict): The token counts of the elements and their descendants.
+        tags (list): The tags to descend into when an element is too big.
+        markup (bool): Emit the HTML of each element instead of its text.
+    Returns:
+        list: A list of text (or HTML) chunks, each within the token limit.
+    """
+    def render(element):
+        return str(element) if markup else element.get_text(separator=' ', strip=True)
+
+    chunks = []
+    for elem in elements:
+        if not counts[id(elem)]:
+            continue
+        if counts[id(elem)] <= max_tokens:
+            chunks.append(render(elem))
+            continue
+
+        # Go deeper
+        child_chunks = chunk_elements(elem.find_all(tags, recursive=False), max_tokens, counts, tags, markup)
+        if not child_chunks:
+            # no more structure, forcibly split the text
+            child_chunks = force_split_text(render(elem), max_tokens)
+        chunks.extend(child_chunks)
+    return chunks
+
+
+def chunk_html_text(url, max_tokens=5000, html_source=None):
+    """Download HTML and chunk it by token size, descending into sections that are too big. Used for chunking the HTML text.
+    If html_source is given, it is used instead of the page snapshot."""
+    if html_source is None:
+        html_source = get_page_snapshot(url).content
+    # only the body is built, the head (scripts, styles and metadata) has no text to chunk
+    soup = parse_html(html_source, parse_only=SoupStrainer('body'))
     
     main = soup.find('main')
     if not main:
         main = soup.body  # fallback
     
-    chunks = []
+    # the page is walked once to count the tokens of every element
+    tags = ['section', 'div', 'article']
+    counts = subtree_token_counts(main)
+
     # Only start from direct children
-    for elem in main.find_all(['section', 'div', 'article'], recursive=False):
-        text = elem.get_text(separator=' ', strip=True)
-        if not text:
-            continue
-        
-        if num_tokens(text) <= max_tokens:
-            chunks.append(text)
-        else:
-            # Go deeper recursively
-            chunks.extend(chunk_element(elem, max_tokens))
-    
-    return chunks
+    return chunk_elements(main.find_all(tags, recursive=False), max_tokens, counts, tags)
 
 
@@ -0,0 +1,207 @@
+import copy
+import re
+
+from bs4 import BeautifulSoup
+
+from utils import html_parser_backend
+from constants import MAX_ISSUES_CODE_ACESSIBILITY
+
+'''
+This script is a local rule engine for the mechanical WCAG 2.1 issues the accessibility prompts look for:
+images without alt text, buttons and links without an accessible name, vague link text, unlabeled form fields,
+click handlers on non-semantic elements and a missing page language or title.
+
+The rules run on the parsed HTML of each chunk in milliseconds and return suggestions in the same shape as the
+model review (label, original_content, revised_content, explanation). Only chunks with content the rules can not
+judge (tables, media, frames, custom widgets) and without enough rule findings are sent to the model.
+'''
+
+VAGUE_LINK_TEXT = {"click here", "here", "click", "read more", "more", "learn more", "more info", "link", "this link", "details", "go"}
+
+# input types whose accessible name comes from their value, or that are not shown
+UNLABELED_INPUT_TYPES = {"hidden", "submit", "button", "reset", "image"}
+
+# elements that need a judgment the rules can not make, so their chunks go to the model
+AMBIGUOUS_TAGS = ["table", "iframe", "video", "audio", "canvas", "object", "embed", "map", "dialog"]
+# attributes of custom widgets whose behavior needs a review
+AMBIGUOUS_ATTRIBUTES = ["role", "tabindex", "onkeydown", "onkeyup", "onkeypress"]
+
+FILE_NAME = re.compile(r"^[\w\-. ]+\.(png|jpe?g|gif|svg|webp|bmp)$|^(img|image|dsc|photo)[\-_ ]?\d+$", re.IGNORECASE)
+HTML_TAG = re.compile(r"<html\b[^>]*>", re.IGNORECASE)
+TITLE = re.compile(r"<title\b[^>]*>(.*?)</title>", re.IGNORECASE | re.DOTALL)
+LABEL_FOR = re.compile(r"<label\b[^>]*?\bfor\s*=\s*[\"']?([^\"'\s>]+)", re.IGNORECASE)
+
+
+def snippet(element, limit=300):
+    """Return the HTML of an element, shortened to its opening and closing tags when it is long."""
+    html = str(element)
+    if len(html) <= limit:
+        return html
+    attrs = "".join(f' {name}="{" ".join(value) if isinstance(value, list) else value}"' for name, value in element.attrs.items())
+    return f"<{element.name}{attrs}>...</{element.name}>"
+
+
+def has_accessible_name(element):
+    """Whether an element has text, an aria-label, aria-labelledby or title, or an image with alt text."""
+    if element.get_text(strip=True):
+        return True
+    if element.get("aria-label", "").strip() or element.get("aria-labelledby") or element.get("title", "").strip():
+        return True
+    return any(img.get("alt", "").strip() for img in element.find_all("img"))
+
+
+def suggestion(label, original, revised, explanation):
+    return {"label": label, "original_content": original, "revised_content": revised, "explanation": explanation}
+
+
+def check_images(soup):
+    findings = []
+    for img in soup.find_all("img"):
+        if img.find_parent(attrs={"aria-hidden": "true"}):
+            continue
+        revised = copy.copy(img)
+        revised["alt"] = "Describe the image"
+        if not img.has_attr("alt"):
+            findings.append(suggestion(
+                "Missing alt text for image", snippet(img), snippet(revised),
+                "Adding alt text to images provides a text alternative for screen reader users, improving accessibility in accordance with WCAG 2.1 guideline 1.1.1 (Non-text Content). Use alt=\"\" if the image is decorative.",
+            ))
+        elif FILE_NAME.match(img["alt"].strip()):
+            findings.append(suggestion(
+                "Image alt text is a file name", snippet(img), snippet(revised),
+                "A file name does not describe the image to screen reader users. Alt text should convey the content or function of the image, as required by WCAG 2.1 guideline 1.1.1 (Non-text Content).",
+            ))
+    return findings
+
+
+def check_buttons(soup):
+    findings = []
+    for button in soup.find_all("button"):
+        if not has_accessible_name(button):
+            revised = copy.copy(button)
+            revised["aria-label"] = "Describe the action"
+            findings.append(suggestion(
+                "Button lacks accessible name", snippet(button), snippet(revised),
+                "Using an aria-label on buttons without visible text ensures that assistive technology users can understand their function, supporting WCAG 2.1 guideline 4.1.2 (Name, Role, Value).",
+            ))
+    return findings
+
+
+def check_links(soup):
+    findings = []
+    for link in soup.find_all("a", href=True):
+        text = link.get_text(" ", strip=True)
+        if not has_accessible_name(link):
+            revised = copy.copy(link)
+            revised["aria-label"] = "Describe the link destination"
+            findings.append(suggestion(
+                "Link lacks accessible name", snippet(link), snippet(revised),
+                "Links without text or an accessible name are announced only as \"link\" by screen readers. Every link needs a name that describes its purpose, meeting WCAG 2.1 guidelines 2.4.4 (Link Purpose) and 4.1.2 (Name, Role, Value).",
+            ))
+        elif text.lower().strip(".!:> ") in VAGUE_LINK_TEXT and not link.get("aria-label", "").strip():
+            revised = copy.copy(link)
+            revised.string = "Describe the link destination"
+            findings.append(suggestion(
+                "Non-descriptive link text", snippet(link), snippet(revised),
+                "Replacing vague link text like \"Click here\" with descriptive text improves navigation and comprehension for screen reader users, meeting WCAG 2.1 guideline 2.4.4 (Link Purpose).",
+            ))
+    return findings
+
+
+def label_ids(html_source):
+    """Return the ids that the <label for=...> elements of some HTML point to."""
+    return set(LABEL_FOR.findall(html_source or ""))
+
+
+def check_form_fields(soup, page_labeled_ids=frozenset()):
+    """Report form fields without a label. page_labeled_ids are the label ids of the whole page, because a label and
+    its field can end up in different chunks."""
+    findings = []
+    labeled_ids = {label["for"] for label in soup.find_all("label", attrs={"for": True})} | set(page_labeled_ids)
+    for field in soup.find_all(["input", "select", "textarea"]):
+        if field.name == "input" and field.get("type", "text").lower() in UNLABELED_INPUT_TYPES:
+            continue
+        if field.get("aria-label", "").strip() or field.get("aria-labelledby") or field.get("title", "").strip():
+            continue
+        if field.find_parent("label") or (field.get("id") and field["id"] in labeled_ids):
+            continue
+
+        revised = copy.copy(field)
+        revised["id"] = field.get("id") or f"{field.get('name', field.name)}-field"
+        findings.append(suggestion(
+            "Label not associated with input field", snippet(field),
+            f'<label for="{revised["id"]}">Describe the field</label>{snippet(revised)}',
+            "Using a label with a 'for' attribute ensures form fields are programmatically associated with their label, which is essential for assistive technology users, aligning with WCAG 2.1 guideline 1.3.1 (Info and Relationships) and 3.3.2 (Labels or Instructions).",
+        ))
+    return findings
+
+
+def check_click_handlers(soup):
+    findings = []
+    for element in soup.find_all(["div", "span"], onclick=True):
+        if element.get("role") in ("button", "link") and element.has_attr("tabindex"):
+            continue
+        original = snippet(element)
+        revised = f'<button onclick="{element["onclick"]}">{element.get_text(" ", strip=True)[:100]}</button>'
+        findings.append(suggestion(
+            "Non-semantic interactive element", original, revised,
+            "Interactive elements must use semantic HTML like <button> to be properly understood by screen readers and keyboard users, as outlined in WCAG 2.1 guideline 4.1.2 (Name, Role, Value).",
+        ))
+    return findings
+
+
+CHUNK_RULES = [check_images, check_buttons, check_links, check_click_handlers]
+
+
+def check_chunk(html_chunk, page_labeled_ids=frozenset()):
+    """Run the rules on an HTML chunk.
+    Args:
+        html_chunk (str): The HTML code chunk.
+        page_labeled_ids (set): The label ids of the whole page, see label_ids.
+    Returns:
+        tuple: (suggestions, needs_model) where suggestions are the rule findings and needs_model tells whether the
+            chunk has content that only the model can review.
+    """
+    soup = BeautifulSoup(html_chunk, html_parser_backend())
+
+    findings = []
+    for rule in CHUNK_RULES:
+        findings.extend(rule(soup))
+    findings.extend(check_form_fields(soup, page_labeled_ids))
+
+    ambiguous = bool(soup.find(AMBIGUOUS_TAGS)) or any(
+        soup.find(attrs={name: True}) for name in AMBIGUOUS_ATTRIBUTES
+    ) or bool(soup.find(lambda tag: any(name.startswith("aria-") and name not in ("aria-label", "aria-hidden") for name in tag.attrs)))
+    # the model review finds at most MAX_ISSUES_CODE_ACESSIBILITY issues per chunk, the rules already found them
+    needs_model = ambiguous and len(findings) < MAX_ISSUES_CODE_ACESSIBILITY
+    return findings, needs_model
+
+
+def check_page(html_source):
+    """Run the page level rules (language and title of the page) on the page HTML.
+    Args:
+        html_source (str): The HTML of the page.
+    Returns:
+        list: The rule findings.
+    """
+    findings = []
+    if not html_source:
+        return findings
+
+    html_tag = HTML_TAG.search(html_source)
+    if html_tag:
+        tag = BeautifulSoup(html_tag.group(0), "html.parser").find("html")
+        if tag is not None and not (tag.get("lang", "").strip() or tag.get("xml:lang", "").strip()):
+            findings.append(suggestion(
+                "Missing page language", html_tag.group(0), html_tag.group(0)[:-1].rstrip() + ' lang="en">',
+                "Setting the lang attribute on the <html> element lets screen readers pronounce the content correctly, as required by WCAG 2.1 guideline 3.1.1 (Language of Page).",
+            ))
+
+    title = TITLE.search(html_source)
+    if not title or not title.group(1).strip():
+        original = title.group(0) if title else "<head>"
+        findings.append(suggestion(
+            "Missing page title", original, "<title>Describe the page</title>",
+            "A descriptive page title tells users where they are and which tab is which, meeting WCAG 2.1 guideline 2.4.2 (Page Titled).",
+        ))
+    return findings
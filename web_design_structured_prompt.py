@@ -6,8 +6,13 @@ from typing import List
 from dotenv import load_dotenv
 from anthropic import AnthropicBedrock
 import base64
+import hashlib
+import concurrent.futures
 
 from constants import MODEL_SELECTION, INSTRUCTOR_CLIENT, S3_BUCKET_NAME, MODEL_ID, MAX_TOKENS
+from llm_cache import guideline_version
+from llm_gateway import LLM_GATEWAY, model_call
+from image_preparation import prepare_screenshot_tiles, report_tiles
 load_dotenv()
 
 '''
@@ -16,8 +21,19 @@ This script uses the Instructor library to analyze web design suggestions based
 When using claude models via Bedrock, a base64 encoding is required to process the image. 
 Directly passing the s3_url or image will not work. 
 
+The screenshot is kept in memory and split into downscaled JPEG tiles that are analyzed in parallel.
+Each tile is base64 encoded directly for Claude, or uploaded to S3 under a content-hashed key for OpenAI.
+The upload runs in the background while the prompt is built.
+Responses are cached by the tile hash and the layout guidelines, see llm_cache.py.
+
+The layout guidelines are sent as a static system prompt ahead of the screenshot, so the provider
+prompt cache can serve them (they are about 7,000 tokens).
+
 '''
 
+# background uploads of screenshots to S3
+S3_UPLOAD_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
 
 class WebSuggestion(BaseModel):
     key: int = Field(..., description = "A unique identifier for this suggestion item." )
@@ -26,26 +42,84 @@ class WebSuggestion(BaseModel):
     reason: str = Field(...,description="A brief explanation of why this suggestion is important, such as 'Improves user engagement and guides users to key content.'")
 
 
-def encode_image_to_base64(image_path):
+def encode_image_to_base64(image_bytes):
     """
-    Reads an image file and returns a base64-encoded string.
+    Encodes in-memory image bytes and returns a base64-encoded string.
     """
-    with open(image_path, "rb") as image_file:
-        encoded_bytes = base64.b64encode(image_file.read())
-        encoded_string = encoded_bytes.decode("utf-8")
+    encoded_bytes = base64.b64encode(image_bytes)
+    encoded_string = encoded_bytes.decode("utf-8")
     return encoded_string
 
 
-def analyze_webdesign(url, Layout_guidelines): 
-    """Using the OpenAI API, analyze the webpage screenshot and provide suggestions for improving the web design.
+def analyze_webdesign(url, Layout_guidelines, screenshot=None): 
+    """Analyze the webpage screenshot and provide suggestions for improving the web design.
+    The screenshot is split into tiles (see image_preparation.py) that are analyzed in parallel on the shared
+    model gateway, and their suggestions are merged. Must not be called from a gateway worker.
     Args:
         url (str): The URL of the webpage to analyze.
+        screenshot (bytes): The screenshot of the webpage, taken here if it is not given.
     Returns:
         output (List[WebSuggestion]) : A list of suggestions for improving the web design, each represented as a WebSuggestion object.
     """
 
+    if screenshot is None:
+        screenshot = capture_screenshot(url)
+    tiles = prepare_screenshot_tiles(screenshot)
+    report_tiles(screenshot, tiles, "bedrock" if MODEL_SELECTION else "openai")
+
+    future_to_tile = {}
+    for tile in tiles:
+        upload_future = None
+        if not MODEL_SELECTION:
+            # start the S3 upload for the OpenAI model while the prompt is being built
+            upload_future = S3_UPLOAD_EXECUTOR.submit(upload_image_bytes_to_s3, tile.image_bytes, S3_BUCKET_NAME, tile.media_type)
+        future_to_tile[LLM_GATEWAY.submit(analyze_webdesign_tile, tile, Layout_guidelines, upload_future)] = tile
+
+    tile_suggestions = {}
+    for future in concurrent.futures.as_completed(future_to_tile):
+        tile = future_to_tile[future]
+        try:
+            tile_suggestions[tile.index] = future.result()
+        except Exception as e:
+            print(f"Error processing screenshot tile {tile.index + 1}: {e}")
+
+    return merge_tile_suggestions([tile_suggestions.get(tile.index, []) for tile in tiles])
+
+
+def merge_tile_suggestions(tile_suggestions):
+    """Merge the suggestions of the tiles in page order, dropping repeats and numbering the keys again.
+    Args:
+        tile_suggestions (list): The suggestions of each tile, in page order.
+    Returns:
+        list: The merged suggestions.
+    """
+    output = []
+    seen = set()
+    for suggestions in tile_suggestions:
+        for item in suggestions:
+            # the same suggestion can come from several tiles, e.g. for a sticky header
+            fingerprint = (item["area"].strip().lower(), item["suggestion"].strip().lower())
+            if fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+            output.append(dict(item, key=len(output) + 1))
+    return output
+
+
+def analyze_webdesign_tile(tile, Layout_guidelines, upload_future=None):
+    """Analyze one screenshot tile and provide suggestions for improving the web design.
+    Args:
+        tile (ScreenshotTile): The screenshot tile.
+        Layout_guidelines (str): The layout guidelines to follow.
+        upload_future (Future): The S3 upload of the tile, for the OpenAI model.
+    Returns:
+        output (list): The suggestions for the tile.
+    """
+
+    # the instructions and the (large) guidelines come first and never change, so the providers can cache them as a prefix
+    system_prompt = f"""You are an AI expert in web accessibility. Analyze the image and provide WCAG-compliant suggestions.
 
-    input_message = f"""Analyze this webpage screenshot and provide improvements for the layout of the page based off of the following guidelines: {Layout_guidelines}. \
+                Provide improvements for the layout of the page based off of the following guidelines: {Layout_guidelines}. \
                 For each suggestion, provide an example of a part of the site that could be improved. Also cite specific guidelines in each suggestion. \
                 If you cannot provide a specific element on the webpage as an example, do not include the suggestion. 
                 
@@ -60,28 +134,30 @@ def analyze_webdesign(url, Layout_guidelines):
                             reason: 'Improves user engagement and guides users to key content.',
                         }},"""
 
-    screenshot_path = capture_screenshot(url)
-
-    if MODEL_SELECTION: 
-        #Using claude model 
-        image_base64 = encode_image_to_base64(screenshot_path)
-
-        image_payload = {
-        "type": "image",
-            "source": {
-                "type": "base64",
-                "media_type": "image/png",  
-                "data": image_base64
-            }
-    }
-        try: 
-
-            resp = INSTRUCTOR_CLIENT.messages.create(
+    input_message = "Analyze this webpage screenshot and provide improvements for the layout of the page."
+    if tile.count > 1:
+        input_message = (f"This image is part {tile.index + 1} of {tile.count} of a full page screenshot, from the top of the page down. "
+                         f"Analyze this part of the webpage and provide improvements for its layout.")
+
+    def request_suggestions():
+        if MODEL_SELECTION: 
+            #Using claude model 
+            image_base64 = encode_image_to_base64(tile.image_bytes)
+
+            image_payload = {
+            "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": tile.media_type,  
+                    "data": image_base64
+                }
+        }
+
+            resp, completion = INSTRUCTOR_CLIENT.messages.create_with_completion(
                 model= MODEL_ID,
                 max_tokens= MAX_TOKENS,
+                system=bedrock_system_prompt(system_prompt),
                 messages=[
-                    #if I wanted to add text guidlines, would i edit this or input text
-                    {"role": "system", "content": "You are an AI expert in web accessibility. Analyze the image and provide WCAG-compliant suggestions."},
                     {
                         "role": "user",
                         "content": [
@@ -92,38 +168,16 @@ def analyze_webdesign(url, Layout_guidelines):
                 ], 
                 response_model = List[WebSuggestion],
             )
-        
-            if not isinstance(resp, list):
-                raise TypeError(f"Expected list, got {type(resp)}")
-        
-        #if the response is a list, check each item type for instance of ContentSuggestion
-            else: 
-                output = []
-                for item in resp:
-                    assert isinstance(item, WebSuggestion)
-                    output.append({"key": item.key,
-                                    "area": item.area,
-                                    "suggestion": item.suggestion,
-                                    "reason": item.reason})  
-                    
-                return output
-        
-        except (ValidationError, InstructorRetryException, TypeError) as e:
-            print(f"Error processing Claude response:{e} ")
-            return []
-
+            LLM_GATEWAY.record_prompt_usage("bedrock", MODEL_ID, completion.usage)
 
-    else: 
-        #Using open AI model 
-        s3_url = upload_to_s3(screenshot_path, S3_BUCKET_NAME)
+        else: 
+            #Using open AI model 
+            s3_url = upload_future.result()
 
-        try: 
-
-            resp = INSTRUCTOR_CLIENT.chat.completions.create(
+            resp, completion = INSTRUCTOR_CLIENT.chat.completions.create_with_completion(
             model= MODEL_ID,
             messages=[
-                #if I wanted to add text guidlines, would i edit this or input text
-                {"role": "system", "content": "You are an AI expert in web accessibility. Analyze the image and provide WCAG-compliant suggestions."},
+                {"role": "system", "content": system_prompt},
                 {
                     "role": "user",
                     "content": [
@@ -134,26 +188,37 @@ def analyze_webdesign(url, Layout_guidelines):
             ], 
             response_model = List[WebSuggestion],
             ) 
+            LLM_GATEWAY.record_prompt_usage("openai", MODEL_ID, completion.usage)
 
-            # Check response type
-            if not isinstance(resp, list):
-                    raise TypeError(f"Expected list, got {type(resp)}")
-            
-            #if the response is a list, check each item type for instance of ContentSuggestion
-            else: 
-                output = []
-                for item in resp:
-                    assert isinstance(item, WebSuggestion)
-                    output.append({"key": item.key,
-                                    "area": item.area,
-                                    "suggestion": item.suggestion,
-                                    "reason": item.reason})  
-                    
-                return output
+        # Check response type
+        if not isinstance(resp, list):
+                raise TypeError(f"Expected list, got {type(resp)}")
+        
+        #if the response is a list, check each item type for instance of ContentSuggestion
+        output = []
+        for item in resp:
+            assert isinstance(item, WebSuggestion)
+            output.append({"key": item.key,
+                            "area": item.area,
+                            "suggestion": item.suggestion,
+                            "reason": item.reason})  
             
-        except (ValidationError, InstructorRetryException, TypeError) as e:
-            print(f"Error processing Claude response:{e} ")
-            return []
+        return output
+
+    try: 
+        # the screenshot is keyed by its hash instead of its (large) base64 encoding
+        return model_call(
+            "bedrock" if MODEL_SELECTION else "openai",
+            MODEL_ID,
+            {"system": system_prompt, "prompt": input_message, "image_sha256": hashlib.sha256(tile.image_bytes).hexdigest(),
+             "max_tokens": MAX_TOKENS, "response_model": "List[WebSuggestion]"},
+            request_suggestions,
+            guideline_version=guideline_version(Layout_guidelines),
+        )
+
+    except (ValidationError, InstructorRetryException, TypeError) as e:
+        print(f"Error processing Claude response:{e} ")
+        return []
             
         
 # testing    